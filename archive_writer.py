@@ -0,0 +1,210 @@
+import asyncio
+import csv
+import os
+import queue
+import struct
+import threading
+import time
+import zipfile
+import zlib
+
+from metrics import log
+
+# 已经压缩过的图片格式再 DEFLATE 只会浪费 CPU
+STORED_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+
+class ArchiveWriter:
+    """images.zip + train.csv 的写入阶段，运行在独立线程里，由队列供数据。
+
+    启动时只读取一次 zip 的目录建立文件名索引，之后查重是 O(1)；图片字节用 writestr 直接写入，不经过临时文件。
+    zip 的中央目录只在关闭时写出，所以写入的条目先不确认：队列取空、攒满 flush_every 条或距上次提交超过
+    flush_interval 秒时关闭压缩包写出目录，连同 CSV 一起 fsync 后再以追加模式重新打开，这之后 add() 才返回，
+    调用方随后在清单里记为已完成。追加的新条目会覆盖旧的目录，异常退出后由 _recover() 逐条找回完整的条目。
+    """
+
+    def __init__(self, zip_path, csv_path, fieldnames=('filename', 'tags'), flush_every=200, flush_interval=5.0, queue_size=256):
+        self.zip_path = os.fspath(zip_path)
+        self.csv_path = csv_path
+        self.fieldnames = list(fieldnames)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.names = set()
+        self.thread = None
+        self.written = 0
+        # 有还没有写出目录的条目
+        self.modified = False
+
+    def start(self):
+        if os.path.exists(self.zip_path + '.recover') or not _readable(self.zip_path):
+            self._recover()
+        self.fileobj = open(self.zip_path, 'r+b' if os.path.exists(self.zip_path) else 'w+b')
+        self.zipf = zipfile.ZipFile(self.fileobj, 'a', zipfile.ZIP_DEFLATED)
+        self.names = set(self.zipf.NameToInfo)
+        self.csvfile = open(self.csv_path, mode='a', newline='', encoding='utf-8')
+        self.csv_writer = csv.DictWriter(self.csvfile, fieldnames=self.fieldnames)
+        if self.csvfile.tell() == 0:
+            self.csv_writer.writeheader()
+        self.thread = threading.Thread(target=self._run, name='archive-writer', daemon=True)
+        self.thread.start()
+        log.info(f"压缩包中已有 {len(self.names)} 个文件: {self.zip_path}")
+        return self
+
+    def __contains__(self, name):
+        return name in self.names
+
+    async def add(self, name, data, csv_row):
+        """把一张图片和对应的 CSV 行交给写入线程，写入完成后返回 True（同名文件已存在时返回 False）。
+
+        data 为 None 时只追加 CSV 行，引用压缩包里已有的同名图片。
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        item = (name, data, csv_row, loop, done)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # 写入跟不上时在线程池里等待队列空位，不阻塞事件循环
+            await loop.run_in_executor(None, self.queue.put, item)
+        return await done
+
+    def _write(self, name, data, csv_row):
+        if data is None:
+            self.csv_writer.writerow(csv_row)
+            return True
+        if name in self.names:
+            return False
+        compress_type = zipfile.ZIP_STORED if name.lower().endswith(STORED_SUFFIXES) else zipfile.ZIP_DEFLATED
+        self.zipf.writestr(name, data, compress_type=compress_type)
+        self.modified = True
+        self.names.add(name)
+        self.csv_writer.writerow(csv_row)
+        return True
+
+    def _commit(self):
+        if self.modified:
+            # close() 在 start_dir 处写出中央目录；传入的文件对象不会被关闭，重新打开时从新的目录继续追加
+            self.zipf.close()
+            self.fileobj.flush()
+            os.fsync(self.fileobj.fileno())
+            self.zipf = zipfile.ZipFile(self.fileobj, 'a', zipfile.ZIP_DEFLATED)
+            self.modified = False
+        self.csvfile.flush()
+        os.fsync(self.csvfile.fileno())
+
+    def _recover(self):
+        # 上次异常退出时目录可能已被之后追加的条目覆盖：把文件改名为 .recover，从头扫描本地文件头，
+        # CRC 校验通过的条目写进新的压缩包，落盘后才删除 .recover（恢复中途退出时下次从 .recover 重来）
+        part = self.zip_path + '.recover'
+        if not os.path.exists(part):
+            os.replace(self.zip_path, part)
+        count = 0
+        with open(self.zip_path, 'wb') as f:
+            with zipfile.ZipFile(f, 'w') as zipf:
+                for info, data in _salvage(part):
+                    zipf.writestr(info, data)
+                    count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.remove(part)
+        log.warning(f"压缩包目录损坏，已从本地文件头恢复 {count} 个文件: {self.zip_path}")
+
+    def _run(self):
+        unconfirmed = []
+        last_commit = time.monotonic()
+        stopping = False
+        while not stopping:
+            try:
+                # 有未确认的条目时不等待，队列一空就提交
+                item = self.queue.get(block=not unconfirmed)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                name, data, csv_row, loop, done = item
+                if name is None:
+                    stopping = True
+                else:
+                    try:
+                        result = self._write(name, data, csv_row)
+                        self.written += result
+                        unconfirmed.append((loop, done, result))
+                    except Exception as e:
+                        loop.call_soon_threadsafe(_set_exception, done, e)
+            if unconfirmed and (item is None or stopping or len(unconfirmed) >= self.flush_every or time.monotonic() - last_commit >= self.flush_interval):
+                try:
+                    self._commit()
+                except Exception as e:
+                    log.error(f"压缩包提交失败: {e}")
+                    for loop, done, result in unconfirmed:
+                        loop.call_soon_threadsafe(_set_exception, done, e)
+                else:
+                    for loop, done, result in unconfirmed:
+                        loop.call_soon_threadsafe(_set_result, done, result)
+                unconfirmed = []
+                last_commit = time.monotonic()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put((None, None, None, None, None))
+            self.thread.join()
+            self.thread = None
+        self.csvfile.close()
+        self.zipf.close()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _readable(path):
+    # 不存在或为空时是新的压缩包；目录损坏时 ZipFile 的追加模式会把新压缩包接在文件末尾，旧条目就找不到了，需要先恢复
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    try:
+        with zipfile.ZipFile(path):
+            return True
+    except zipfile.BadZipFile:
+        return False
+
+
+def _salvage(path):
+    """按顺序读取本地文件头，逐个返回完整的 (ZipInfo, bytes)，遇到第一个不完整的条目为止。"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(zipfile.sizeFileHeader)
+            if len(header) < zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+                return
+            _, _, _, flags, method, mtime, mdate, crc, compress_size, file_size, name_length, extra_length = struct.unpack(zipfile.structFileHeader, header)
+            # 大小记在数据之后（0x08）或 zip64 时无法确定条目的结尾
+            if flags & 0x08 or compress_size == 0xFFFFFFFF or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                return
+            name = f.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+            f.seek(extra_length, os.SEEK_CUR)
+            data = f.read(compress_size)
+            if len(data) < compress_size:
+                return
+            if method == zipfile.ZIP_DEFLATED:
+                try:
+                    data = zlib.decompress(data, -zlib.MAX_WBITS)
+                except zlib.error:
+                    return
+            if len(data) != file_size or zlib.crc32(data) != crc:
+                return
+            date_time = ((mdate >> 9) + 1980, (mdate >> 5) & 0xF, mdate & 0x1F, mtime >> 11, (mtime >> 5) & 0x3F, (mtime & 0x1F) * 2)
+            info = zipfile.ZipInfo(name, date_time=date_time)
+            info.compress_type = method
+            yield info, data
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
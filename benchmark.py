@@ -0,0 +1,614 @@
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import urlsplit, parse_qsl
+
+from PIL import Image
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource，峰值内存记为 None
+    resource = None
+
+from buckets import Buckets
+from engine import Crawl, CrawlEngine
+from metrics import metrics
+from sinks import FolderSink, ShardSink, ArchiveSink
+from sources import DanbooruSource, MoebooruSource, PREVIEW_VARIANTS, make_policy
+from workqueue import worker_dir, worker_file
+
+# 列表接口和图片用不同的主机名，客户端的按 host 限速和真实站点一样分开
+API_HOST = '127.0.0.1'
+CDN_HOST = 'localhost'
+# 各变体的长边像素，original 使用场景里的 image_size
+VARIANT_SIZES = {'720x720': 720, 'sample': 850, 'preview': 180}
+
+
+def synthetic_image(fmt, size):
+    # 随机噪声图，压缩后的体积接近真实照片/插画的上限
+    width, height = size
+    img = Image.frombytes('RGB', size, os.urandom(width * height * 3))
+    out = io.BytesIO()
+    img.save(out, {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}[fmt])
+    return out.getvalue()
+
+
+class MockBooru:
+    """本地的假图站，在后台线程里运行自己的事件循环。
+
+    列表接口模仿 Danbooru 的 posts.json（page=N / b<id> / a<id>，media_asset.variants，~tag OR 查询）
+    和 Moebooru 的 post.json（tags 里的 id:<N / id:>N），另有 tags.json / tag_aliases.json 供规划阶段使用。
+    图片按格式和尺寸生成一次，每个帖子在末尾追加自己的 id，md5 各不相同且与返回的字节一致。
+    通过 configure() 注入延迟、429、被截断的响应体和内容损坏的图片。
+    """
+
+    def __init__(self, tags=(), posts_per_tag=200, shared_posts=0, formats=('jpg', 'png', 'webp'), image_size=(1024, 768)):
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.server = None
+        self.port = None
+        self.images = {}
+        self.hashes = {}
+        self.md5s = {}
+        self.configure(tags, posts_per_tag, shared_posts, formats, image_size)
+        self.reset()
+
+    def configure(self, tags=(), posts_per_tag=200, shared_posts=0, formats=('jpg', 'png', 'webp'), image_size=(1024, 768),
+                  api_latency=0.0, cdn_latency=0.0, throttle_rate=0.0, retry_after=1, truncate_rate=0.0, ranges=True, seed=0, corrupt_rate=0.0):
+        """shared_posts 个帖子同时属于所有 tag（用于测试 md5 去重）；throttle_rate / truncate_rate 是每个请求返回 429 /
+        只发送一半响应体后断开的概率；corrupt_rate 是图片以 200 返回、但内容只有前一半（Content-Length 与之一致）的概率。"""
+        self.tags = list(tags)
+        self.posts_per_tag = posts_per_tag
+        self.shared_posts = shared_posts
+        self.formats = formats
+        self.image_size = tuple(image_size)
+        self.api_latency = api_latency
+        self.cdn_latency = cdn_latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.truncate_rate = truncate_rate
+        # 图片是否支持 Range 续传
+        self.ranges = ranges
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+        self.md5s.clear()
+
+    def prepare(self):
+        # 预先生成底图，生成时间不计入场景耗时
+        for ext in self.formats:
+            for variant in ('original',) + tuple(VARIANT_SIZES):
+                self.image(variant, 0, ext)
+
+    def reset(self):
+        self.requests = {'api': 0, 'cdn': 0, 'throttled': 0, 'truncated': 0, 'resumed': 0, 'corrupted': 0, 'bytes': 0}
+
+    @property
+    def api_url(self):
+        return f'http://{API_HOST}:{self.port}'
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._serve, API_HOST, 0))
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name='mock-booru', daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # ---- 数据 ----
+
+    def tag_ids(self, tag):
+        if tag not in self.tags:
+            return []
+        index = self.tags.index(tag)
+        # 共享帖子的 id 最小，各 tag 自己的帖子按 tag 分段
+        own = range(1_000_000 * (index + 1), 1_000_000 * (index + 1) + self.posts_per_tag - self.shared_posts)
+        return list(range(1, self.shared_posts + 1)) + list(own)
+
+    def post_tags(self, post_id):
+        if post_id <= self.shared_posts:
+            return self.tags
+        return [self.tags[post_id // 1_000_000 - 1]]
+
+    def file_ext(self, post_id):
+        return self.formats[post_id % len(self.formats)]
+
+    def variant_size(self, variant):
+        if variant == 'original':
+            return self.image_size
+        scale = min(1.0, VARIANT_SIZES[variant] / max(self.image_size))
+        return max(1, int(self.image_size[0] * scale)), max(1, int(self.image_size[1] * scale))
+
+    def image(self, variant, post_id, ext):
+        size = self.variant_size(variant)
+        key = (ext, size)
+        if key not in self.images:
+            self.images[key] = synthetic_image(ext, size)
+        return self.images[key] + str(post_id).encode('ascii')
+
+    def file_size(self, variant, post_id, ext):
+        self.image(variant, 0, ext)
+        return len(self.images[(ext, self.variant_size(variant))]) + len(str(post_id))
+
+    def md5(self, post_id):
+        if post_id not in self.md5s:
+            # 同一张底图只哈希一次，每个帖子只追加自己的 id
+            ext = self.file_ext(post_id)
+            key = (ext, self.image_size)
+            if key not in self.hashes:
+                self.image('original', 0, ext)
+                self.hashes[key] = hashlib.md5(self.images[key])
+            digest = self.hashes[key].copy()
+            digest.update(str(post_id).encode('ascii'))
+            self.md5s[post_id] = digest.hexdigest()
+        return self.md5s[post_id]
+
+    def image_url(self, variant, post_id, ext):
+        return f'http://{CDN_HOST}:{self.port}/data/{variant}/{post_id}.{ext}'
+
+    def danbooru_post(self, post_id):
+        ext = self.file_ext(post_id)
+        variants = []
+        for variant, variant_ext in (('original', ext), ('720x720', 'webp'), ('sample', 'jpg'), ('preview', 'jpg')):
+            width, height = self.variant_size(variant)
+            variants.append({'type': variant, 'url': self.image_url(variant, post_id, variant_ext), 'file_ext': variant_ext, 'width': width, 'height': height})
+        return {'id': post_id, 'md5': self.md5(post_id), 'file_ext': ext, 'rating': 's', 'score': post_id % 100,
+                'tag_string': ' '.join(self.post_tags(post_id) + ['1girl', 'solo']),
+                'tag_string_character': ' '.join(self.post_tags(post_id)), 'tag_string_general': '1girl solo',
+                'file_size': self.file_size('original', post_id, ext),
+                'file_url': variants[0]['url'], 'media_asset': {'variants': variants}}
+
+    def moebooru_post(self, post_id):
+        ext = self.file_ext(post_id)
+        return {'id': post_id, 'md5': self.md5(post_id), 'file_ext': ext, 'rating': 's',
+                'tags': ' '.join(self.post_tags(post_id) + ['1girl', 'solo']),
+                'file_url': self.image_url('original', post_id, ext),
+                'width': self.image_size[0], 'height': self.image_size[1], 'file_size': self.file_size('original', post_id, ext),
+                'sample_url': self.image_url('sample', post_id, 'jpg'),
+                'sample_width': self.variant_size('sample')[0], 'sample_height': self.variant_size('sample')[1],
+                'sample_file_size': self.file_size('sample', post_id, 'jpg'),
+                'preview_url': self.image_url('preview', post_id, 'jpg')}
+
+    def listing(self, path, params):
+        terms = params.get('tags', '').split()
+        ors = [term[1:] for term in terms if term.startswith('~')]
+        plain = [term for term in terms if not term.startswith(('~', 'id:', 'order:'))]
+        ids = {post_id for tag in (ors or plain[:1]) for post_id in self.tag_ids(tag)}
+        for term in terms:
+            if term.startswith('id:<'):
+                ids = {i for i in ids if i < int(term[4:])}
+            elif term.startswith('id:>'):
+                ids = {i for i in ids if i > int(term[4:])}
+        ids = sorted(ids, reverse=True)
+        limit = int(params.get('limit', 20))
+        page = params.get('page', '1')
+        if page.startswith('b'):
+            ids = [i for i in ids if i < int(page[1:])][:limit]
+        elif page.startswith('a'):
+            ids = [i for i in ids if i > int(page[1:])][-limit:]
+        else:
+            ids = ids[(int(page) - 1) * limit:int(page) * limit]
+        post = self.danbooru_post if path == '/posts.json' else self.moebooru_post
+        return [post(i) for i in ids]
+
+    # ---- HTTP ----
+
+    def route(self, path, params):
+        """返回 (状态码, Content-Type, 响应体, 是否为图片)。"""
+        if path in ('/posts.json', '/post.json'):
+            return 200, 'application/json', json.dumps(self.listing(path, params)).encode('utf-8'), False
+        if path == '/tags.json':
+            names = params.get('search[name_comma]', '').split(',')
+            tags = [{'name': name, 'post_count': len(self.tag_ids(name))} for name in names if name in self.tags]
+            return 200, 'application/json', json.dumps(tags).encode('utf-8'), False
+        if path == '/tag_aliases.json':
+            return 200, 'application/json', b'[]', False
+        if path.startswith('/data/'):
+            _, _, variant, name = path.split('/')
+            post_id, ext = name.split('.')
+            content_type = 'image/jpeg' if ext == 'jpg' else f'image/{ext}'
+            return 200, content_type, self.image(variant, int(post_id), ext), True
+        return 404, 'text/plain', b'not found', False
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                request_headers = {}
+                while (line := (await reader.readline()).strip()):
+                    key, _, value = line.decode('latin-1').partition(':')
+                    request_headers[key.strip().lower()] = value.strip()
+                target = request.decode('latin-1').split()[1]
+                url = urlsplit(target)
+                status, content_type, body, is_image = self.route(url.path, dict(parse_qsl(url.query)))
+                self.requests['cdn' if is_image else 'api'] += 1
+                await asyncio.sleep(self.cdn_latency if is_image else self.api_latency)
+                headers = {}
+                if self.random.random() < self.throttle_rate:
+                    self.requests['throttled'] += 1
+                    status, content_type, body, is_image = 429, 'text/plain', b'', False
+                    headers['Retry-After'] = str(self.retry_after)
+                if is_image and self.ranges:
+                    headers['Accept-Ranges'] = 'bytes'
+                    range_match = re.match(r'bytes=(\d+)-$', request_headers.get('range', ''))
+                    if range_match:
+                        start = int(range_match.group(1))
+                        self.requests['resumed'] += 1
+                        if start >= len(body):
+                            headers['Content-Range'] = f'bytes */{len(body)}'
+                            status, body = 416, b''
+                        else:
+                            status = 206
+                            headers['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+                            body = body[start:]
+                if is_image and status == 200 and self.random.random() < self.corrupt_rate:
+                    # 传输本身完整，客户端只能通过 md5 或图片结构发现
+                    self.requests['corrupted'] += 1
+                    body = body[:len(body) // 2]
+                truncate = is_image and status in (200, 206) and self.random.random() < self.truncate_rate
+                self.requests['bytes'] += len(body) // 2 if truncate else len(body)
+                reason = {200: 'OK', 206: 'Partial Content', 404: 'Not Found', 416: 'Range Not Satisfiable', 429: 'Too Many Requests'}[status]
+                head = [f'HTTP/1.1 {status} {reason}', f'Content-Type: {content_type}', f'Content-Length: {len(body)}']
+                head += [f'{k}: {v}' for k, v in headers.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+                if truncate:
+                    # 声明完整长度，只发送一半后断开连接
+                    self.requests['truncated'] += 1
+                    writer.write(body[:len(body) // 2])
+                    await writer.drain()
+                    break
+                writer.write(body)
+                await writer.drain()
+        except (ConnectionError, IndexError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+
+class MockProxies:
+    """本地的 HTTP 正向代理，作为代理池的测试出口，和 MockBooru 一样在后台线程里运行。
+
+    每个代理的响应体按 bandwidth（字节/秒）限速，模拟单个出口的带宽上限；dead 个地址不接受连接，模拟失效的代理。
+    """
+
+    def __init__(self, count=1, bandwidth=None, dead=0):
+        self.count = count
+        self.bandwidth = bandwidth
+        self.dead = dead
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.urls = []
+        self.requests = [0] * count
+        # 各代理的链路在什么时候空闲，响应体排队发送
+        self.link_free = [0.0] * count
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            for index in range(self.count):
+                server = self.loop.run_until_complete(asyncio.start_server(lambda r, w, i=index: self._serve(i, r, w), API_HOST, 0))
+                self.urls.append(f'http://{API_HOST}:{server.sockets[0].getsockname()[1]}')
+            for _ in range(self.dead):
+                # 绑定后立即关闭，得到一个拒绝连接的端口
+                server = self.loop.run_until_complete(asyncio.start_server(lambda r, w: None, API_HOST, 0))
+                port = server.sockets[0].getsockname()[1]
+                server.close()
+                self.urls.append(f'http://{API_HOST}:{port}')
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name='mock-proxies', daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _send(self, index, writer, data):
+        if self.bandwidth:
+            now = time.monotonic()
+            self.link_free[index] = max(now, self.link_free[index]) + len(data) / self.bandwidth
+            await asyncio.sleep(self.link_free[index] - now)
+        writer.write(data)
+        await writer.drain()
+
+    async def _serve(self, index, reader, writer):
+        # 每个客户端连接对应一个上游连接，两边都保持长连接；请求行从 http://host:port/path 改写成 /path
+        upstream = None
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                method, target, version = request.decode('latin-1').split()
+                head = []
+                while (line := await reader.readline()).strip():
+                    if not line.lower().startswith(b'proxy-'):
+                        head.append(line)
+                url = urlsplit(target)
+                if upstream is None:
+                    upstream = await asyncio.open_connection(url.hostname, url.port)
+                up_reader, up_writer = upstream
+                path = url.path + (f'?{url.query}' if url.query else '')
+                up_writer.write(f'{method} {path} {version}\r\n'.encode('latin-1') + b''.join(head) + b'\r\n')
+                await up_writer.drain()
+                self.requests[index] += 1
+                status = await up_reader.readline()
+                response_head = [status]
+                length = 0
+                while (line := await up_reader.readline()).strip():
+                    response_head.append(line)
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                writer.write(b''.join(response_head) + b'\r\n')
+                while length:
+                    # 上游断开（被截断的响应体）时抛出 IncompleteReadError，同样断开客户端
+                    chunk = await up_reader.readexactly(min(length, 64 * 1024))
+                    length -= len(chunk)
+                    await self._send(index, writer, chunk)
+                await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if upstream is not None:
+                upstream[1].close()
+            writer.close()
+
+async def monitor_lag(samples, interval=0.05):
+    # 事件循环延迟：定时器应当在 interval 后醒来，实际多等的时间说明循环被同步代码阻塞了
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 在 exec 之后仍保留父进程的峰值，优先读取本进程自己的 VmHWM
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return round(peak / (1024 * 1024 if os.uname().sysname == 'Darwin' else 1024), 1)
+
+
+def run_scenario(config, worker=None, work_dir=None):
+    """在单独的进程里跑一次真实的抓取流程（process_line / download_image / sink），返回计时和指标。
+
+    worker 不为 None 时作为多个 worker 进程之一，和其他 worker 在 work_dir 里共用工作队列和清单。
+    """
+    if worker is not None:
+        return asyncio.run(_run_scenario(config, work_dir, worker))
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        return asyncio.run(_run_scenario(config, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def _run_scenario(config, work_dir, worker=None):
+    txt_path = os.path.join(work_dir, f'tags-{worker}.txt' if worker is not None else 'tags.txt')
+    with open(txt_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(config['tags']) + '\n')
+
+    policy = make_policy(config['min_side'], config['max_file_bytes'], config['prefer_ext'])
+    if config['site'] == 'yandere':
+        source = MoebooruSource(config['api_url'], headers=None, policy=policy)
+    else:
+        source = DanbooruSource(config['api_url'], variants=PREVIEW_VARIANTS if config['sink'] == 'archive' else ('original',), policy=policy)
+    output = os.path.join(work_dir, 'out')
+    zip_path, csv_path = os.path.join(work_dir, 'images.zip'), os.path.join(work_dir, 'train.csv')
+    if worker is not None:
+        output = worker_dir(output, worker)
+        zip_path, csv_path = worker_file(zip_path, worker), worker_file(csv_path, worker)
+    if config['sink'] == 'archive':
+        sink = ArchiveSink(zip_path, csv_path)
+    elif config['sink'] == 'webdataset':
+        sink = ShardSink(output)
+    else:
+        sink = FolderSink(output, config['metadata'])
+    crawl = Crawl(source, sink, txt_path, max_images=config['max_images'], page_fetchers=config['page_fetchers'],
+                  download_workers=config['download_workers'], api_concurrency=config['api_concurrency'],
+                  cdn_concurrency=config['cdn_concurrency'], api_rate=config['api_rate'], cdn_rate=config['cdn_rate'],
+                  listing_cache_path=os.path.join(work_dir, 'listing_cache.db'), cache_ttl=None,
+                  or_group_size=config['or_group_size'], buckets=Buckets(config['bucket_resolution']) if config['bucket_resolution'] else None,
+                  byte_budget=config['byte_budget'], work_queue=os.path.join(work_dir, 'work_queue.db') if worker is not None else None,
+                  worker_id=str(worker) if worker is not None else None, proxy_pool=config.get('proxy_pool'),
+                  verify=config['verify'], quarantine_dir=os.path.join(work_dir, 'quarantine'))
+    engine = CrawlEngine(os.path.join(work_dir, 'manifest.db'), config['convert_workers'], dedupe=config['dedupe'], log_level='warning')
+
+    lag = []
+    monitor = asyncio.create_task(monitor_lag(lag))
+    start = time.monotonic()
+    await engine.run([crawl])
+    elapsed = time.monotonic() - start
+    monitor.cancel()
+
+    def total(name):
+        return sum(value for (key, _), value in metrics.counters.items() if key == name)
+
+    lag.sort()
+    return {
+        'seconds': round(elapsed, 3),
+        'downloads': total('downloads_total'),
+        'linked': total('linked_total'),
+        'bytes': total('download_bytes_total'),
+        'retries': total('retries_total'),
+        'corrupt': total('corrupt_total'),
+        'peak_rss_mb': peak_rss_mb(),
+        'lag_max_ms': round(lag[-1] * 1000, 1) if lag else None,
+        'lag_p99_ms': round(lag[int(len(lag) * 0.99)] * 1000, 1) if lag else None,
+    }
+
+
+# 默认场景，每个场景只写与 DEFAULTS 不同的设置
+DEFAULTS = {
+    'site': 'danbooru', 'sink': 'folder', 'tags': [f'tag_{i}' for i in range(8)], 'posts_per_tag': 200, 'shared_posts': 0,
+    'max_images': 100, 'formats': ('jpg', 'png'), 'image_size': (1024, 768),
+    'api_latency': 0.02, 'cdn_latency': 0.01, 'throttle_rate': 0.0, 'retry_after': 1, 'truncate_rate': 0.0, 'ranges': True,
+    'page_fetchers': 4, 'download_workers': 8, 'api_concurrency': 2, 'cdn_concurrency': 8,
+    'api_rate': 1000.0, 'cdn_rate': 1000.0, 'convert_workers': None, 'dedupe': 'link', 'or_group_size': 1,
+    'bucket_resolution': None, 'min_side': None, 'max_file_bytes': None, 'prefer_ext': (), 'byte_budget': None, 'workers': 1,
+    'proxies': 0, 'proxy_bandwidth': None, 'dead_proxies': 0, 'corrupt_rate': 0.0, 'verify': True, 'metadata': 'txt',
+    # 下载 + 引用的图片数应为多少，不一致时打印警告；None 不检查
+    'expect_images': None,
+}
+SCENARIOS = {
+    'folder': {},
+    'webp': {'formats': ('webp',)},
+    'webdataset': {'sink': 'webdataset'},
+    'archive': {'sink': 'archive'},
+    'yandere': {'site': 'yandere'},
+    'dedupe': {'shared_posts': 150},
+    # 几个小tag共享一半的帖子并合并成 OR 查询：共享的帖子同时被多个tag处理，每个tag都应得到全部 10 张（下载 25 张，引用 15 张）
+    'dedupe-shared': {'tags': [f'tag_{i}' for i in range(4)], 'posts_per_tag': 10, 'shared_posts': 5, 'or_group_size': 2, 'expect_images': 40},
+    'slow-api': {'api_latency': 0.3, 'cdn_latency': 0.05},
+    'throttled': {'throttle_rate': 0.05, 'api_rate': 20.0, 'cdn_rate': 50.0},
+    'truncated': {'truncate_rate': 0.05},
+    'truncated-large': {'truncate_rate': 0.3, 'image_size': (3000, 2000)},
+    'truncated-no-range': {'truncate_rate': 0.3, 'image_size': (3000, 2000), 'ranges': False},
+    # 5% 的图片内容损坏：原图由 md5 发现，archive 下载的缩略图没有 md5，由图片结构检查发现；verify-off 比较结构检查的开销
+    'corrupt': {'corrupt_rate': 0.05},
+    'corrupt-archive': {'corrupt_rate': 0.05, 'sink': 'archive'},
+    'verify-off': {'verify': False},
+    # 大量小图，标注和元数据的写入占比大：同名 txt 和每个tag一个 metadata.jsonl
+    'many-small': {'tags': [f'tag_{i}' for i in range(16)], 'max_images': 200, 'image_size': (64, 48), 'formats': ('jpg',), 'page_fetchers': 8},
+    'many-small-jsonl': {'tags': [f'tag_{i}' for i in range(16)], 'max_images': 200, 'image_size': (64, 48), 'formats': ('jpg',), 'page_fetchers': 8, 'metadata': 'jsonl'},
+    'buckets': {'image_size': (3000, 2000), 'bucket_resolution': 512},
+    'min-side': {'image_size': (3000, 2000), 'min_side': 720},
+    'budget': {'byte_budget': 20 * 1024 ** 2},
+    'small-tags': {'tags': [f'tag_{i}' for i in range(40)], 'posts_per_tag': 10, 'or_group_size': 2},
+    # 多个 worker 进程从同一个工作队列租约标签行，和 workers-1 比较扩展性；
+    # 小图 + 高延迟，单个 worker 受并发数和延迟限制，而不是假图站本身的带宽
+    'workers-1': {'tags': [f'tag_{i}' for i in range(16)], 'max_images': 100, 'image_size': (256, 192), 'api_latency': 0.2, 'cdn_latency': 0.2},
+    'workers-4': {'tags': [f'tag_{i}' for i in range(16)], 'max_images': 100, 'image_size': (256, 192), 'api_latency': 0.2, 'cdn_latency': 0.2, 'workers': 4},
+    # 经本地代理下载，每个代理限速 4 MB/秒，比较代理池的吞吐量是否随出口数量增加；proxies-dead 另有一个拒绝连接的代理
+    'proxies-1': {'max_images': 50, 'image_size': (512, 384), 'proxies': 1, 'proxy_bandwidth': 4 * 1024 ** 2},
+    'proxies-4': {'max_images': 50, 'image_size': (512, 384), 'proxies': 4, 'proxy_bandwidth': 4 * 1024 ** 2, 'download_workers': 32},
+    'proxies-dead': {'max_images': 50, 'image_size': (512, 384), 'proxies': 4, 'proxy_bandwidth': 4 * 1024 ** 2, 'download_workers': 32, 'dead_proxies': 1},
+}
+
+
+def run_workers(config, context):
+    # 同时启动 workers 个进程，各自的结果合计：数量相加，内存和事件循环延迟取最大值；
+    # 空闲的 worker 会等到其他 worker 的租约全部结束才退出，完成最后一行的 worker 最先退出，所以耗时取最小值
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        with ProcessPoolExecutor(max_workers=config['workers'], mp_context=context) as executor:
+            futures = [executor.submit(run_scenario, config, worker, work_dir) for worker in range(config['workers'])]
+            results = [future.result() for future in futures]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    merged = {key: sum(result[key] for result in results) for key in ('downloads', 'linked', 'bytes', 'retries', 'corrupt')}
+    merged['seconds'] = min(result['seconds'] for result in results)
+    for key in ('peak_rss_mb', 'lag_max_ms', 'lag_p99_ms'):
+        values = [result[key] for result in results if result[key] is not None]
+        merged[key] = max(values) if values else None
+    return merged
+
+
+def benchmark(names=None, overrides=None, results_path=None, repeat=1):
+    """依次运行 SCENARIOS 中的场景（names 为 None 时全部运行），打印结果，results_path 不为 None 时追加 JSON 行。
+
+    每个场景在新进程里运行，峰值内存互不影响；假图站在本进程的后台线程里运行。
+    """
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with MockBooru() as server:
+        for name in names or SCENARIOS:
+            config = {**DEFAULTS, **SCENARIOS[name], **(overrides or {})}
+            server.configure(config['tags'], config['posts_per_tag'], config['shared_posts'], config['formats'], config['image_size'],
+                             config['api_latency'], config['cdn_latency'], config['throttle_rate'], config['retry_after'], config['truncate_rate'], config['ranges'], corrupt_rate=config['corrupt_rate'])
+            server.prepare()
+            config['api_url'] = server.api_url
+            for run in range(repeat):
+                server.reset()
+                with MockProxies(config['proxies'], config['proxy_bandwidth'], config['dead_proxies']) if config['proxies'] else nullcontext() as proxies:
+                    config['proxy_pool'] = proxies.urls if proxies else None
+                    if config['workers'] > 1:
+                        result = run_workers(config, context)
+                    else:
+                        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                            result = executor.submit(run_scenario, config).result()
+                if proxies:
+                    result['proxy_requests'] = proxies.requests
+                images = result['downloads'] + result['linked']
+                requests = server.requests['api'] + server.requests['cdn']
+                result.update({
+                    'scenario': name,
+                    'run': run + 1,
+                    'images': images,
+                    'images_per_sec': round(images / result['seconds'], 1) if result['seconds'] else None,
+                    'requests_per_image': round(requests / images, 2) if images else None,
+                    'mb_per_sec': round(result['bytes'] / 1024 ** 2 / result['seconds'], 1) if result['seconds'] else None,
+                    # 服务器实际发出的字节（包括失败、被截断的传输），除以图片数
+                    'sent_mb_per_image': round(server.requests['bytes'] / 1024 ** 2 / images, 2) if images else None,
+                    'server': dict(server.requests),
+                })
+                results.append(result)
+                print(f"{name:<18} 图片 {images:>5}  {result['images_per_sec']:>7} 张/秒  {result['mb_per_sec']:>6} MB/秒  "
+                      f"请求/图片 {result['requests_per_image']}  传输 {result['sent_mb_per_image']} MB/图片  重试 {result['retries']}  峰值内存 {result['peak_rss_mb']} MB  "
+                      f"事件循环延迟 p99/最大 {result['lag_p99_ms']}/{result['lag_max_ms']} ms")
+                if config['expect_images'] is not None and images != config['expect_images']:
+                    print(f"警告: {name} 得到 {images} 张图片，应为 {config['expect_images']} 张")
+                if results_path:
+                    with open(results_path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(dict(result, time=time.time(), config={k: v for k, v in config.items() if k not in ('api_url', 'proxy_pool')}), ensure_ascii=False) + '\n')
+    return results
+
+
+if __name__ == "__main__":
+    names = None # 要运行的场景，None 为 SCENARIOS 中的全部，例如 ['folder', 'webp']
+    overrides = {} # 覆盖所有场景的设置，例如 {'download_workers': 16, 'image_size': (2048, 1536)}
+    results_path = "benchmark_results.jsonl" # 结果追加到这个文件，便于和之前的结果比较；None 不保存
+    repeat = 1 # 每个场景重复的次数
+
+    benchmark(names, overrides, results_path, repeat)
@@ -0,0 +1,67 @@
+import io
+import math
+
+from PIL import Image
+
+
+def make_buckets(resolution=1024, step=64, max_ratio=2.0):
+    """面积不超过 resolution² 的宽高比分桶，边长是 step 的倍数，长边/短边不超过 max_ratio。"""
+    sizes = set()
+    width = step
+    while width <= resolution * max_ratio:
+        height = resolution * resolution // width // step * step
+        if height >= step and max(width, height) / min(width, height) <= max_ratio:
+            sizes.add((width, height))
+        width += step
+    return tuple(sorted(sizes))
+
+
+def closest_bucket(width, height, sizes):
+    # 按宽高比的对数距离选分桶，横图和竖图对称
+    ratio = math.log(width / height)
+    return min(sizes, key=lambda size: abs(math.log(size[0] / size[1]) - ratio))
+
+
+def resize_to_bucket(data, sizes, quality=95):
+    """在子进程中运行：缩放到最接近的分桶（先等比缩放到覆盖分桶，再居中裁剪），返回 (JPEG 字节, (宽, 高))。
+
+    JPEG 用 draft() 在解码时直接按 1/2、1/4、1/8 缩小，大图不需要完整解码。
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        bucket = closest_bucket(img.width, img.height, sizes)
+        scale = max(bucket[0] / img.width, bucket[1] / img.height)
+        img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        scale = max(bucket[0] / img.width, bucket[1] / img.height)
+        size = (max(bucket[0], round(img.width * scale)), max(bucket[1], round(img.height * scale)))
+        img = img.resize(size, Image.LANCZOS)
+        left = (size[0] - bucket[0]) // 2
+        top = (size[1] - bucket[1]) // 2
+        img = img.crop((left, top, left + bucket[0], top + bucket[1]))
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=quality)
+    return out.getvalue(), bucket
+
+
+def image_size(path):
+    # 只读文件头
+    with Image.open(path) as img:
+        return img.size
+
+
+class Buckets:
+    """训练用的宽高比分桶设置：下载时在进程池里缩放裁剪到分桶尺寸，只保存训练用的分辨率。
+
+    required() 给出覆盖目标分桶所需的变体尺寸，由 sources.VariantPolicy 选出满足它的最小变体，少下载字节。
+    """
+
+    def __init__(self, resolution=1024, step=64, max_ratio=2.0):
+        self.resolution = resolution
+        self.sizes = make_buckets(resolution, step, max_ratio)
+
+    def required(self, width, height):
+        """原图为 width x height 时，变体至少需要的 (宽, 高)：等比缩放后能覆盖所属分桶。"""
+        bucket = closest_bucket(width, height, self.sizes)
+        scale = max(bucket[0] / width, bucket[1] / height)
+        return width * scale, height * scale
@@ -0,0 +1,51 @@
+import importlib.util
+
+import httpx
+
+from metrics import log
+
+# 连接复用：空闲连接保留的秒数，减少重复 TLS 握手
+KEEPALIVE_EXPIRY = 30.0
+
+
+def api_timeout(read=30.0):
+    # API 返回的是小 JSON，读超时不需要太长；等待连接池的时间短一些，失败后由重试处理
+    return httpx.Timeout(connect=10.0, read=read, write=10.0, pool=10.0)
+
+
+def cdn_timeout(read=60.0):
+    # read 是两次收到数据之间的最长间隔，不是整张图的下载时间，卡住的传输会在这个时间后失败
+    return httpx.Timeout(connect=10.0, read=read, write=10.0, pool=60.0)
+
+
+def http2_available():
+    return importlib.util.find_spec('h2') is not None
+
+
+def create_clients(proxies=None, headers=None, api_connections=2, cdn_connections=8, http2=False, api_read_timeout=30.0, cdn_read_timeout=60.0, pool=None):
+    """返回 (api_session, cdn_session) 两个独立的 AsyncClient。
+
+    API 请求和图片下载使用各自的连接池和超时，卡住的大文件传输不会占用翻页请求的连接。
+    http2=True 时在同一连接上多路复用请求（需要安装 h2：pip install httpx[http2]）。
+    给出代理池 pool（proxypool.ProxyPool）时忽略 proxies，每个代理各有 api_connections / cdn_connections 个连接。
+    """
+    if http2 and not http2_available():
+        log.warning("未安装 h2，HTTP/2 已关闭（pip install httpx[http2]）")
+        http2 = False
+    api_session = httpx.AsyncClient(
+        timeout=api_timeout(api_read_timeout),
+        limits=httpx.Limits(max_connections=api_connections, max_keepalive_connections=api_connections, keepalive_expiry=KEEPALIVE_EXPIRY),
+        proxies=proxies if pool is None else None,
+        transport=pool.transport(api_connections, http2, KEEPALIVE_EXPIRY) if pool is not None else None,
+        headers=headers,
+        http2=http2,
+    )
+    cdn_session = httpx.AsyncClient(
+        timeout=cdn_timeout(cdn_read_timeout),
+        limits=httpx.Limits(max_connections=cdn_connections, max_keepalive_connections=cdn_connections, keepalive_expiry=KEEPALIVE_EXPIRY),
+        proxies=proxies if pool is None else None,
+        transport=pool.transport(cdn_connections, http2, KEEPALIVE_EXPIRY) if pool is not None else None,
+        headers=headers,
+        http2=http2,
+    )
+    return api_session, cdn_session
@@ -0,0 +1,78 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from PIL import Image
+
+from buckets import resize_to_bucket
+
+JPEG_QUALITY = 95
+# JPEG 结束标记（EOI）在文件末尾这么多字节内，之后可能还有填充
+JPEG_TAIL = 1024
+
+
+def to_jpeg_bytes(data, quality=JPEG_QUALITY):
+    # 在子进程中运行：从内存解码，重新编码为 JPEG 并返回字节
+    with Image.open(io.BytesIO(data)) as img:
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+
+def verify_image(image):
+    """在工作线程中运行：image 为文件路径或字节，只检查文件头和结构（Pillow verify，不解码像素），
+    JPEG 另外检查结束标记，被截断或损坏时抛出异常。"""
+    source = io.BytesIO(image) if isinstance(image, bytes) else image
+    with Image.open(source) as img:
+        image_format = img.format
+        img.verify()
+    if image_format == 'JPEG':
+        if isinstance(image, bytes):
+            tail = image[-JPEG_TAIL:]
+        else:
+            with open(image, 'rb') as f:
+                f.seek(max(0, os.path.getsize(image) - JPEG_TAIL))
+                tail = f.read()
+        if b'\xff\xd9' not in tail:
+            raise IOError("JPEG 缺少结束标记，文件被截断")
+    return image_format
+
+
+class ImageConverter:
+    """图片转换阶段，所有 CPU 密集的解码/编码都在进程池里完成，不阻塞事件循环。
+
+    run(func, *args) 可以提交任意可 pickle 的模块级函数，供以后的图片处理复用。
+    """
+
+    def __init__(self, workers=None, quality=JPEG_QUALITY):
+        self.workers = workers or os.cpu_count() or 1
+        self.quality = quality
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def to_jpeg(self, data):
+        return await self.run(to_jpeg_bytes, data, self.quality)
+
+    async def verify(self, image):
+        # 结构检查不解码像素，主要是读文件和 zlib 的 CRC（都会释放 GIL），放在线程池里，不占用转换进程也不用传输字节
+        return await asyncio.get_running_loop().run_in_executor(None, verify_image, image)
+
+    async def to_bucket(self, data, buckets):
+        # 返回 (JPEG 字节, 分桶尺寸)
+        return await self.run(resize_to_bucket, data, buckets.sizes, self.quality)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
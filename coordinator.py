@@ -0,0 +1,46 @@
+import asyncio
+from engine import read_lines
+from metrics import log, setup_logging
+from workqueue import WorkQueue, QueueServer
+
+async def main(txt_path, queue_path='work_queue.db', sites=('danbooru',), start_line=1, serve=False, host='127.0.0.1', port=8765, max_attempts=3, report_interval=60.0, log_level='info', requeue=False):
+    setup_logging(log_level)
+    lines = await read_lines(txt_path, start_line)
+    if lines is None:
+        return
+    # 每个站点一个队列，已在队列里的行保持原状态，可以重复运行来追加新的行
+    for site in sites:
+        queue = WorkQueue(queue_path, site, max_attempts)
+        if requeue:
+            log.info(f"[{site}] 已把 {await queue.requeue()} 个处理过的标签行放回队列")
+        log.info(f"[{site}] 已向工作队列加入 {await queue.load(lines)} 个标签行，当前进度: {await queue.progress()}")
+        await queue.close()
+    if not serve:
+        return
+    async with QueueServer(queue_path, host, port, max_attempts) as server:
+        while True:
+            await asyncio.sleep(report_interval)
+            unfinished = 0
+            for site in sites:
+                queue = server.queue(site)
+                log.info(f"[{site}] 工作队列进度: {await queue.progress()}")
+                unfinished += await queue.unfinished()
+            if not unfinished:
+                log.info("所有标签行都已处理完")
+                break
+
+if __name__ == "__main__":
+    # 分布式抓取的协调端：把标签行装入工作队列，各 worker 在 for_lora_train.py / yandere.py / single_tag_crawler.py / multi_crawler.py 里设置 work_queue 后启动
+    txt_path = "artist_full.txt" # 每行一个tag
+    queue_path = "work_queue.db" # 工作队列的SQLite文件，同一台机器上的 worker 把 work_queue 设为这个路径即可，不需要 serve
+    sites = ("danbooru",) # 要装入的站点队列，和各脚本的站点名一致: 'danbooru'、'yandere'
+    start_line = 1
+    serve = False # True 时在 host:port 提供协调服务，其他机器上的 worker 把 work_queue 设为 "http://<本机地址>:<port>"
+    host = "127.0.0.1" # 多台机器时改为 "0.0.0.0"，协调服务没有认证，只在内网使用
+    port = 8765
+    max_attempts = 3 # 协调服务下一个标签行最多分配几次（失败或租约过期都算一次），之后记为 failed；worker 直接共用队列文件时为 3
+    report_interval = 60 # 协调服务每隔多少秒输出一次进度，所有行处理完后退出
+    log_level = "info"
+    requeue = False # 定期增量抓取: True 时把上次已完成的行重新放回队列，worker 设置 refresh_after 后每个tag只请求新帖子
+
+    asyncio.run(main(txt_path, queue_path, sites, start_line, serve, host, port, max_attempts, report_interval, log_level, requeue))
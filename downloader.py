@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from urllib.parse import urlsplit
+
+import aiofiles
+
+# 流式下载的分块大小，峰值内存只与分块大小和并发数有关，与图片大小无关
+CHUNK_SIZE = 256 * 1024
+# 隔离非图片响应（错误页）时最多保留的字节数
+ERROR_PAGE_BYTES = 64 * 1024
+# 图片文件的扩展名；动图 zip（ugoira）、视频等其他文件不下载
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.avif')
+# 这些 Content-Type 不说明内容是什么，按 URL 的扩展名判断
+GENERIC_TYPES = ('', 'application/octet-stream', 'binary/octet-stream')
+
+
+class SkipDownload(Exception):
+    """响应头表明内容不需要下载（视频、空文件、超出大小限制等），无需重试"""
+
+
+class NotImage(SkipDownload):
+    """内容确实不是能用的图片（zip、视频等，或完整且 md5 一致却无法解析），重新下载也一样，调用方记入清单"""
+
+
+class DownloadFailed(Exception):
+    """重试次数用尽仍未下载成功"""
+
+
+class CorruptDownload(IOError):
+    """内容校验失败（md5 与 API 不一致或图片结构损坏），需要重新下载。
+
+    image 是校验失败的内容：文件路径（流式下载的 .part 或已保存的文件）或字节，由调用方隔离或删除。
+    """
+
+    def __init__(self, message, image=None, reason='md5'):
+        super().__init__(message)
+        self.image = image
+        self.reason = reason
+
+
+def part_path(filename):
+    return filename.with_name(filename.name + '.part')
+
+
+def is_image_url(url):
+    # 没有扩展名的 URL 交给响应头判断
+    ext = os.path.splitext(urlsplit(url).path)[1].lower()
+    return not ext or ext in IMAGE_EXTENSIONS
+
+
+def check_headers(response, max_bytes=None):
+    # 在读取响应体之前根据响应头判断是否值得下载
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type.startswith('text/') or 'json' in content_type:
+        # 通常是 CDN 临时返回的错误页，和校验失败一样隔离后重试
+        raise CorruptDownload(f"非图片内容 ({content_type})", reason='content_type')
+    if not content_type.startswith('image/') and not (content_type in GENERIC_TYPES and is_image_url(str(response.url))):
+        raise NotImage(f"不是图片 ({content_type or '没有 Content-Type'})")
+    content_length = response.headers.get('Content-Length')
+    expected = int(content_length) if content_length and content_length.isdigit() else None
+    if expected == 0:
+        raise SkipDownload("空文件")
+    if max_bytes is not None and expected is not None and expected > max_bytes:
+        raise SkipDownload(f"文件过大 ({expected} > {max_bytes} 字节)")
+    return expected
+
+
+def content_range(response, offset):
+    """解析 206 响应的 Content-Range，返回文件总长度（未知为 None）；起点与请求的不一致时抛出 IOError。"""
+    match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', response.headers.get('Content-Range', ''))
+    if not match or int(match.group(1)) != offset:
+        raise IOError(f"Content-Range 与请求不一致: {response.headers.get('Content-Range')}")
+    return int(match.group(3)) if match.group(3) != '*' else None
+
+
+def begin_body(response, offset, max_bytes=None):
+    """检查响应头，返回 (写入起点, 文件总长度, 失败后能否续传)。
+
+    206 时从 offset 继续写；200 说明服务器忽略了 Range，从头写。
+    """
+    encoded = response.headers.get('Content-Encoding', 'identity') != 'identity'
+    if response.status_code == 206 and offset:
+        check_headers(response)
+        total = content_range(response, offset)
+        if max_bytes is not None and total is not None and total > max_bytes:
+            raise SkipDownload(f"文件过大 ({total} > {max_bytes} 字节)")
+        return offset, total, not encoded
+    expected = check_headers(response, max_bytes)
+    # 压缩传输时字节偏移对应的是压缩后的数据，不能续传
+    resumable = response.headers.get('Accept-Ranges', '').lower() == 'bytes' and not encoded
+    return 0, expected, resumable
+
+
+async def read_head(response, limit=ERROR_PAGE_BYTES):
+    # 非图片响应（错误页）只读取开头一部分用于隔离
+    data = bytearray()
+    async for chunk in response.aiter_bytes():
+        data.extend(chunk)
+        if len(data) >= limit:
+            break
+    return bytes(data[:limit])
+
+
+def range_headers(offset):
+    return {'Range': f'bytes={offset}-'} if offset else None
+
+
+async def stream_download(session, url, filename, chunk_size=CHUNK_SIZE, max_bytes=None, md5=None):
+    """把 url 分块写入 filename.part，完整后原子重命名为 filename。
+
+    服务器支持 Range（Accept-Ranges: bytes）时，传输中断的 .part 会保留下来，下次（包括进程重启后）
+    从已有的字节继续请求；完成时校验总长度，给出 md5 时还校验内容，不一致则删除 .part 从头下载。
+    返回响应状态码，只有返回 200 时 filename 才存在。
+    """
+    tmp_filename = part_path(filename)
+    offset = tmp_filename.stat().st_size if tmp_filename.exists() else 0
+    async with session.stream('GET', url, headers=range_headers(offset)) as response:
+        if response.status_code == 416 and offset:
+            # 已有的 .part 与服务器上的文件对不上，丢弃后重试
+            os.remove(tmp_filename)
+            raise IOError(f"续传位置无效 ({offset} 字节)，从头下载")
+        if response.status_code not in (200, 206):
+            return response.status_code
+        resumable = False
+        try:
+            start, total, resumable = begin_body(response, offset, max_bytes)
+            digest = await file_digest(tmp_filename, start) if md5 else None
+            # 有 Content-Encoding 时 Content-Length 是压缩后的长度，需要解码后写入
+            encoded = response.headers.get('Content-Encoding', 'identity') != 'identity'
+            chunks = response.aiter_bytes(chunk_size) if encoded else response.aiter_raw(chunk_size)
+            async with aiofiles.open(tmp_filename, 'ab' if start else 'wb') as f:
+                async for chunk in chunks:
+                    await f.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+            received = start + response.num_bytes_downloaded
+            if total is not None and received != total:
+                raise IOError(f"下载不完整: {received}/{total} 字节")
+            if digest is not None and digest.hexdigest() != md5:
+                raise CorruptDownload(f"md5 不匹配: {digest.hexdigest()} != {md5}", tmp_filename)
+        except CorruptDownload as e:
+            # 校验失败的 .part 留给调用方隔离；错误页时 .part 里已有的部分不受影响，隔离的是错误页本身
+            if e.image is None:
+                e.image = await read_head(response)
+            raise
+        except BaseException as e:
+            # 可以续传时保留已下载的部分，跳过的文件删除
+            if tmp_filename.exists() and (isinstance(e, SkipDownload) or not resumable):
+                os.remove(tmp_filename)
+            raise
+    os.replace(tmp_filename, filename)
+    return 200
+
+
+async def file_digest(path, length):
+    # 续传时先对已有的前 length 字节计算 md5，后续的分块在写入时追加
+    digest = hashlib.md5()
+    if length:
+        async with aiofiles.open(path, 'rb') as f:
+            remaining = length
+            while remaining:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+    return digest
+
+
+def link_file(source, target):
+    # 同一内容已经在别处下载过：优先硬链接，跨文件系统时退回符号链接，都不支持时复制
+    if os.path.exists(target):
+        return
+    try:
+        os.link(source, target)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+
+async def fetch_bytes(session, url, chunk_size=CHUNK_SIZE, max_bytes=None, buffer=None, md5=None):
+    """与 stream_download 相同的响应头检查和校验，但把响应体读入内存，返回 (状态码, 字节)。
+
+    buffer 为调用方在多次重试之间保留的 bytearray：中断时已收到的部分留在里面，下次用 Range 继续。
+    """
+    buffer = bytearray() if buffer is None else buffer
+    offset = len(buffer)
+    async with session.stream('GET', url, headers=range_headers(offset)) as response:
+        if response.status_code == 416 and offset:
+            buffer.clear()
+            raise IOError(f"续传位置无效 ({offset} 字节)，从头下载")
+        if response.status_code not in (200, 206):
+            return response.status_code, None
+        resumable = False
+        try:
+            start, total, resumable = begin_body(response, offset, max_bytes)
+            del buffer[start:]
+            # 边接收边计算 md5，续传时先算已有的部分
+            digest = hashlib.md5(buffer) if md5 else None
+            async for chunk in response.aiter_bytes(chunk_size):
+                buffer.extend(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+            received = start + response.num_bytes_downloaded
+            if total is not None and received != total:
+                raise IOError(f"下载不完整: {received}/{total} 字节")
+            if digest is not None and digest.hexdigest() != md5:
+                data = bytes(buffer)
+                buffer.clear()
+                raise CorruptDownload(f"md5 不匹配: {digest.hexdigest()} != {md5}", data)
+        except BaseException as e:
+            if isinstance(e, CorruptDownload) and e.image is None:
+                e.image = await read_head(response)
+            if isinstance(e, SkipDownload) or not resumable:
+                buffer.clear()
+            raise
+    data = bytes(buffer)
+    buffer.clear()
+    return 200, data
+
+
+def quarantine(image, quarantine_dir, name, url=None, reason=None):
+    """把校验失败的内容移到 quarantine_dir/name（image 为文件路径时移动，为字节时写入），原因追加到 quarantine.jsonl。
+
+    quarantine_dir 为 None 时直接删除文件。
+    """
+    if quarantine_dir is None:
+        if not isinstance(image, (bytes, bytearray)) and image is not None and os.path.exists(image):
+            os.remove(image)
+        return None
+    os.makedirs(quarantine_dir, exist_ok=True)
+    target = os.path.join(quarantine_dir, name)
+    if isinstance(image, (bytes, bytearray)):
+        with open(target, 'wb') as f:
+            f.write(image)
+    elif image is not None and os.path.exists(image):
+        os.replace(image, target)
+    with open(os.path.join(quarantine_dir, 'quarantine.jsonl'), 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'file': name, 'url': url, 'reason': reason, 'time': time.time()}, ensure_ascii=False) + '\n')
+    return target
+
+
+async def write_atomic(filename, data):
+    tmp_filename = part_path(filename)
+    async with aiofiles.open(tmp_filename, 'wb') as f:
+        await f.write(data)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,590 @@
+import asyncio
+import os
+import time
+from contextlib import nullcontext
+from functools import partial
+
+import aiofiles
+
+from buckets import image_size
+from clients import create_clients
+from converter import ImageConverter
+from downloader import stream_download, fetch_bytes, quarantine, is_image_url, SkipDownload, NotImage, DownloadFailed, CorruptDownload
+from listing_cache import ListingCache, OfflineMiss, fetch_listing
+from manifest import Manifest
+from metrics import metrics, log, setup_logging, MetricsReporter, RATE_BUCKETS
+from pipeline import CrawlPipeline, TagJob
+from planner import plan_jobs, group_jobs
+from proxypool import ProxyPool
+from ratelimit import RateLimiter, retryable, backoff_delay
+from sources import comparison_name, ORIGINAL_VARIANTS
+from workqueue import open_queue, default_worker_id, Heartbeat, POLL_INTERVAL
+
+
+class Crawl:
+    """一个站点的一次抓取：站点适配器 source、写入方式 sink、标签行文件，以及这个站点自己的并发和速率预算。"""
+
+    def __init__(self, source, sink, txt_path, start_line=1, max_images=5, page_fetchers=4, download_workers=8, queue_size=100,
+                 api_concurrency=2, cdn_concurrency=8, api_rate=5.0, cdn_rate=20.0, timeout=60.0, api_timeout=30.0, proxies=None,
+                 http2=False, listing_cache_path='listing_cache.db', cache_ttl=3600, offline=False, plan_ttl=86400,
+                 plan_order='largest', or_group_size=1, buckets=None, byte_budget=None, work_queue=None, worker_id=None,
+                 lease_seconds=300, refresh_after=None, proxy_pool=None, verify=True, quarantine_dir=None):
+        self.source = source
+        self.sink = sink
+        self.txt_path = txt_path
+        self.start_line = start_line
+        self.max_images = max_images
+        self.page_fetchers = page_fetchers
+        self.download_workers = download_workers
+        self.queue_size = queue_size
+        self.api_concurrency = api_concurrency
+        self.cdn_concurrency = cdn_concurrency
+        self.api_rate = api_rate
+        self.cdn_rate = cdn_rate
+        self.timeout = timeout
+        self.api_timeout = api_timeout
+        self.proxies = proxies
+        self.http2 = http2
+        self.listing_cache_path = listing_cache_path
+        self.cache_ttl = cache_ttl
+        self.offline = offline
+        self.plan_ttl = plan_ttl
+        self.plan_order = plan_order
+        self.or_group_size = or_group_size
+        # 训练用的宽高比分桶（buckets.Buckets），None 为保存原始图片
+        self.buckets = buckets
+        # 本次运行最多下载的字节数，None 不限；达到后停止翻页和下载，断点保留
+        self.byte_budget = byte_budget
+        self.downloaded_bytes = 0
+        # 多进程/多机器分布式抓取：work_queue 为共享的 SQLite 队列文件或协调服务地址（见 workqueue.py），
+        # 设置后标签行从队列按需租约，txt_path 只在队列为空时用来填充队列
+        self.work_queue = work_queue
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        # 增量抓取：已完成的tag距上次抓取超过 refresh_after 秒时，只请求比上次见过的最大帖子 id 更新的帖子（id:>N），
+        # 没有新帖子的tag只花一个请求；None 时已完成的tag不再请求
+        self.refresh_after = refresh_after
+        # 代理池：代理地址列表，设置后忽略 proxies；并发（api_concurrency / cdn_concurrency）和速率（api_rate / cdn_rate）
+        # 都是每个代理的预算，请求分给延迟和错误率最低的代理，连续失败的代理暂时剔除
+        self.proxy_pool = proxy_pool
+        # 下载完成后在线程池里检查图片结构（md5 在下载时已经校验），不通过的文件移到 quarantine_dir 后重新下载，
+        # quarantine_dir 为 None 时直接删除；完整且 md5 一致却不通过的文件隔离后记为 skipped，不再重试
+        self.verify = verify
+        self.quarantine_dir = quarantine_dir
+        self.failed_lines = []
+
+    @property
+    def site(self):
+        return self.source.site
+
+    def over_budget(self):
+        return self.byte_budget is not None and self.downloaded_bytes >= self.byte_budget
+
+
+async def read_lines(txt_path, start_line=1):
+    # 返回 [(行号, 标签行)]，跳过空行
+    log.info(f"尝试打开文件: {txt_path}")
+    try:
+        async with aiofiles.open(txt_path, mode='r', encoding='utf-8') as file:
+            all_lines = await file.readlines()
+    except FileNotFoundError:
+        log.error(f"错误: 文件 {txt_path} 不存在.")
+        return None
+    lines = [(number, line.strip()) for number, line in enumerate(all_lines, 1) if number >= start_line and line.strip()]
+    log.info(f"成功读取文件: {txt_path}, 从第 {start_line} 行开始，共 {len(lines)} 行待处理。")
+    return lines
+
+
+class CrawlEngine:
+    """在一个进程里同时抓取多个站点。
+
+    每个 Crawl 有自己的 API/CDN 客户端、限速器、列表缓存和下载队列，一个站点被限速时其他站点照常下载；
+    所有站点共享同一个清单（md5 去重、断点）和图片转换进程池。
+    各阶段的耗时、字节数、重试和跳过原因记录在 metrics 里，可以通过 metrics_port / metrics_path 导出。
+    """
+
+    def __init__(self, manifest_path='manifest.db', convert_workers=None, jpeg_quality=95, dedupe='skip', max_retries=10,
+                 log_level='info', metrics_port=None, metrics_path=None, metrics_interval=30.0):
+        self.manifest_path = manifest_path
+        self.convert_workers = convert_workers
+        self.jpeg_quality = jpeg_quality
+        self.dedupe = dedupe
+        self.max_retries = max_retries
+        self.log_level = log_level
+        self.reporter = MetricsReporter(metrics_port, metrics_path, metrics_interval)
+
+    async def run(self, crawls):
+        """返回每个 Crawl 多次请求失败的标签行号列表。"""
+        setup_logging(self.log_level)
+        log.info("开始执行脚本...")
+        log.info(f"当前工作目录: {os.getcwd()}")
+        with ImageConverter(self.convert_workers, self.jpeg_quality) as self.converter, Manifest(self.manifest_path) as self.manifest:
+            async with self.reporter:
+                # 一个站点出错时其他站点照常完成，断点都保存后再抛出
+                results = await asyncio.gather(*(self.run_crawl(crawl) for crawl in crawls), return_exceptions=True)
+        errors = [(crawl, result) for crawl, result in zip(crawls, results) if isinstance(result, BaseException)]
+        for crawl, error in errors:
+            log.error(f"[{crawl.site}] 抓取异常退出: {error!r}")
+        if errors:
+            raise errors[0][1]
+        return [crawl.failed_lines for crawl in crawls]
+
+    async def run_crawl(self, crawl):
+        if crawl.work_queue is None:
+            return await self.crawl_lines(crawl)
+        queue = open_queue(crawl.work_queue, crawl.site)
+        try:
+            if not await queue.progress():
+                # 队列还是空的：由第一个启动的 worker 填充（重复填充会被忽略）
+                lines = await read_lines(crawl.txt_path, crawl.start_line)
+                if lines:
+                    log.info(f"[{crawl.site}] 已向工作队列加入 {await queue.load(lines)} 个标签行")
+            await self.crawl_lines(crawl, queue)
+        finally:
+            # 没有处理完的行（达到流量上限或异常退出）立即交还，不必等租约过期
+            await queue.release(crawl.worker_id)
+            log.info(f"[{crawl.site}] 工作队列进度: {await queue.progress()}")
+            await queue.close()
+
+    async def crawl_lines(self, crawl, queue=None):
+        """抓取一个站点的标签行：queue 为 None 时处理 txt_path 里的全部行，否则从工作队列按需租约。"""
+        source, sink, manifest = crawl.source, crawl.sink, self.manifest
+        if queue is None:
+            lines = await read_lines(crawl.txt_path, crawl.start_line)
+            if lines is None:
+                return
+        if manifest.needs_legacy_import(crawl.site):
+            # 只在第一次使用清单时扫描一次已有文件
+            imported = await manifest.import_legacy(crawl.site, sink.legacy_names())
+            log.info(f"已导入 {imported} 个已有文件到清单: {manifest.path}")
+
+        if queue is None:
+            # 从断点恢复每个tag的页码和数量，已完成的tag不再请求
+            jobs = [self.resume_job(crawl, number, line) for number, line in lines]
+            jobs = [job for job in jobs if not job.complete()]
+            log.info(f"[{crawl.site}] 待处理的标签行: {len(jobs)}")
+
+        # API 请求和图片下载使用各自的连接池和超时
+        pool = ProxyPool(crawl.proxy_pool, {source.api_host: crawl.api_rate}, crawl.cdn_rate) if crawl.proxy_pool else None
+        egress = len(pool) if pool is not None else 1
+        api_session, cdn_session = create_clients(crawl.proxies, source.headers, crawl.api_concurrency, crawl.cdn_concurrency, crawl.http2, crawl.api_timeout, crawl.timeout, pool)
+        async with api_session, cdn_session:
+            if pool is None:
+                # API host 和图片 CDN host 各自独立限速
+                limiter = RateLimiter({source.api_host: crawl.api_rate}, default_rate=crawl.cdn_rate)
+                limiter.install(api_session)
+                limiter.install(cdn_session)
+                metrics.gauge('api_rate', lambda: limiter.host(source.api_host).rate, site=crawl.site)
+            else:
+                # 代理池里每个代理各自限速，总速率是各代理之和
+                log.info(f"[{crawl.site}] 使用 {egress} 个代理")
+                metrics.gauge('api_rate', lambda: pool.rate(source.api_host), site=crawl.site)
+                metrics.gauge('healthy_proxies', pool.healthy, site=crawl.site)
+            metrics.install(api_session, 'api')
+            metrics.install(cdn_session, 'cdn')
+            if queue is None:
+                jobs = await self.plan(crawl, api_session, jobs)
+
+            async def handle_item(job, item):
+                return await self.process_item(crawl, cdn_session, job, item)
+
+            # 列表页缓存，cache_ttl 为 None 时不使用
+            cache = ListingCache(crawl.listing_cache_path, crawl.cache_ttl, crawl.offline) if crawl.cache_ttl is not None else None
+            pipeline = CrawlPipeline(handle_item, crawl.download_workers, crawl.queue_size, crawl.api_concurrency * egress, crawl.cdn_concurrency * egress)
+            # 队列长度：下载队列长期满说明瓶颈在下载或写入，长期空说明瓶颈在翻页
+            metrics.gauge('download_queue_depth', pipeline.queue.qsize, site=crawl.site)
+            metrics.gauge('sink_queue_depth', sink.backlog, site=crawl.site)
+
+            # 本 worker 有标签行完成时唤醒等待租约的翻页任务
+            finished = asyncio.Event()
+
+            async def produce(job):
+                try:
+                    await self.process_line(crawl, api_session, pipeline, cache, job)
+                except Exception:
+                    job.failed = True
+                    raise
+                finally:
+                    if queue is not None:
+                        await self.report(crawl, queue, job)
+                        finished.set()
+
+            try:
+                with sink, cache or nullcontext():
+                    if queue is None:
+                        await pipeline.run(jobs, produce, crawl.page_fetchers)
+                    else:
+                        async with Heartbeat(queue, crawl.worker_id, crawl.lease_seconds):
+                            await pipeline.run(self.lease_jobs(crawl, queue, api_session, finished), produce, crawl.page_fetchers)
+            finally:
+                metrics.remove_gauges(site=crawl.site)
+
+        if crawl.over_budget():
+            log.warning(f"[{crawl.site}] 已达到本次运行的流量上限 {crawl.byte_budget} 字节，未完成的标签行已保存断点")
+        if queue is None:
+            # 被拒绝的行重启也不会成功，不算在内
+            crawl.failed_lines = sorted(job.line_number for job in jobs if job.failed and job.rejected is None)
+        if crawl.failed_lines:
+            log.warning(f"[{crawl.site}] 以下标签行多次请求失败，已保存断点: {', '.join(map(str, crawl.failed_lines))}")
+
+    def resume_job(self, crawl, number, line):
+        """按断点恢复一个标签行；增量模式下已完成、且距上次抓取超过 refresh_after 秒的tag只请求上次之后的新帖子。"""
+        job = TagJob(line, number, crawl.max_images)
+        updated_at = self.manifest.resume(crawl.site, job)
+        if crawl.refresh_after is not None and job.complete() and time.time() - updated_at >= crawl.refresh_after:
+            # 旧版本的断点没有 max_id 时用清单里该tag的最大帖子 id，都没有时从头翻页
+            job.refresh(job.max_id if job.max_id is not None else self.manifest.max_post_id(crawl.site, line))
+        return job
+
+    async def plan(self, crawl, session, jobs):
+        source = crawl.source
+        if source.plannable and crawl.plan_ttl is not None and not crawl.offline:
+            # 先批量查询各tag的帖子数，跳过没有帖子或已被别名的tag，并按帖子数排序
+            jobs = await plan_jobs(session, jobs, self.manifest, crawl.site, source.base_url, crawl.plan_ttl, crawl.plan_order)
+            # 帖子很少的tag合成 OR 查询，按 tag_string 分回各自的tag
+            jobs = group_jobs(jobs, crawl.or_group_size, source.pagination.limit)
+        return jobs
+
+    def lease_jobs(self, crawl, queue, session, finished):
+        """工作队列模式下交给 pipeline 的 next_job()：本地的行用完时再租约一批（每个翻页任务一行，合并查询时多租几行），
+        恢复断点、规划后逐个返回。
+
+        队列里暂时没有可租约的行、但还有行持有租约时等待（本 worker 有行完成时立即再查），
+        其他 worker 的租约过期后这些行会分到这里；全部完成或达到流量上限时返回 None。
+        """
+        site, worker = crawl.site, crawl.worker_id
+        batch = crawl.page_fetchers * max(crawl.or_group_size, 1)
+        buffer = []
+        lock = asyncio.Lock()
+
+        async def next_job():
+            async with lock:
+                while not buffer:
+                    if crawl.over_budget():
+                        return None
+                    leased = await queue.lease(worker, batch, crawl.lease_seconds)
+                    if not leased:
+                        if not await queue.unfinished():
+                            return None
+                        finished.clear()
+                        try:
+                            await asyncio.wait_for(finished.wait(), POLL_INTERVAL)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    metrics.inc('leased_lines_total', len(leased), site=site)
+                    jobs = [self.resume_job(crawl, number, line) for number, line in leased]
+                    planned = await self.plan(crawl, session, [job for job in jobs if not job.complete()])
+                    # 已完成的、规划阶段跳过的行直接报告完成
+                    kept = {id(member) for job in planned for member in job.members or [job]}
+                    for job in jobs:
+                        if id(job) not in kept:
+                            await queue.complete(worker, job.line_number)
+                            metrics.inc('work_lines_total', site=site, result='done')
+                    buffer.extend(planned)
+                return buffer.pop(0)
+
+        return next_job
+
+    async def report(self, crawl, queue, job):
+        # 合并查询按成员分别报告；没有完成也没有失败的行（达到流量上限时）交还队列
+        for member in job.members or [job]:
+            if member.rejected is not None:
+                # 重试也不会成功，不再分配
+                result = 'rejected'
+                await queue.complete(crawl.worker_id, member.line_number)
+            elif member.failed:
+                result = 'failed'
+                await queue.complete(crawl.worker_id, member.line_number, failed=True)
+            elif member.complete() and not crawl.offline:
+                result = 'done'
+                await queue.complete(crawl.worker_id, member.line_number)
+            else:
+                result = 'released'
+                await queue.release(crawl.worker_id, member.line_number)
+            metrics.inc('work_lines_total', site=crawl.site, result=result)
+
+    async def download_image(self, session, url, target, crawl, convert=True, md5=None):
+        """下载一张图片：target 为文件路径时流式写入文件并返回该路径，为 None 时返回字节；convert 为 True 时 WebP 在进程池中转成 JPEG 字节。
+
+        中断的传输在重试时用 Range 从已收到的字节继续（写文件时 .part 在重启后也保留），给出 md5 时边下载边校验，
+        crawl.verify 时再在线程池里检查图片结构；校验失败的内容隔离后重新下载。
+        跳过的文件（包括 Content-Length 超过 policy.max_bytes 的）返回 None，不是图片的内容抛出 NotImage，
+        多次重试仍失败时抛出 DownloadFailed。
+        """
+        site = crawl.site
+        policy = crawl.source.policy
+        max_bytes = policy.max_bytes if policy is not None else None
+        # 下载到内存时，重试之间保留已收到的部分
+        buffer = bytearray()
+        retries = 0
+        while retries < self.max_retries:
+            try:
+                start = time.monotonic()
+                if url.lower().endswith('.webp') or target is None:
+                    status_code, image = await fetch_bytes(session, url, max_bytes=max_bytes, buffer=buffer, md5=md5)
+                else:
+                    status_code = await stream_download(session, url, target, max_bytes=max_bytes, md5=md5)
+                    image = target
+                if status_code == 200:
+                    if crawl.verify:
+                        try:
+                            await self.verify_image(crawl, image)
+                        except CorruptDownload as e:
+                            if md5 is None:
+                                raise
+                            # 完整收到且 md5 与 API 一致：文件本身就是这样（例如 Pillow 不支持的格式），重新下载也一样
+                            await asyncio.get_running_loop().run_in_executor(
+                                None, partial(quarantine, image, crawl.quarantine_dir, os.path.basename(url), url, str(e)))
+                            raise NotImage(str(e)) from e
+                    self.observe_download(crawl, start, len(image) if isinstance(image, bytes) else os.path.getsize(image))
+                    if convert and url.lower().endswith('.webp'):
+                        try:
+                            with metrics.timer('convert_seconds', site=site):
+                                image = await self.converter.to_jpeg(image)
+                        except Exception as e:
+                            log.warning(f"WebP转换失败: {e}, 文件: {url}")
+                            metrics.inc('skips_total', site=site, reason='convert_failed')
+                            return None
+                    return image
+                elif retryable(status_code):
+                    retries += 1
+                    metrics.inc('retries_total', site=site, stage='download', status=str(status_code))
+                    log.info(f"下载失败 (状态码 {status_code}, 尝试 {retries}/{self.max_retries}): {url}")
+                    await asyncio.sleep(backoff_delay(retries))
+                else:
+                    log.warning(f"下载失败 (状态码 {status_code}): {url}")
+                    break
+            except NotImage:
+                metrics.inc('skips_total', site=site, reason='not_image')
+                raise
+            except SkipDownload as e:
+                log.debug(f"跳过下载: {e} - {url}")
+                metrics.inc('skips_total', site=site, reason='headers')
+                return None
+            except CorruptDownload as e:
+                # 截断、CDN 错误页、损坏的文件不写入数据集：隔离后从头重新下载
+                retries += 1
+                buffer.clear()
+                metrics.inc('corrupt_total', site=site, reason=e.reason)
+                metrics.inc('retries_total', site=site, stage='download', status='corrupt')
+                log.warning(f"校验失败，已隔离 (尝试 {retries}/{self.max_retries}): {e} - {url}")
+                await asyncio.get_running_loop().run_in_executor(
+                    None, partial(quarantine, e.image, crawl.quarantine_dir, os.path.basename(url), url, str(e)))
+                await asyncio.sleep(backoff_delay(retries))
+            except Exception as e:
+                log.info(f"下载异常 (尝试 {retries + 1}/{self.max_retries}): {e} - {url}")
+                retries += 1
+                metrics.inc('retries_total', site=site, stage='download', status=type(e).__name__)
+                await asyncio.sleep(backoff_delay(retries))
+
+        log.warning(f"放弃下载: {url}")
+        metrics.inc('downloads_failed_total', site=site)
+        raise DownloadFailed(url)
+
+    async def verify_image(self, crawl, image):
+        # 只读文件头和结构，不解码像素；失败时抛出 CorruptDownload
+        try:
+            with metrics.timer('verify_seconds', site=crawl.site):
+                await self.converter.verify(image)
+        except Exception as e:
+            raise CorruptDownload(f"图片结构损坏: {e}", image, reason='verify') from e
+
+    @staticmethod
+    def observe_download(crawl, start, size):
+        elapsed = time.monotonic() - start
+        site = crawl.site
+        crawl.downloaded_bytes += size
+        metrics.inc('download_bytes_total', size, site=site)
+        metrics.inc('downloads_total', site=site)
+        metrics.observe('download_seconds', elapsed, site=site)
+        if elapsed > 0:
+            metrics.observe('download_bytes_per_second', size / elapsed, RATE_BUCKETS, site=site)
+
+    async def process_item(self, crawl, session, job, item):
+        source, sink, manifest, site = crawl.source, crawl.sink, self.manifest, crawl.site
+        if crawl.over_budget():
+            metrics.inc('skips_total', site=site, reason='budget')
+            return False
+        url, variant = source.image_url(item, crawl.buckets)
+        if not url:
+            log.debug(f"未找到图片URL: {item.get('id')}")
+            metrics.inc('skips_total', site=site, reason='no_url')
+            return False
+        if not is_image_url(url):
+            # 例如 Danbooru 动图的原文件是 zip
+            log.debug(f"不是图片文件，跳过: {url}")
+            metrics.inc('skips_total', site=site, reason='not_image')
+            return False
+        name = comparison_name(url, jpeg=crawl.buckets is not None)
+        if crawl.offline:
+            # 离线演练只翻缓存的列表页，不请求图片，按会下载计数
+            log.debug(f"离线模式，不下载: {name}")
+            metrics.inc('skips_total', site=site, reason='offline')
+            return True
+        post_id = item.get('id')
+        md5 = item.get('md5')
+        if manifest.status(site, post_id) == 'skipped':
+            log.debug(f"之前已确认不是图片，跳过: {name}")
+            metrics.inc('skips_total', site=site, reason='not_image')
+            return False
+        groups = source.tag_groups(item)
+        sample = {'id': post_id, 'md5': md5, 'tag_line': job.line, 'rating': item.get('rating'), 'score': item.get('score'),
+                  'tag_string': source.tag_string(item), 'tag_groups': groups, 'caption': source.caption(item, groups)}
+
+        if self.dedupe and md5:
+            # 请求图片之前先按 md5 查清单：本tag已有则计数，其他tag/站点已有则按 dedupe 跳过或引用
+            while True:
+                if manifest.has_content(site, md5, job.line):
+                    log.debug(f"文件已存在: {name}, 跳过下载")
+                    metrics.inc('skips_total', site=site, reason='exists')
+                    return True
+                # 原图只能引用原图，缩略图只能引用同一尺寸的缩略图
+                duplicate = manifest.find_md5(md5, ORIGINAL_VARIANTS if variant in ORIGINAL_VARIANTS else (variant,))
+                if duplicate:
+                    reused = await self.reuse_duplicate(crawl, job, name, duplicate, sample)
+                    if reused is not None:
+                        return reused
+                if manifest.claim_md5(md5):
+                    break
+                # 相同内容正在别的 tag 下下载：等它结束后重新查清单，下载成功就引用，失败就自己下载
+                log.debug(f"相同内容正在下载中，等待: {name}")
+                metrics.inc('dedupe_waits_total', site=site)
+                await manifest.wait_md5(md5)
+        # 其他 worker 正在下载同一帖子时也视为已存在
+        if manifest.is_done(site, post_id, name) or name in sink or not manifest.claim(site, post_id):
+            log.debug(f"文件已存在: {name}, 跳过下载")
+            metrics.inc('skips_total', site=site, reason='exists')
+            manifest.release_md5(md5)
+            return True
+
+        try:
+            # API 的 md5 是原文件的，只能校验原图
+            expected_md5 = md5 if variant in ORIGINAL_VARIANTS else None
+            if crawl.buckets is None:
+                image = await self.download_image(session, url, sink.target(job, name), crawl, md5=expected_md5)
+            else:
+                # 分桶时下载到内存，在进程池中缩放裁剪后只写入训练用的尺寸
+                image = await self.download_image(session, url, None, crawl, convert=False, md5=expected_md5)
+                if image is not None:
+                    image = await self.resize(crawl, image, url, sample)
+            success = image is not None
+            if success:
+                with metrics.timer('sink_write_seconds', site=site):
+                    await sink.save(job, name, image, sample)
+                await manifest.record(site, post_id, md5, name, job.line, variant, path=sink.path(job, name))
+        except NotImage as e:
+            # 记为 skipped，之后的运行不再请求
+            log.info(f"不是图片，跳过: {e} - {url}")
+            await manifest.record(site, post_id, md5, name, job.line, variant, status='skipped')
+            success = False
+        except DownloadFailed:
+            # 只记录这一张失败，不影响该tag的其他帖子
+            await manifest.record(site, post_id, md5, name, job.line, variant, status='failed')
+            success = False
+        finally:
+            manifest.release(site, post_id)
+            manifest.release_md5(md5)
+        return success
+
+    async def resize(self, crawl, image, url, sample):
+        # 缩放到分桶尺寸，分桶记录在 sample['bucket'] 里由 sink 写入分桶清单；失败返回 None
+        try:
+            with metrics.timer('resize_seconds', site=crawl.site):
+                image, sample['bucket'] = await self.converter.to_bucket(image, crawl.buckets)
+            return image
+        except Exception as e:
+            log.warning(f"缩放失败: {e}, 文件: {url}")
+            metrics.inc('skips_total', site=crawl.site, reason='resize_failed')
+            return None
+
+    async def reuse_duplicate(self, crawl, job, name, duplicate, sample):
+        # 同一内容（md5 相同）已经在别的 tag 或站点下载过，不再请求图片；
+        # 已有的文件无法引用（只在别的压缩包里、已被移走）时返回 None，由调用方正常下载
+        src_site, src_id = duplicate[0], duplicate[1]
+        if self.dedupe != 'link':
+            log.debug(f"内容重复 (已在 {src_site} #{src_id} 下载)，跳过: {name}")
+            metrics.inc('skips_total', site=crawl.site, reason='duplicate')
+            return False
+        if crawl.buckets is not None and duplicate[4] and os.path.exists(duplicate[4]):
+            # 已有文件的尺寸就是它的分桶
+            sample['bucket'] = image_size(duplicate[4])
+        if not await crawl.sink.link(job, name, duplicate, sample):
+            log.debug(f"无法引用 {src_site} #{src_id} 的文件，重新下载: {name}")
+            sample.pop('bucket', None)
+            return None
+        await self.manifest.add_ref(crawl.site, sample['id'], sample['md5'], job.line, crawl.sink.path(job, name))
+        log.debug(f"内容重复，引用 {src_site} #{src_id}: {name}")
+        metrics.inc('linked_total', site=crawl.site)
+        return True
+
+    async def process_line(self, crawl, session, pipeline, cache, job, max_retries=8):
+        pagination, manifest, site = crawl.source.pagination, self.manifest, crawl.site
+        log.info(f"处理第 {job.line_number} 行: {job.line}")
+        crawl.sink.prepare(job)
+        processed_tags = job.search()
+        retries = 0
+
+        while not job.complete():
+            if crawl.over_budget():
+                # 本次运行的流量用完，断点保留，下次运行继续
+                log.debug(f"[{site}] 已达到流量上限，停止翻页: {job.line}")
+                break
+            url = pagination.url(job, processed_tags)
+            status_code = None
+            try:
+                async with pipeline.api_limit:
+                    # 有缓存时重复运行直接使用缓存的列表页
+                    with metrics.timer('listing_seconds', site=site):
+                        status_code, data = await fetch_listing(session, url, cache)
+                if status_code != 200:
+                    if not retryable(status_code):
+                        # 4xx 等重试也不会成功的错误，直接放弃该tag，并记入断点，之后的运行不再请求
+                        log.warning(f"请求失败 (状态码 {status_code})，不再请求该tag: {url}")
+                        job.failed = True
+                        job.rejected = status_code
+                        if not crawl.offline:
+                            await manifest.checkpoint(site, job)
+                        return
+                    raise IOError(f"请求失败 (状态码 {status_code})")
+            except OfflineMiss:
+                # 离线演练到缓存的尽头就停下，断点保持不变
+                log.info(f"离线模式，缓存中没有后续列表页，停止: {job.line}")
+                return
+            except Exception as e:
+                # 只在本进程内重试这一个tag的这一页，断点保持不变
+                retries += 1
+                metrics.inc('retries_total', site=site, stage='listing', status=str(status_code) if status_code else type(e).__name__)
+                log.info(f"请求异常 (尝试 {retries}/{max_retries}): {e} - {url}")
+                if retries >= max_retries:
+                    log.warning(f"放弃第 {job.line_number} 行: {job.line}")
+                    job.failed = True
+                    return
+                await asyncio.sleep(backoff_delay(retries))
+                continue
+            retries = 0
+            metrics.inc('listing_pages_total', site=site)
+            # 记录见过的最大帖子 id，下次增量抓取只请求更新的帖子
+            for item in data:
+                job.saw(item)
+            if not data:
+                log.info(f"Tag '{processed_tags}' 已无更多图片。")
+                job.exhausted = True
+                break
+            # 断点记录了这一页已处理到第几条，恢复时跳过这些帖子
+            for index in range(pagination.start(job), len(data)):
+                if not await pipeline.put(job, data[index]):
+                    break
+            else:
+                index = len(data)
+            # 这一页入队的帖子全部处理完后才推进断点，崩溃后从这里继续
+            await job.settled()
+            pagination.advance(job, data, index)
+            # 已翻过该tag的全部帖子（post_count 已知时），不再请求一个空页
+            job.exhausted = job.listed(len(data)) and index == len(data)
+            if not crawl.offline:
+                await manifest.checkpoint(crawl.site, job)
+        await job.settled()
+        # 离线演练没有下载图片，不保存断点
+        if not crawl.offline:
+            await manifest.checkpoint(crawl.site, job)
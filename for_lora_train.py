@@ -1,192 +1,93 @@
-import httpx
 import asyncio
-import aiofiles
-import os
 from pathlib import Path
-from PIL import Image
-import json
+from buckets import Buckets
+from engine import Crawl, CrawlEngine
+from sinks import FolderSink, ShardSink
+from sources import DanbooruSource, make_policy, make_caption_rules
+from workqueue import default_worker_id, worker_dir
 
-async def download_image(session, item, filename, save_dir, error_flag, line_number):
-    max_retries = 10
-    retries = 0
-    
-    # 获取原始图片URL
-    media_asset = item.get('media_asset', {})
-    variants = media_asset.get('variants', [])
-    original_variant = next((v for v in variants if v['type'] == 'original'), None)
-    url = original_variant['url'] if original_variant else None
-    
-    if not url:
-        print(f"未找到原始图片URL: {item}")
-        return False
-
-    while retries < max_retries:
-        try:
-            response = await session.get(url)
-            if response.status_code == 200:
-                content_type = response.headers.get('Content-Type', '')
-                if 'video' in content_type:
-                    print(f"跳过视频文件: {url}")
-                    return False
-                
-                # 下载图片
-                async with aiofiles.open(filename, 'wb') as f:
-                    await f.write(response.content)
-                
-                # 处理WebP格式
-                if filename.suffix.lower() == '.webp':
-                    new_filename = filename.with_suffix('.jpg')
-                    with Image.open(filename) as img:
-                        img.save(new_filename, 'JPEG')
-                    os.remove(filename)
-                    filename = new_filename
-                    print(f"转换完成: {filename}")
-                
-                print(f"下载完成: {filename}")
-                
-                # 处理tag_string并保存到txt文件
-                tag_string = item.get('tag_string', '')
-                processed_tags = tag_string.replace(' ', ',').replace('_', ' ')
-                txt_filename = filename.with_suffix('.txt')
-                async with aiofiles.open(txt_filename, 'w', encoding='utf-8') as txt_file:
-                    await txt_file.write(processed_tags)
-                print(f"写入TXT: {txt_filename}")
-                
-                return True
-            else:
-                print(f"下载失败 (状态码 {response.status_code}): {url}")
-                break
-        except Exception as e:
-            print(f"下载异常 (尝试 {retries + 1}/{max_retries}): {e} - {url}")
-            retries += 1
-    
-    print(f"放弃下载: {url}")
-    error_flag['value'] = True
-    error_flag['lines'].append(line_number)
-    return False
-
-async def process_line(session, line, line_number, base_save_dir, max_images=5, existing_filenames=None, error_flag=None):
-    # 为每行创建一个子文件夹，使用清理后的行内容作为文件夹名
-    folder_name = line.strip().replace(' ', '_').replace('/', '_').replace('\\', '_')  # 避免非法字符
-    save_dir = base_save_dir / folder_name
-    save_dir.mkdir(parents=True, exist_ok=True)
-    
-    processed_tags = line.replace(' ', '_')
-    page = 1
-    processed_count = 0
-    
-    while processed_count < max_images:
-        url = f"https://kagamihara.donmai.us/posts.json?page={page}&tags={processed_tags}"
-        try:
-            response = await session.get(url)
-            if response.status_code == 200:
-                data = response.json()
-                if not data:
-                    break
-                for item in data:
-                    image_name = os.path.basename(item.get('file_url', ''))
-                    
-                    comparison_filename = image_name
-                    if comparison_filename.endswith('.webp'):
-                        comparison_filename = comparison_filename[:-5] + '.jpg'
-                    
-                    unique_filename = save_dir / comparison_filename
-                    
-                    if comparison_filename in existing_filenames:
-                        print(f"文件已存在: {comparison_filename}, 跳过下载")
-                        processed_count += 1
-                        if processed_count >= max_images:
-                            return
-                    else:
-                        success = await download_image(session, item, unique_filename, save_dir, error_flag, line_number)
-                        if success:
-                            processed_count += 1
-                            existing_filenames.add(comparison_filename)
-                            if processed_count >= max_images:
-                                return
-                        elif error_flag['value']:
-                            return
-            else:
-                print(f"请求失败 (状态码 {response.status_code}): {url}")
-                error_flag['value'] = True
-                error_flag['lines'].append(line_number)
-                return
-        except Exception as e:
-            print(f"请求异常: {e} - {url}")
-            error_flag['value'] = True
-            error_flag['lines'].append(line_number)
-            return
-        page += 1
-
-async def read_existing_filenames(base_save_dir):
-    existing_filenames = set()
-    for sub_dir in base_save_dir.glob('*'):
-        if sub_dir.is_dir():
-            for file in sub_dir.glob('*.jpg'):
-                existing_filenames.add(file.name)
-    return existing_filenames
-
-async def main(txt_path, save_dir="downloaded_images", timeout=1000, proxies=None, start_line=1, max_lines_per_batch=5, max_images=5):
-    print("开始执行脚本...")
-    print(f"当前工作目录: {os.getcwd()}")
-    print(f"尝试打开文件: {txt_path}")
-
-    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout), proxies=proxies) as session:
-        lines = []
-        try:
-            async with aiofiles.open(txt_path, mode='r') as file:
-                line_number = 0
-                while True:
-                    line = await file.readline()
-                    if not line:
-                        break
-                    line_number += 1
-                    if line_number >= start_line:
-                        lines.append(line.strip())
-            print(f"成功读取文件: {txt_path}, 行数: {len(lines)}")
-        except FileNotFoundError:
-            print(f"错误: 文件 {txt_path} 不存在.")
-            return None
-        
-        base_save_dir = Path(save_dir)
-        base_save_dir.mkdir(parents=True, exist_ok=True)
-        print(f"创建/检查基础保存目录: {base_save_dir}")
-
-        existing_filenames = await read_existing_filenames(base_save_dir)
-        
-        error_flag = {'value': False, 'lines': []}
-        batch_start_line = start_line
-        while lines:
-            batch_lines = lines[:max_lines_per_batch]
-            lines = lines[max_lines_per_batch:]
-            
-            for i, line in enumerate(batch_lines, start=1):
-                current_line_number = batch_start_line + i - 1
-                print(f"处理第 {current_line_number}/{batch_start_line + len(batch_lines) - 1} 行: {line}")
-                await process_line(session, line, current_line_number, base_save_dir, max_images=max_images, existing_filenames=existing_filenames, error_flag=error_flag)
-                if error_flag['value']:
-                    print(f"检测到下载异常，停止脚本。出错的行号: {', '.join(map(str, sorted(set(error_flag['lines']))))}")
-                    return min(error_flag['lines'])
-        
-            batch_start_line += max_lines_per_batch
-    return None
+async def main(txt_path, save_dir="downloaded_images", timeout=60.0, proxies=None, start_line=1, page_fetchers=4, max_images=5, download_workers=8, queue_size=100, api_concurrency=2, cdn_concurrency=8, convert_workers=None, jpeg_quality=95, manifest_path=None, pagination_mode='cursor', page_limit=200, api_rate=5.0, cdn_rate=20.0, output_mode='folder', shard_samples=1000, shard_bytes=1024 ** 3, dedupe='skip', api_timeout=30.0, http2=False, listing_cache_path=None, cache_ttl=3600, offline=False, plan_ttl=86400, plan_order='largest', or_group_size=1, log_level='info', metrics_port=None, metrics_path=None, bucket_resolution=None, bucket_step=64, bucket_max_ratio=2.0, min_side=None, max_file_bytes=None, prefer_ext=(), byte_budget=None, work_queue=None, worker_id=None, refresh_after=None, proxy_pool=None, verify_images=True, quarantine_dir=None, metadata_format='txt', caption_exclude=(), caption_categories=None, caption_max_tags=None, caption_prefix=()):
+    base_save_dir = Path(save_dir)
+    # 分布式抓取时每个 worker 写入 save_dir 下自己的文件夹，清单和列表缓存仍在 save_dir（同一台机器上的 worker 共用断点和去重）
+    worker_id = (worker_id or default_worker_id()) if work_queue else None
+    output_dir = worker_dir(base_save_dir, worker_id) if worker_id else base_save_dir
+    source = DanbooruSource(page_limit=page_limit, pagination_mode=pagination_mode, variants=('original',), policy=make_policy(min_side, max_file_bytes, prefer_ext),
+                            caption_rules=make_caption_rules(caption_exclude, caption_categories, caption_max_tags, caption_prefix, replace_underscores=True))
+    # 设置了分桶分辨率时下载能覆盖分桶的最小变体，缩放裁剪后保存
+    buckets = Buckets(bucket_resolution, bucket_step, bucket_max_ratio) if bucket_resolution else None
+    # 'webdataset' 模式把样本顺序写入 tar 分片，不再为每张图生成单独的文件
+    sink = ShardSink(output_dir, shard_samples, shard_bytes) if output_mode == 'webdataset' else FolderSink(output_dir, metadata_format)
+    crawl = Crawl(source, sink, txt_path, start_line, max_images, page_fetchers, download_workers, queue_size,
+                  api_concurrency, cdn_concurrency, api_rate, cdn_rate, timeout, api_timeout, proxies, http2,
+                  listing_cache_path or base_save_dir / 'listing_cache.db', cache_ttl, offline, plan_ttl, plan_order, or_group_size, buckets, byte_budget, work_queue, worker_id, refresh_after=refresh_after, proxy_pool=proxy_pool,
+                  verify=verify_images, quarantine_dir=quarantine_dir or base_save_dir / '.quarantine')
+    engine = CrawlEngine(manifest_path or base_save_dir / 'manifest.db', convert_workers, jpeg_quality, dedupe, log_level=log_level, metrics_port=metrics_port, metrics_path=metrics_path)
+    failed_lines, = await engine.run([crawl])
+    return failed_lines[0] if failed_lines else None
 
 if __name__ == "__main__":
     txt_path = "artist_full.txt" # 所有你需要爬的标签txt，每行一个tag，不同tag会保存到不同的文件夹里
     save_dir = "downloaded_images"
-    timeout = 5000
+    timeout = 60 # 图片下载的读超时(秒)，即两次收到数据之间最长的等待，卡住的传输超时后重试
+    api_timeout = 30 # API请求的读超时(秒)
     proxies = {"http://": 'http://127.0.0.1:7890', "https://": 'http://127.0.0.1:7890'}
-    max_lines_per_batch = 5
+    page_fetchers = 4 # 同时翻页的tag数
+    download_workers = 8 # 下载worker数
+    queue_size = 100 # 待下载队列长度，队列满时翻页暂停
+    api_concurrency = 2 # API请求最大并发
+    cdn_concurrency = 8 # 图片下载最大并发
+    convert_workers = None # WebP转JPEG的进程数，None为CPU核数
+    jpeg_quality = 95 # 转换后的JPEG质量
+    manifest_path = None # 已抓取帖子的SQLite清单，None为 save_dir/manifest.db
+    pagination_mode = "cursor" # 翻页方式: 'cursor' 按帖子id键集翻页，'page' 为数字页码
+    page_limit = 200 # 每页条数，Danbooru 最多 200
+    api_rate = 5.0 # API初始请求速率(请求/秒)，会根据429/Retry-After和错误率自动调整
+    cdn_rate = 20.0 # 图片CDN初始请求速率(请求/秒)
+    output_mode = "folder" # 'folder': 每个tag一个文件夹，图片+txt；'webdataset': 写入 save_dir 下的 tar 分片，附 shards.json 索引
+    shard_samples = 1000 # 每个分片最多的样本数
+    shard_bytes = 1024 ** 3 # 每个分片最大字节数
+    listing_cache_path = None # 列表页缓存，None为 save_dir/listing_cache.db
+    cache_ttl = 3600 # 列表页缓存有效期(秒)，过期后用 ETag/Last-Modified 重新验证；None 不使用缓存
+    offline = False # True 时只读缓存、不请求API也不下载图片，用于对上次抓取结果的离线演练（建议配合单独的 manifest_path）
+    plan_ttl = 86400 # 翻页前批量查询tag帖子数的缓存有效期(秒)，跳过没有帖子或已被别名的tag；None 不做规划
+    or_group_size = 2 # 合并查询: 规划后帖子合计不超过一页的小tag每 or_group_size 个合成一个 ~a ~b 查询；普通账号最多2个tag(Gold 6, Platinum 12)，1 为关闭
+    plan_order = "largest" # 规划后的处理顺序: 'largest' 帖子多的先开始，'smallest'，None 保持文件顺序
+    http2 = False # HTTP/2 多路复用，需要 pip install httpx[http2]
+    log_level = "info" # 日志级别: 'debug' 输出每个文件的事件，'info' 每个tag的进度，'warning' 只输出失败
+    metrics_port = None # 在本机该端口提供 Prometheus 格式的 /metrics，None 不开启
+    metrics_path = None # 每30秒向该文件追加一行 JSON 指标快照（耗时、字节数、队列长度、重试和跳过原因），None 不写
+    bucket_resolution = None # 训练分辨率，例如 1024：下载时按宽高比缩放裁剪到分桶（面积约 1024²），并写入 save_dir/buckets.jsonl；None 保存原图
+    bucket_step = 64 # 分桶边长的步长
+    bucket_max_ratio = 2.0 # 分桶的最大长宽比
+    min_side = None # 变体选择: 短边至少多少像素，设置后在各尺寸的变体中选满足条件且字节数最少的；None 使用默认变体
+    max_file_bytes = None # 单个文件最大字节数，超过的变体不下载
+    prefer_ext = () # 满足条件的变体中优先的格式，例如 ("jpg",) 可以避免 WebP 转换
+    byte_budget = None # 本次运行最多下载的字节数，例如 20 * 1024 ** 3；达到后停止，断点保留，None 不限
+    work_queue = None # 分布式抓取: 共享的工作队列文件(例如 "work_queue.db")或协调服务地址("http://host:8765")，见 coordinator.py；多个进程/机器各自运行本脚本即可分摊标签行，结束后用 merge_workers.py 合并输出；None 按 start_line 处理整个 txt
+    worker_id = None # worker 名，输出写入 save_dir/worker-<worker_id>；None为 主机名-进程号，固定的名字(例如 "w1")重启后继续写同一个文件夹
+    dedupe = "link" # 按md5去重: 'skip' 重复内容不下载也不计数，'link' 不下载但硬链接到当前tag并计数（webdataset 模式从已写入的分片里复制样本），None 关闭；把 manifest_path 指向同一个文件即可与其他脚本共享
     max_images = 50 # 一个tag最多爬的图片数
+    refresh_after = None # 增量模式: 已完成的tag距上次抓取超过多少秒时(例如 86400)只请求比上次更新的帖子(id:>N)，新帖子同样受 max_images 限制；None 已完成的tag不再请求
+    proxy_pool = None # 代理池: 多个代理地址的列表，例如 ['http://127.0.0.1:7890', 'http://127.0.0.1:7891']，设置后忽略 proxies；并发和速率都是每个代理的值，download_workers 相应调大到 cdn_concurrency×代理数
+    verify_images = True # 下载后检查图片结构（Pillow verify，JPEG 检查结束标记），原图另按 API 的 md5 校验；不通过的文件隔离后重新下载
+    quarantine_dir = None # 校验失败的文件和原因（quarantine.jsonl）移到这里，None为 save_dir/.quarantine
+    metadata_format = "txt" # 标注和元数据: 'txt' 每张图一个同名txt标注，'jsonl' 每个tag文件夹一个 metadata.jsonl（帖子id、评级、分数、标注、按类别的完整标签），'both' 两者都写
+    caption_exclude = () # 标注里去掉的标签，可以用通配符，例如 ("highres", "absurdres", "*_background")；按站点原始的标签名（带下划线）匹配
+    caption_categories = None # 标注只保留这些类别的标签，例如 ("character", "general")；None 全部保留
+    caption_max_tags = None # 标注最多保留多少个标签，None 不限
+    caption_prefix = () # 放在每个标注最前面的标签，例如 LoRA 的触发词 ("my_trigger",)
     start_line = 1
+    max_restarts = 3 # 有标签行多次请求失败时最多重新启动几次；返回 4xx 的tag记入断点，不会重新启动
 
     total_lines_processed = 0
-    while True:
-        result = asyncio.run(main(txt_path, save_dir, timeout, proxies, start_line, max_lines_per_batch, max_images))
+    for restart in range(max_restarts + 1):
+        result = asyncio.run(main(txt_path, save_dir, timeout, proxies, start_line, page_fetchers, max_images, download_workers, queue_size, api_concurrency, cdn_concurrency, convert_workers, jpeg_quality, manifest_path, pagination_mode, page_limit, api_rate, cdn_rate, output_mode, shard_samples, shard_bytes, dedupe, api_timeout, http2, listing_cache_path, cache_ttl, offline, plan_ttl, plan_order, or_group_size, log_level, metrics_port, metrics_path, bucket_resolution, bucket_step, bucket_max_ratio, min_side, max_file_bytes, prefer_ext, byte_budget, work_queue, worker_id, refresh_after, proxy_pool, verify_images, quarantine_dir, metadata_format, caption_exclude, caption_categories, caption_max_tags, caption_prefix))
         if result is None:
             break
+        elif restart == max_restarts:
+            print(f"第 {result} 行等标签行重新启动 {max_restarts} 次后仍然失败，已保存断点，下次运行继续。")
         else:
-            start_line = result
+            start_line = result  # 重启后各tag从断点继续
 
         with open(txt_path, 'r') as file:
             total_lines_in_file = sum(1 for _ in file)
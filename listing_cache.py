@@ -0,0 +1,135 @@
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+import httpx
+
+from metrics import metrics, log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    page_limit INTEGER NOT NULL,
+    items INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS listings_fetched_at ON listings (fetched_at);
+"""
+
+
+class OfflineMiss(Exception):
+    """离线模式下请求的列表页不在缓存里。"""
+
+
+class ListingCache:
+    """帖子列表页（posts.json / post.json）的本地缓存，保存在 SQLite 里，响应体用 zlib 压缩。
+
+    键是 host + 路径 + 除 limit 以外的参数（即站点 + tags + 翻页位置）的哈希，limit 更大的缓存页
+    可以满足更小的请求；按数字页码翻页时每页的起点取决于 limit，limit 也算进键里。
+    ttl 秒内直接使用缓存；过期后带 If-None-Match / If-Modified-Since 重新验证，
+    服务器返回 304 时继续使用缓存。offline=True 时只读缓存，不发送任何请求，缓存中没有的页抛出 OfflineMiss。
+    """
+
+    def __init__(self, path='listing_cache.db', ttl=3600, offline=False, keep=7 * 86400):
+        self.path = path
+        self.ttl = ttl
+        self.offline = offline
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=30000')
+        self.conn.executescript(SCHEMA)
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        if keep and not offline:
+            # 太久没有用到的页不再保留
+            self.conn.execute('DELETE FROM listings WHERE fetched_at < ?', (time.time() - keep,))
+
+    def close(self):
+        log.info(f"列表缓存: 命中 {self.hits}, 304 重新验证 {self.revalidated}, 请求 {self.misses}")
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def key(url):
+        url = httpx.URL(url)
+        params = dict(url.params)
+        limit = int(params.pop('limit', 0) or 0)
+        if params.get('page', '').isdigit():
+            # page=2 在 limit 不同时是不同的帖子
+            params['limit'] = str(limit)
+        material = f"{url.host}{url.path}?" + '&'.join(f"{k}={params[k]}" for k in sorted(params))
+        return hashlib.sha256(material.encode('utf-8')).hexdigest(), limit
+
+    def lookup(self, key, limit):
+        row = self.conn.execute(
+            'SELECT page_limit, items, etag, last_modified, fetched_at, body FROM listings WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        page_limit, items = row[0], row[1]
+        # 缓存页的 limit 不小于本次请求，或者缓存页本身就是最后一页时才能使用
+        if page_limit < limit and items >= page_limit:
+            return None
+        return row
+
+    def store(self, key, url, limit, data, response):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO listings (key, url, page_limit, items, etag, last_modified, fetched_at, body) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, url, limit, len(data), response.headers.get('ETag'), response.headers.get('Last-Modified'),
+             time.time(), zlib.compress(response.content)),
+        )
+
+    async def fetch(self, session, url):
+        """返回 (状态码, 列表数据)，状态码不是 200 时数据为 None。"""
+        key, limit = self.key(url)
+        entry = self.lookup(key, limit)
+        if entry is not None and (self.offline or time.time() - entry[4] < self.ttl):
+            self.hits += 1
+            metrics.inc('listing_cache_total', result='hit')
+            return 200, json.loads(zlib.decompress(entry[5]))[:limit or None]
+        if self.offline:
+            # 不能当作列表末尾，否则tag会被标记为已翻完
+            log.debug(f"离线模式，缓存中没有: {url}")
+            raise OfflineMiss(url)
+
+        headers = {}
+        if entry is not None:
+            if entry[2]:
+                headers['If-None-Match'] = entry[2]
+            if entry[3]:
+                headers['If-Modified-Since'] = entry[3]
+        response = await session.get(url, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            metrics.inc('listing_cache_total', result='revalidated')
+            self.conn.execute('UPDATE listings SET fetched_at = ? WHERE key = ?', (time.time(), key))
+            return 200, json.loads(zlib.decompress(entry[5]))[:limit or None]
+        if response.status_code != 200:
+            return response.status_code, None
+        self.misses += 1
+        metrics.inc('listing_cache_total', result='miss')
+        data = response.json()
+        self.store(key, url, limit, data, response)
+        return 200, data
+
+
+async def fetch_listing(session, url, cache=None):
+    # 不使用缓存时直接请求
+    if cache is None:
+        response = await session.get(url)
+        return response.status_code, response.json() if response.status_code == 200 else None
+    return await cache.fetch(session, url)
@@ -0,0 +1,329 @@
+import asyncio
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    site TEXT NOT NULL,
+    post_id INTEGER,
+    md5 TEXT,
+    file_name TEXT,
+    tag_line TEXT,
+    variant TEXT,
+    path TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (site, post_id)
+);
+CREATE TABLE IF NOT EXISTS refs (
+    site TEXT NOT NULL,
+    tag_line TEXT NOT NULL,
+    md5 TEXT NOT NULL,
+    post_id INTEGER,
+    path TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (site, tag_line, md5)
+);
+CREATE INDEX IF NOT EXISTS posts_file_name ON posts (site, file_name);
+CREATE INDEX IF NOT EXISTS posts_md5 ON posts (md5);
+CREATE INDEX IF NOT EXISTS posts_tag_line ON posts (site, tag_line);
+CREATE INDEX IF NOT EXISTS refs_md5 ON refs (md5);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    site TEXT NOT NULL,
+    tag_line TEXT NOT NULL,
+    line_number INTEGER,
+    page TEXT,
+    page_offset INTEGER NOT NULL DEFAULT 0,
+    processed_count INTEGER NOT NULL DEFAULT 0,
+    exhausted INTEGER NOT NULL DEFAULT 0,
+    max_id INTEGER,
+    since_id INTEGER,
+    rejected INTEGER,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (site, tag_line)
+);
+CREATE TABLE IF NOT EXISTS tag_info (
+    site TEXT NOT NULL,
+    name TEXT NOT NULL,
+    post_count INTEGER,
+    alias_of TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (site, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class Manifest:
+    """已抓取帖子的 SQLite 清单（WAL 模式），以 site + post_id 为键。
+
+    启动时不再扫描目录，查询都走索引。旧版本留下的文件只在第一次运行时通过
+    import_legacy() 导入一次（post_id 为空，按 file_name 去重）。
+    多个脚本使用同一个清单文件时，可以按 md5 跨 tag、跨站点去重：重复的内容不再下载，
+    只在 refs 表里记录它也属于哪个 tag。
+    抓取时的写操作（record / add_ref / checkpoint 等）是协程，在清单自己的写入线程里用单独的连接执行，
+    其他进程持有写锁时最多等待 busy_timeout，但不阻塞事件循环；WAL 模式下读不需要等锁，仍在调用方线程执行。
+    """
+
+    def __init__(self, path='manifest.db'):
+        self.path = path
+        self.conn = self._connect()
+        self.conn.executescript(SCHEMA)
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(posts)')}
+        if 'path' not in columns:
+            # 旧版本的清单没有 path 列
+            self.conn.execute('ALTER TABLE posts ADD COLUMN path TEXT')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(checkpoints)')}
+        if 'max_id' not in columns:
+            # 旧版本的断点没有增量抓取用的 max_id / since_id
+            self.conn.execute('ALTER TABLE checkpoints ADD COLUMN max_id INTEGER')
+            self.conn.execute('ALTER TABLE checkpoints ADD COLUMN since_id INTEGER')
+        if 'rejected' not in columns:
+            # 旧版本的断点没有记录请求被拒绝的tag
+            self.conn.execute('ALTER TABLE checkpoints ADD COLUMN rejected INTEGER')
+        # 正在下载中的帖子，防止多个 worker 重复下载同一帖子
+        self.in_flight = set()
+        # 正在下载中的内容（md5），下载结束（成功或失败）时 set，相同内容的其他 tag 等待后再引用
+        self.md5_events = {}
+        self.writer = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='manifest-writer', initializer=self._open_writer)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        # 多个脚本同时写同一个清单时等待锁，而不是立即报错
+        conn.execute('PRAGMA busy_timeout=30000')
+        return conn
+
+    def _open_writer(self):
+        # 写入线程的连接只在该线程里使用
+        self.writer = self._connect()
+
+    async def _write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def _execute(self, sql, params=(), many=False):
+        # 在写入线程里执行；many 时作为一个事务批量写入
+        if not many:
+            return self.writer.execute(sql, params).rowcount
+        with self.writer:
+            self.writer.execute('BEGIN')
+            return self.writer.executemany(sql, params).rowcount
+
+    def close(self):
+        if self.writer is not None:
+            self.executor.submit(self.writer.close).result()
+        self.executor.shutdown(wait=True)
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def status(self, site, post_id):
+        row = self.conn.execute('SELECT status FROM posts WHERE site = ? AND post_id = ?', (site, post_id)).fetchone()
+        return row[0] if row else None
+
+    def has_file(self, site, file_name):
+        row = self.conn.execute('SELECT 1 FROM posts WHERE site = ? AND file_name = ? LIMIT 1', (site, file_name)).fetchone()
+        return row is not None
+
+    def is_done(self, site, post_id, file_name=None):
+        if self.status(site, post_id) == 'done':
+            return True
+        return file_name is not None and self.has_file(site, file_name)
+
+    def claim(self, site, post_id):
+        # 返回 False 表示该帖子已在下载中
+        key = (site, post_id)
+        if key in self.in_flight:
+            return False
+        self.in_flight.add(key)
+        return True
+
+    def release(self, site, post_id):
+        self.in_flight.discard((site, post_id))
+
+    def claim_md5(self, md5):
+        # 同一内容在不同 tag / 站点下同时被下载时只下载一次
+        if not self.claim('md5', md5):
+            return False
+        self.md5_events[md5] = asyncio.Event()
+        return True
+
+    def release_md5(self, md5):
+        self.release('md5', md5)
+        event = self.md5_events.pop(md5, None)
+        if event is not None:
+            event.set()
+
+    async def wait_md5(self, md5):
+        # 等待正在下载同一内容的 worker 结束
+        event = self.md5_events.get(md5)
+        if event is not None:
+            await event.wait()
+
+    async def record(self, site, post_id, md5=None, file_name=None, tag_line=None, variant=None, status='done', path=None):
+        await self._write(
+            self._execute,
+            'INSERT INTO posts (site, post_id, md5, file_name, tag_line, variant, path, status, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (site, post_id) DO UPDATE SET md5 = excluded.md5, file_name = excluded.file_name, '
+            'tag_line = excluded.tag_line, variant = excluded.variant, path = excluded.path, status = excluded.status, '
+            'updated_at = excluded.updated_at',
+            (site, post_id, md5, file_name, tag_line, variant, path, status, time.time()),
+        )
+
+    def find_md5(self, md5, variants=None):
+        # 任意站点已下载完成的同一内容，优先返回有本地文件路径的记录；
+        # variants 限定文件的尺寸版本，md5 相同的缩略图不能代替原图
+        if variants is None:
+            return self.conn.execute(
+                'SELECT site, post_id, tag_line, file_name, path FROM posts WHERE md5 = ? AND status = ? '
+                'ORDER BY path IS NULL LIMIT 1',
+                (md5, 'done'),
+            ).fetchone()
+        variants = list(variants)
+        return self.conn.execute(
+            'SELECT site, post_id, tag_line, file_name, path FROM posts WHERE md5 = ? AND status = ? '
+            f"AND variant IN ({','.join('?' * len(variants))}) ORDER BY path IS NULL LIMIT 1",
+            (md5, 'done', *variants),
+        ).fetchone()
+
+    def has_content(self, site, md5, tag_line):
+        # 这个 tag 是否已经有这份内容（自己下载的或引用的）
+        row = self.conn.execute(
+            'SELECT 1 FROM posts WHERE site = ? AND md5 = ? AND tag_line = ? AND status = ? '
+            'UNION ALL SELECT 1 FROM refs WHERE site = ? AND md5 = ? AND tag_line = ? LIMIT 1',
+            (site, md5, tag_line, 'done', site, md5, tag_line),
+        ).fetchone()
+        return row is not None
+
+    async def add_ref(self, site, post_id, md5, tag_line, path=None):
+        await self._write(
+            self._execute,
+            'INSERT OR REPLACE INTO refs (site, tag_line, md5, post_id, path, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (site, tag_line, md5, post_id, path, time.time()),
+        )
+
+    def move_paths(self, old_prefix, new_prefix):
+        # 合并 worker 输出后改写记录的本地路径，之后的去重链接仍能找到文件
+        old_prefix, new_prefix = str(old_prefix), str(new_prefix)
+        with self.conn:
+            for table in ('posts', 'refs'):
+                self.conn.execute(
+                    f'UPDATE {table} SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?',
+                    (new_prefix, len(old_prefix) + 1, len(old_prefix), old_prefix),
+                )
+
+    def needs_legacy_import(self, site):
+        return self.get_meta(f'legacy_imported:{site}') is None
+
+    async def import_legacy(self, site, file_names):
+        # 把旧版本按文件名去重时留下的文件导入清单，每个 site 只执行一次
+        if not self.needs_legacy_import(site):
+            return 0
+        await self._write(self._import_legacy, site, list(file_names))
+        return len(file_names)
+
+    def _import_legacy(self, site, file_names):
+        now = time.time()
+        with self.writer:
+            self.writer.execute('BEGIN')
+            self.writer.executemany(
+                'INSERT INTO posts (site, post_id, file_name, status, updated_at) VALUES (?, NULL, ?, ?, ?)',
+                ((site, name, 'done', now) for name in file_names),
+            )
+            self.writer.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (f'legacy_imported:{site}', str(now)))
+
+    def resume(self, site, job):
+        # 用上次保存的断点恢复 TagJob 的页码、已下载数量、增量抓取的帖子 id 和被拒绝的状态码，返回断点的保存时间（没有断点为 None）
+        row = self.conn.execute(
+            'SELECT page, page_offset, processed_count, exhausted, max_id, since_id, rejected, updated_at FROM checkpoints WHERE site = ? AND tag_line = ?',
+            (site, job.line),
+        ).fetchone()
+        if not row:
+            return None
+        page, job.offset, job.processed_count, exhausted, job.max_id, job.since_id, job.rejected, updated_at = row
+        job.page = int(page) if page.isdigit() else page
+        job.exhausted = bool(exhausted)
+        return updated_at
+
+    def max_post_id(self, site, tag_line):
+        # 旧版本的断点没有 max_id 时，用清单里该tag已有的最大帖子 id
+        row = self.conn.execute(
+            'SELECT MAX(post_id) FROM (SELECT post_id FROM posts WHERE site = ? AND tag_line = ? '
+            'UNION ALL SELECT post_id FROM refs WHERE site = ? AND tag_line = ?)',
+            (site, tag_line, site, tag_line),
+        ).fetchone()
+        return row[0]
+
+    async def checkpoint(self, site, job):
+        # 合并查询只保存各成员tag的数量；断点内容在调用时取值，之后 job 的变化不影响这次写入
+        now = time.time()
+        await self._write(
+            self._execute,
+            'INSERT OR REPLACE INTO checkpoints (site, tag_line, line_number, page, page_offset, processed_count, exhausted, max_id, since_id, rejected, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(site, j.line, j.line_number, str(j.page), j.offset, j.processed_count, int(j.exhausted), j.max_id, j.since_id, j.rejected, now) for j in job.members or [job]],
+            True,
+        )
+
+    def tag_info(self, site, names, max_age):
+        # 返回 max_age 秒内查询过的 tag: name -> (post_count, alias_of)
+        result = {}
+        names = list(names)
+        since = time.time() - max_age
+        for i in range(0, len(names), 500):
+            batch = names[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT name, post_count, alias_of FROM tag_info WHERE site = ? AND updated_at >= ? AND name IN ({','.join('?' * len(batch))})",
+                (site, since, *batch),
+            )
+            result.update((name, (post_count, alias_of)) for name, post_count, alias_of in rows)
+        return result
+
+    async def save_tag_info(self, site, info):
+        now = time.time()
+        await self._write(
+            self._execute,
+            'INSERT OR REPLACE INTO tag_info (site, name, post_count, alias_of, updated_at) VALUES (?, ?, ?, ?, ?)',
+            [(site, name, post_count, alias_of, now) for name, (post_count, alias_of) in info.items()],
+            True,
+        )
+
+    def report(self):
+        return self.conn.execute(
+            'SELECT site, status, COUNT(*) FROM posts GROUP BY site, status '
+            "UNION ALL SELECT site, 'linked', COUNT(*) FROM refs GROUP BY site ORDER BY 1, 2"
+        ).fetchall()
+
+    def tag_counts(self, site, status='done'):
+        return self.conn.execute(
+            'SELECT tag_line, COUNT(*) FROM posts WHERE site = ? AND status = ? AND tag_line IS NOT NULL '
+            'GROUP BY tag_line ORDER BY COUNT(*) DESC',
+            (site, status),
+        ).fetchall()
+
+
+if __name__ == "__main__":
+    # 用法: python manifest.py [manifest.db]
+    with Manifest(sys.argv[1] if len(sys.argv) > 1 else 'manifest.db') as manifest:
+        for site, status, count in manifest.report():
+            print(f"{site}\t{status}\t{count}")
@@ -0,0 +1,145 @@
+import csv
+import json
+import os
+import zipfile
+from pathlib import Path
+
+from manifest import Manifest
+from metadata_writer import METADATA_NAME
+from metrics import log, setup_logging
+from shards import INDEX_NAME
+from sinks import BUCKET_MANIFEST
+from workqueue import WORKER_PREFIX
+
+
+def shard_number(name):
+    return int(name.rsplit('-', 1)[1].split('.')[0])
+
+
+def remove_empty_dirs(path):
+    # 自底向上删除空文件夹，留下同名冲突没有搬走的文件
+    for root, dirs, files in os.walk(path, topdown=False):
+        if not os.listdir(root):
+            os.rmdir(root)
+
+
+def merge_folders(save_dir, manifest_path=None):
+    """把 save_dir 下各 worker 的 worker-<id> 文件夹合并进 save_dir：tag 文件夹里的文件搬到同名 tag 文件夹，
+    各tag的 metadata.jsonl 追加到同名tag的 metadata.jsonl，
+    tar 分片重新编号后加入 save_dir 的 shards.json，分桶清单追加到 save_dir 的 buckets.jsonl。
+
+    同名文件已存在时保留原文件，未下载完的 .part 文件删除；给出清单时改写其中记录的路径，之后的去重链接仍能找到文件。
+    只在所有 worker 都停止后运行。
+    """
+    save_dir = Path(save_dir)
+    manifest = Manifest(manifest_path) if manifest_path and os.path.exists(manifest_path) else None
+    index_path = save_dir / INDEX_NAME
+    index = json.loads(index_path.read_text(encoding='utf-8')) if index_path.exists() else []
+    try:
+        for worker in sorted(save_dir.glob(WORKER_PREFIX + '*')):
+            if not worker.is_dir():
+                continue
+            moved = skipped = 0
+            worker_index = worker / INDEX_NAME
+            if worker_index.exists():
+                for entry in json.loads(worker_index.read_text(encoding='utf-8')):
+                    number = max((shard_number(e['shard']) for e in index), default=-1) + 1
+                    name = f"{entry['shard'].rsplit('-', 1)[0]}-{number:06d}.tar"
+                    os.replace(worker / entry['shard'], save_dir / name)
+                    index.append(dict(entry, shard=name))
+                    if manifest is not None:
+                        # 清单里记录的分片内位置带着分片名，重新编号后一起改写
+                        manifest.move_paths((worker / entry['shard']).resolve(), (save_dir / name).resolve())
+                    moved += 1
+                tmp = index_path.with_name(INDEX_NAME + '.part')
+                tmp.write_text(json.dumps(index, ensure_ascii=False, indent=1), encoding='utf-8')
+                os.replace(tmp, index_path)
+                os.remove(worker_index)
+            worker_buckets = worker / BUCKET_MANIFEST
+            if worker_buckets.exists():
+                # 分桶清单里是相对路径，搬到 save_dir 后不变
+                with open(save_dir / BUCKET_MANIFEST, 'a', encoding='utf-8') as f:
+                    f.write(worker_buckets.read_text(encoding='utf-8'))
+                os.remove(worker_buckets)
+            for tag_dir in worker.iterdir():
+                if not tag_dir.is_dir() or tag_dir.name.startswith('.'):
+                    continue
+                target_dir = save_dir / tag_dir.name
+                target_dir.mkdir(exist_ok=True)
+                for file in tag_dir.iterdir():
+                    if file.suffix == '.part':
+                        # 被中断的下载，合并后路径变了也无法续传
+                        os.remove(file)
+                        continue
+                    if file.name == METADATA_NAME:
+                        with open(target_dir / METADATA_NAME, 'a', encoding='utf-8') as f:
+                            f.write(file.read_text(encoding='utf-8'))
+                        os.remove(file)
+                        continue
+                    if (target_dir / file.name).exists():
+                        skipped += 1
+                        continue
+                    os.replace(file, target_dir / file.name)
+                    moved += 1
+            if manifest is not None:
+                manifest.move_paths(worker.resolve(), save_dir.resolve())
+            remove_empty_dirs(worker)
+            log.info(f"已合并 {worker}: 搬移 {moved} 个文件，跳过 {skipped} 个同名文件")
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+
+def merge_archives(output_zip, csv_file):
+    """把各 worker 的 images.worker-<id>.zip / train.worker-<id>.csv 合并进 output_zip 和 csv_file，合并后删除。
+
+    压缩包里已有的同名文件不重复写入，CSV 行全部追加。只在所有 worker 都停止后运行。
+    """
+    output_zip, csv_file = Path(output_zip), Path(csv_file)
+    with zipfile.ZipFile(output_zip, 'a', zipfile.ZIP_DEFLATED) as target:
+        names = set(target.NameToInfo)
+        for part in sorted(output_zip.parent.glob(f"{output_zip.stem}.{WORKER_PREFIX}*{output_zip.suffix}")):
+            added = 0
+            with zipfile.ZipFile(part) as source:
+                for info in source.infolist():
+                    if info.filename in names:
+                        continue
+                    # 保留原来的压缩方式（图片为 STORED）
+                    target.writestr(info, source.read(info))
+                    names.add(info.filename)
+                    added += 1
+            os.remove(part)
+            log.info(f"已合并 {part}: {added} 个文件")
+
+    parts = sorted(csv_file.parent.glob(f"{csv_file.stem}.{WORKER_PREFIX}*{csv_file.suffix}"))
+    if not parts:
+        return
+    with open(csv_file, mode='a', newline='', encoding='utf-8') as out:
+        writer = None
+        for part in parts:
+            with open(part, mode='r', newline='', encoding='utf-8') as f:
+                reader = csv.DictReader(f)
+                if writer is None:
+                    writer = csv.DictWriter(out, fieldnames=reader.fieldnames)
+                    if out.tell() == 0:
+                        writer.writeheader()
+                rows = 0
+                for row in reader:
+                    writer.writerow(row)
+                    rows += 1
+            os.remove(part)
+            log.info(f"已合并 {part}: {rows} 行")
+
+
+if __name__ == "__main__":
+    # 所有 worker 停止后运行，把各 worker 的输出合并到同一个位置
+    save_dir = "downloaded_images" # for_lora_train.py / yandere.py 的 save_dir，合并其中的 worker-* 文件夹；None 跳过
+    manifest_path = None # 改写清单里记录的文件路径，None为 save_dir/manifest.db
+    output_zip = None # single_tag_crawler.py 的 output_zip 和 csv_file，例如 "images.zip"，合并 images.worker-*.zip 和 train.worker-*.csv；None 跳过
+    csv_file = "train.csv"
+
+    setup_logging('info')
+    if save_dir:
+        merge_folders(save_dir, manifest_path or Path(save_dir) / 'manifest.db')
+    if output_zip:
+        merge_archives(output_zip, csv_file)
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import log
+
+# 每个tag文件夹里的元数据文件，每行一个样本
+METADATA_NAME = 'metadata.jsonl'
+# 写入 metadata.jsonl 的样本字段，另外 tags 为完整的标签列表
+METADATA_FIELDS = ('id', 'md5', 'tag_line', 'rating', 'score', 'caption', 'tag_groups', 'bucket')
+
+
+def metadata_record(filename, sample):
+    record = {'file': filename.name}
+    record.update((key, sample[key]) for key in METADATA_FIELDS if sample.get(key) is not None)
+    record['tags'] = sample.get('tag_string', '').split()
+    return record
+
+
+class MetadataWriter:
+    """标注和元数据的写入阶段，运行在独立线程里，由队列供数据。
+
+    captions=True 时每张图旁边写同名 .txt 标注，jsonl=True 时每个tag文件夹追加一个 metadata.jsonl
+    （帖子 id、评级、分数、标注和完整的标签列表，同一文件出现多行时以最后一行为准）。
+    写入线程每次取出队列里已有的全部样本一起写，完成后一次性通知事件循环；metadata.jsonl 保持打开，
+    每 flush_every 行或每 flush_interval 秒 flush 一次，最多同时打开 max_open 个。
+    """
+
+    def __init__(self, captions=True, jsonl=False, flush_every=200, flush_interval=5.0, queue_size=256, max_open=64):
+        self.captions = captions
+        self.jsonl = jsonl
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.max_open = max_open
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.files = OrderedDict()
+        self.thread = None
+        self.written = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='metadata-writer', daemon=True)
+            self.thread.start()
+        return self
+
+    async def add(self, filename, sample):
+        """把一张图片（filename 为图片路径）的标注和元数据交给写入线程，写入完成后返回。"""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        item = (filename, sample, loop, done)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # 写入跟不上时在线程池里等待队列空位，不阻塞事件循环
+            await loop.run_in_executor(None, self.queue.put, item)
+        await done
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def _jsonl(self, directory):
+        f = self.files.get(directory)
+        if f is None:
+            if len(self.files) >= self.max_open:
+                _, oldest = self.files.popitem(last=False)
+                oldest.close()
+            f = self.files[directory] = open(directory / METADATA_NAME, 'a', encoding='utf-8')
+        else:
+            self.files.move_to_end(directory)
+        return f
+
+    def _write(self, filename, sample):
+        if self.captions:
+            with open(filename.with_suffix('.txt'), 'w', encoding='utf-8') as f:
+                f.write(sample['caption'])
+        if self.jsonl:
+            self._jsonl(filename.parent).write(json.dumps(metadata_record(filename, sample), ensure_ascii=False) + '\n')
+
+    def _flush(self):
+        for f in self.files.values():
+            f.flush()
+
+    def _run(self):
+        pending_rows = 0
+        last_flush = time.monotonic()
+        stop = False
+        while not stop:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            # 一次取出已经排队的全部样本
+            while len(batch) < self.queue.maxsize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            results = {}
+            for filename, sample, loop, done in batch:
+                if filename is None:
+                    stop = True
+                    continue
+                try:
+                    self._write(filename, sample)
+                    results.setdefault(loop, []).append((done, None))
+                    pending_rows += 1
+                    self.written += 1
+                except Exception as e:
+                    log.warning(f"写入标注失败: {e} - {filename}")
+                    results.setdefault(loop, []).append((done, e))
+            for loop, futures in results.items():
+                loop.call_soon_threadsafe(_resolve, futures)
+            if pending_rows and (pending_rows >= self.flush_every or time.monotonic() - last_flush >= self.flush_interval):
+                self._flush()
+                pending_rows = 0
+                last_flush = time.monotonic()
+        self._flush()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put((None, None, None, None))
+            self.thread.join()
+            self.thread = None
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _resolve(futures):
+    for future, exc in futures:
+        if future.done():
+            continue
+        if exc is None:
+            future.set_result(None)
+        else:
+            future.set_exception(exc)
@@ -0,0 +1,214 @@
+import asyncio
+import bisect
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
+
+# 所有模块共用的日志器，逐个文件的事件用 debug，逐个tag的进度用 info
+log = logging.getLogger('crawler')
+
+# 请求、下载、转换耗时(秒)的直方图分桶
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 单个文件下载速度(字节/秒)的直方图分桶
+RATE_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6)
+
+
+def setup_logging(level='info'):
+    """level: 'debug' 输出每个文件的事件，'info' 只输出每个tag的进度和汇总，'warning' 只输出失败。"""
+    if not log.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(level.upper() if isinstance(level, str) else level)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # 按分桶估算分位数（取所在桶的上界）
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """进程内的计数器、直方图和仪表，标签用关键字参数传入。
+
+    只在事件循环线程里更新，不加锁；仪表是在导出时才调用的函数（例如队列长度）。
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = self.key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def gauge(self, name, func, **labels):
+        self.gauges[self.key(name, labels)] = func
+
+    def remove_gauges(self, **labels):
+        # 一个站点抓取结束后去掉它的仪表，避免引用已关闭的队列
+        items = tuple(labels.items())
+        for key in [key for key in self.gauges if all(item in key[1] for item in items)]:
+            del self.gauges[key]
+
+    def install(self, session, client):
+        """通过 httpx 的 event_hooks 记录每个请求的响应头耗时和状态码，client 为 'api' 或 'cdn'。"""
+        started = WeakKeyDictionary()
+
+        async def on_request(request):
+            started[request] = time.monotonic()
+
+        async def on_response(response):
+            request = response.request
+            labels = {'client': client, 'host': request.url.host}
+            start = started.pop(request, None)
+            if start is not None:
+                self.observe('http_request_seconds', time.monotonic() - start, **labels)
+            self.inc('http_responses_total', status=str(response.status_code), **labels)
+
+        session.event_hooks['request'].append(on_request)
+        session.event_hooks['response'].append(on_response)
+        return session
+
+    def snapshot(self):
+        def name(key):
+            labels = ','.join(f'{k}={v}' for k, v in key[1])
+            return f'{key[0]}{{{labels}}}' if labels else key[0]
+
+        histograms = {}
+        for key, h in self.histograms.items():
+            histograms[name(key)] = {'count': h.count, 'sum': round(h.sum, 3), 'p50': h.quantile(0.5), 'p95': h.quantile(0.95)}
+        return {
+            'time': time.time(),
+            'uptime': round(time.time() - self.started, 1),
+            'counters': {name(key): value for key, value in self.counters.items()},
+            'gauges': {name(key): func() for key, func in self.gauges.items()},
+            'histograms': histograms,
+        }
+
+    def prometheus(self):
+        """Prometheus 文本格式。"""
+        def labels(pairs):
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+        lines = []
+        for (name, pairs), value in sorted(self.counters.items()):
+            lines.append(f'crawler_{name}{labels(pairs)} {value}')
+        for (name, pairs), func in sorted(self.gauges.items(), key=lambda item: item[0]):
+            lines.append(f'crawler_{name}{labels(pairs)} {func()}')
+        for (name, pairs), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+            total = 0
+            for bound, count in zip(h.buckets, h.counts):
+                total += count
+                lines.append(f'crawler_{name}_bucket{labels(pairs + (("le", bound),))} {total}')
+            lines.append(f'crawler_{name}_bucket{labels(pairs + (("le", "+Inf"),))} {h.count}')
+            lines.append(f'crawler_{name}_sum{labels(pairs)} {h.sum}')
+            lines.append(f'crawler_{name}_count{labels(pairs)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+
+# 进程内唯一的指标集合，各模块直接导入使用
+metrics = Metrics()
+
+
+class MetricsReporter:
+    """把 metrics 暴露给外部：port 不为 None 时在本机提供 Prometheus 格式的 /metrics，
+    path 不为 None 时每 interval 秒向该文件追加一行 JSON 快照（结束时再写一行）。
+    """
+
+    def __init__(self, port=None, path=None, interval=30.0, host='127.0.0.1'):
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.host = host
+        self.server = None
+        self.task = None
+
+    async def __aenter__(self):
+        if self.port is not None:
+            self.server = await asyncio.start_server(self._serve, self.host, self.port)
+            log.info(f"指标地址: http://{self.host}:{self.port}/metrics")
+        if self.path is not None:
+            self.task = asyncio.create_task(self._write_loop())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.write_snapshot()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def write_snapshot(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(metrics.snapshot(), ensure_ascii=False) + '\n')
+
+    async def _write_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.write_snapshot()
+
+    async def _serve(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # 读完请求头
+            while (await reader.readline()).strip():
+                pass
+            if request.split()[1:2] == [b'/metrics']:
+                status, body = '200 OK', metrics.prometheus().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('ascii') + body)
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
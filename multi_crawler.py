@@ -0,0 +1,59 @@
+import asyncio
+from engine import Crawl, CrawlEngine
+from sinks import FolderSink
+from sources import DanbooruSource, MoebooruSource
+from workqueue import default_worker_id, worker_dir
+
+async def main(crawls, manifest_path='manifest.db', convert_workers=None, jpeg_quality=95, dedupe='link', log_level='info', metrics_port=None, metrics_path=None):
+    # 所有站点在同一个进程里同时抓取，共享清单（跨站点 md5 去重）和图片转换进程池
+    engine = CrawlEngine(manifest_path, convert_workers, jpeg_quality, dedupe, log_level=log_level, metrics_port=metrics_port, metrics_path=metrics_path)
+    return await engine.run(crawls)
+
+if __name__ == "__main__":
+    txt_path = "artist_full.txt" # 每行一个tag，每个站点都按这个文件抓取
+    proxies = {"http://": 'http://127.0.0.1:7890', "https://": 'http://127.0.0.1:7890'}
+    metadata_format = "txt" # 标注和元数据: 'txt' / 'jsonl' / 'both'，见 for_lora_train.py
+    proxy_pool = None # 代理池: 多个代理地址的列表，设置后忽略 proxies，下面的并发和速率变为每个代理的值
+    manifest_path = "manifest.db" # 所有站点共享的清单
+    convert_workers = None # WebP转JPEG的进程数，None为CPU核数
+    jpeg_quality = 95
+    log_level = "info" # 日志级别: 'debug' 输出每个文件的事件，'info' 每个tag的进度，'warning' 只输出失败
+    metrics_port = None # 在本机该端口提供 Prometheus 格式的 /metrics，None 不开启
+    metrics_path = None # 每30秒向该文件追加一行 JSON 指标快照（耗时、字节数、队列长度、重试和跳过原因），None 不写
+    dedupe = "link" # 按md5去重: 'skip' / 'link' / None，见 for_lora_train.py
+    max_images = 50 # 每个站点每个tag最多爬的图片数
+    work_queue = None # 分布式抓取: 共享的工作队列文件或协调服务地址（每个站点一个队列），见 coordinator.py；结束后用 merge_workers.py 合并输出
+    worker_id = None # worker 名，输出写入各 save_dir/worker-<worker_id>；None为 主机名-进程号
+    max_restarts = 3 # 有标签行多次请求失败的站点最多重新启动几次；返回 4xx 的tag记入断点，不会重新启动
+    refresh_after = None # 增量模式: 已完成的tag距上次抓取超过多少秒时(例如 86400)只请求比上次更新的帖子(id:>N)；None 已完成的tag不再请求
+
+    worker_id = (worker_id or default_worker_id()) if work_queue else None
+
+    def output_dir(save_dir):
+        return worker_dir(save_dir, worker_id) if worker_id else save_dir
+
+    # 每个站点有自己的并发和速率预算，一个站点被限速时其他站点照常下载
+    crawls = [
+        Crawl(DanbooruSource(), FolderSink(output_dir("downloaded_images"), metadata_format), txt_path, max_images=max_images, proxies=proxies,
+              page_fetchers=4, download_workers=8, api_concurrency=2, cdn_concurrency=8, api_rate=5.0, cdn_rate=20.0,
+              listing_cache_path="downloaded_images/listing_cache.db", or_group_size=2, work_queue=work_queue, worker_id=worker_id, refresh_after=refresh_after, proxy_pool=proxy_pool,
+              quarantine_dir="downloaded_images/.quarantine"),
+        Crawl(MoebooruSource(), FolderSink(output_dir("./yande"), metadata_format), txt_path, max_images=max_images, proxies=proxies,
+              page_fetchers=5, download_workers=8, api_concurrency=2, cdn_concurrency=8, api_rate=2.0, cdn_rate=10.0,
+              listing_cache_path="./yande/listing_cache.db", work_queue=work_queue, worker_id=worker_id, refresh_after=refresh_after, proxy_pool=proxy_pool,
+              quarantine_dir="./yande/.quarantine"),
+    ]
+
+    for restart in range(max_restarts + 1):
+        failed = asyncio.run(main(crawls, manifest_path, convert_workers, jpeg_quality, dedupe, log_level, metrics_port, metrics_path))
+        # 只重新启动有失败标签行的站点，各tag从断点继续
+        crawls = [crawl for crawl, lines in zip(crawls, failed) if lines]
+        if not crawls:
+            break
+        if restart == max_restarts:
+            for crawl in crawls:
+                print(f"[{crawl.site}] 第 {crawl.failed_lines[0]} 行等标签行重新启动 {max_restarts} 次后仍然失败，已保存断点，下次运行继续")
+            break
+        for crawl in crawls:
+            crawl.start_line = crawl.failed_lines[0]
+            print(f"[{crawl.site}] 将在第 {crawl.start_line} 行重新启动")
@@ -0,0 +1,69 @@
+from urllib.parse import urlencode
+
+# 各站点单次请求允许的最大条数
+DANBOORU_MAX_LIMIT = 200
+MOEBOORU_MAX_LIMIT = 100
+# cursor 模式下按剩余所需数量缩小 limit，但不小于这个值，避免被跳过的帖子拖出很多小请求
+MIN_LIMIT = 20
+
+
+class Pagination:
+    """帖子列表的翻页方式。
+
+    mode='cursor' 按帖子 id 做键集翻页（Danbooru 的 page=b<id>，Moebooru 的 id:<N 标签），
+    深翻页不会变慢，也不受数字页数上限限制；mode='page' 是原来的 page=1,2,3...。
+    job.page 保存当前位置：page 模式为页码，cursor 模式为 'b<上一条已处理帖子的 id>'（从头开始时为页码 1）。
+    """
+
+    def __init__(self, endpoint, limit, mode='cursor', cursor_param='page'):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.mode = mode
+        # 'page': Danbooru 风格 page=b<id>；'tag': Moebooru 风格在 tags 里加 id:<N
+        self.cursor_param = cursor_param
+
+    def cursor(self, job):
+        # page 模式留下的数字页码在 cursor 模式下视为从头开始
+        if self.mode == 'cursor' and isinstance(job.page, str) and job.page.startswith('b'):
+            return int(job.page[1:])
+        return None
+
+    def url(self, job, tags):
+        if self.mode == 'page':
+            if not isinstance(job.page, int):
+                job.page, job.offset = 1, 0
+            params = {'limit': self.limit, 'page': job.page, 'tags': tags}
+        else:
+            remaining = job.max_images - job.processed_count
+            params = {'limit': min(self.limit, max(remaining, MIN_LIMIT)), 'tags': tags}
+            cursor = self.cursor(job)
+            if cursor is not None:
+                if self.cursor_param == 'page':
+                    params['page'] = f"b{cursor}"
+                else:
+                    params['tags'] = f"{tags} id:<{cursor}"
+        return f"{self.endpoint}?{urlencode(params)}"
+
+    def advance(self, job, data, index):
+        # data[:index] 已经处理完，把断点移到第 index 条之前
+        if self.mode == 'page':
+            if index < len(data):
+                job.offset = index
+            else:
+                job.page += 1
+                job.offset = 0
+        elif index > 0:
+            job.page = f"b{data[index - 1]['id']}"
+            job.offset = 0
+
+    def start(self, job):
+        # cursor 模式下每次请求都从断点之后开始，不需要页内偏移
+        return job.offset if self.mode == 'page' else 0
+
+
+def danbooru(base_url='https://kagamihara.donmai.us', limit=DANBOORU_MAX_LIMIT, mode='cursor'):
+    return Pagination(f"{base_url}/posts.json", min(limit, DANBOORU_MAX_LIMIT), mode, 'page')
+
+
+def moebooru(base_url='https://yande.re', limit=MOEBOORU_MAX_LIMIT, mode='cursor'):
+    return Pagination(f"{base_url}/post.json", min(limit, MOEBOORU_MAX_LIMIT), mode, 'tag')
@@ -0,0 +1,239 @@
+import asyncio
+from collections import deque
+
+from metrics import log
+
+
+class TagJob:
+    # 一个标签行的抓取状态，生产者（翻页）和消费者（下载）共享
+    def __init__(self, line, line_number, max_images):
+        self.line = line
+        self.line_number = line_number
+        self.max_images = max_images
+        self.processed_count = 0
+        self.pending = 0
+        self.changed = asyncio.Condition()
+        # 断点信息：下一次要请求的页及页内已处理的条数、是否已翻到最后一页、是否因请求失败而中止
+        self.page = 1
+        self.offset = 0
+        self.exhausted = False
+        self.failed = False
+        # 列表请求返回 4xx 等重试也不会成功的状态码时记下状态码，该tag不再请求
+        self.rejected = None
+        # 规划阶段查到的帖子总数（未知为 None）和本次已翻过的帖子数
+        self.post_count = None
+        self.seen = 0
+        # 合并查询（TagGroup）的成员，普通tag为空
+        self.members = []
+        # 增量抓取：翻页时见到的最大帖子 id，以及本次只请求 id 大于 since_id 的帖子（None 为全部）
+        self.max_id = None
+        self.since_id = None
+
+    def finished(self):
+        return self.processed_count >= self.max_images
+
+    def wanted(self):
+        # 已完成 + 正在下载的数量不足 max_images 时才继续入队
+        return self.processed_count + self.pending < self.max_images
+
+    def complete(self):
+        return self.exhausted or self.finished() or self.rejected is not None
+
+    def query(self):
+        return self.line.strip().replace(' ', '_')
+
+    def search(self):
+        # 列表请求的 tags 参数，增量抓取时加上 id:>since_id
+        if self.since_id is not None:
+            return f"{self.query()} id:>{self.since_id}"
+        return self.query()
+
+    def route(self, item):
+        # 帖子应该计入哪些 TagJob
+        return [self]
+
+    def saw(self, item):
+        post_id = item.get('id')
+        if isinstance(post_id, int) and (self.max_id is None or post_id > self.max_id):
+            self.max_id = post_id
+
+    def refresh(self, since_id):
+        # 已完成的tag重新抓取上次之后的新帖子，数量重新计算
+        self.since_id = since_id
+        if since_id is not None and (self.max_id is None or since_id > self.max_id):
+            self.max_id = since_id
+        self.page, self.offset = 1, 0
+        self.processed_count = 0
+        self.exhausted = False
+
+    def restart(self):
+        # 还没有翻页进度时会从列表开头翻页，已下载过的帖子会经清单重新计数（例如之前属于合并查询的tag）
+        if self.page == 1 and not self.offset:
+            self.processed_count = 0
+
+    def listed(self, count):
+        # 已翻过的帖子数达到 post_count 时说明列表已经翻完，不必再请求一个空页
+        self.seen += count
+        return self.post_count is not None and self.seen >= self.post_count
+
+    async def settled(self):
+        # 等待该tag已入队的帖子全部处理完
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.pending == 0)
+
+
+class TagGroup(TagJob):
+    """几个帖子很少的tag合成一个 OR 查询（~a ~b ...）一起翻页。
+
+    返回的帖子按 tag_string 分给对应的成员 TagJob，max_images 和下载计数按成员分别记录。
+    合并的都是帖子合计不超过一页的tag，所以不保存合并查询自己的翻页断点，每次运行从头翻页，
+    已下载的帖子经清单重新计数。
+    """
+
+    def __init__(self, members):
+        # 父类初始化时会通过下面的 property 写入成员
+        self.members = members
+        super().__init__(' '.join('~' + member.query() for member in members), min(member.line_number for member in members), sum(member.max_images for member in members))
+        self.members = members
+        self.post_count = sum(member.post_count or 0 for member in members)
+
+    @property
+    def processed_count(self):
+        return sum(member.processed_count for member in self.members)
+
+    @processed_count.setter
+    def processed_count(self, value):
+        # 数量只记录在成员上
+        pass
+
+    @property
+    def exhausted(self):
+        return self._exhausted
+
+    @exhausted.setter
+    def exhausted(self, value):
+        self._exhausted = value
+        if value:
+            # 已达到 max_images 的成员可能有帖子被跳过，不标记为翻完
+            for member in self.members:
+                if not member.finished():
+                    member.exhausted = True
+
+    @property
+    def failed(self):
+        return self._failed
+
+    @failed.setter
+    def failed(self, value):
+        self._failed = value
+        for member in self.members:
+            member.failed = value
+
+    def finished(self):
+        return all(member.finished() for member in self.members)
+
+    def wanted(self):
+        return any(member.wanted() for member in self.members)
+
+    def query(self):
+        return self.line
+
+    def route(self, item):
+        tags = set(str(item.get('tag_string') or item.get('tags') or '').lower().split())
+        return [member for member in self.members if member.query().lower() in tags]
+
+    def saw(self, item):
+        for member in self.route(item):
+            member.saw(item)
+
+    def restart(self):
+        if self.page == 1 and not self.offset:
+            for member in self.members:
+                member.processed_count = 0
+
+    async def settled(self):
+        for member in self.members:
+            await member.settled()
+
+
+class CrawlPipeline:
+    """翻页任务把帖子放进有界队列，固定数量的下载 worker 从队列中取出并处理。
+
+    handle_item(job, item) 是各脚本自己的下载逻辑，返回 True 表示计入该tag的数量。
+    API 请求和 CDN 下载分别由 api_limit / cdn_limit 两个信号量限制并发。
+    """
+
+    def __init__(self, handle_item, download_workers=8, queue_size=100, api_concurrency=2, cdn_concurrency=8):
+        self.handle_item = handle_item
+        self.download_workers = download_workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.api_limit = asyncio.Semaphore(api_concurrency)
+        self.cdn_limit = asyncio.Semaphore(cdn_concurrency)
+
+    async def put(self, job, item):
+        # 返回 False 表示该tag（合并查询时为全部成员tag）已经达到 max_images，生产者应停止翻页
+        targets = [target for target in job.route(item) if await self._reserve(target)]
+        if targets:
+            # 属于多个成员tag的帖子只入队一次，由同一个下载 worker 依次处理：第一个成员下载，其余的经清单引用。
+            # 队列满时在这里阻塞，翻页速度被下载速度反压
+            await self.queue.put((targets, item))
+        return not job.finished()
+
+    async def _reserve(self, job):
+        async with job.changed:
+            await job.changed.wait_for(lambda: job.finished() or job.wanted())
+            if job.finished():
+                return False
+            job.pending += 1
+        return True
+
+    async def _download_worker(self):
+        while True:
+            jobs, item = await self.queue.get()
+            try:
+                for job in jobs:
+                    success = False
+                    try:
+                        async with self.cdn_limit:
+                            success = await self.handle_item(job, item)
+                    except Exception as e:
+                        log.error(f"处理异常: {e} - 第 {job.line_number} 行: {job.line}")
+                    finally:
+                        async with job.changed:
+                            job.pending -= 1
+                            if success:
+                                job.processed_count += 1
+                            job.changed.notify_all()
+            finally:
+                self.queue.task_done()
+
+    async def _page_fetcher(self, next_job, produce):
+        while (job := await next_job()) is not None:
+            job.restart()
+            try:
+                await produce(job)
+            except Exception as e:
+                log.error(f"翻页异常: {e} - 第 {job.line_number} 行: {job.line}")
+                job.failed = True
+
+    async def run(self, jobs, produce, page_fetchers=4):
+        """produce(job) 负责翻页并调用 put()。
+
+        jobs 是 TagJob 列表，或者每次返回下一个 TagJob、没有更多时返回 None 的协程函数（从工作队列按需租约时）。
+        """
+        if callable(jobs):
+            next_job = jobs
+        else:
+            job_queue = deque(jobs)
+
+            async def next_job():
+                return job_queue.popleft() if job_queue else None
+
+        workers = [asyncio.create_task(self._download_worker()) for _ in range(self.download_workers)]
+        try:
+            await asyncio.gather(*(self._page_fetcher(next_job, produce) for _ in range(page_fetchers)))
+            await self.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
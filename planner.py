@@ -0,0 +1,126 @@
+import asyncio
+from urllib.parse import urlencode
+
+from metrics import metrics, log
+from pipeline import TagGroup
+from ratelimit import retryable, backoff_delay
+
+# 每次请求查询的 tag 数（Danbooru 单次最多返回 1000 条）
+TAG_BATCH = 100
+# Danbooru 普通用户一次搜索最多 2 个 tag（Gold 6，Platinum 12），OR 查询的每个 ~tag 都计入
+OR_GROUP_SIZE = 2
+
+
+def tag_name(line):
+    # 与 process_line 中拼接查询的方式一致
+    return line.strip().replace(' ', '_').lower()
+
+
+async def fetch_json(session, url, max_retries=5):
+    for attempt in range(1, max_retries + 1):
+        try:
+            response = await session.get(url)
+            if response.status_code == 200:
+                return response.json()
+            if not retryable(response.status_code):
+                log.warning(f"请求失败 (状态码 {response.status_code}): {url}")
+                return None
+            log.info(f"请求失败 (状态码 {response.status_code}, 尝试 {attempt}/{max_retries}): {url}")
+            metrics.inc('retries_total', stage='plan', status=str(response.status_code))
+        except Exception as e:
+            log.info(f"请求异常 (尝试 {attempt}/{max_retries}): {e} - {url}")
+            metrics.inc('retries_total', stage='plan', status=type(e).__name__)
+        await asyncio.sleep(backoff_delay(attempt))
+    return None
+
+
+async def lookup_tags(session, base_url, names, batch_size=TAG_BATCH):
+    """批量查询 Danbooru tag 的 post_count 和别名，返回 name -> (post_count, alias_of)。
+
+    查询失败的批次不出现在结果里（按未知处理，不会被跳过）。
+    """
+    info = {}
+    for i in range(0, len(names), batch_size):
+        batch = names[i:i + batch_size]
+        params = {'search[name_comma]': ','.join(batch), 'limit': len(batch), 'only': 'name,post_count'}
+        tags = await fetch_json(session, f"{base_url}/tags.json?{urlencode(params)}")
+        if tags is None:
+            continue
+        counts = {tag['name']: tag['post_count'] for tag in tags}
+        empty = [name for name in batch if not counts.get(name)]
+        aliases = {}
+        if empty:
+            # 帖子数为 0 的 tag 可能只是别名
+            params = {'search[antecedent_name_comma]': ','.join(empty), 'search[status]': 'active', 'limit': len(empty), 'only': 'antecedent_name,consequent_name'}
+            rows = await fetch_json(session, f"{base_url}/tag_aliases.json?{urlencode(params)}") or []
+            aliases = {row['antecedent_name']: row['consequent_name'] for row in rows}
+        for name in batch:
+            info[name] = (counts.get(name, 0), aliases.get(name))
+        log.info(f"已查询 tag 信息: {min(i + batch_size, len(names))}/{len(names)}")
+    return info
+
+
+async def plan_jobs(session, jobs, manifest, site, base_url, ttl=86400, order='largest', batch_size=TAG_BATCH):
+    """翻页之前的规划阶段：批量取得每个 tag 的 post_count，去掉没有帖子或已被别名的 tag，
+    并按帖子数排序（'largest' 大的先开始，长尾可以和它们重叠；'smallest'；None 保持文件顺序）。
+
+    结果保存在清单的 tag_info 表里，ttl 秒内不再重复查询。
+    """
+    # 名字里带逗号的 tag 不能用 name_comma 查询，保持未知
+    names = sorted({tag_name(job.line) for job in jobs} - {''})
+    names = [name for name in names if ',' not in name]
+    info = manifest.tag_info(site, names, ttl)
+    missing = [name for name in names if name not in info]
+    if missing:
+        fetched = await lookup_tags(session, base_url, missing, batch_size)
+        await manifest.save_tag_info(site, fetched)
+        info.update(fetched)
+
+    planned = []
+    for job in jobs:
+        post_count, alias_of = info.get(tag_name(job.line), (None, None))
+        if alias_of:
+            log.info(f"跳过第 {job.line_number} 行: {job.line} 是 {alias_of} 的别名")
+            continue
+        if post_count == 0:
+            log.info(f"跳过第 {job.line_number} 行: {job.line} 没有帖子")
+            continue
+        job.post_count = post_count
+        planned.append(job)
+
+    if order:
+        # 帖子数未知的 tag 排在最后
+        known = [job for job in planned if job.post_count is not None]
+        unknown = [job for job in planned if job.post_count is None]
+        known.sort(key=lambda job: min(job.post_count, job.max_images), reverse=order == 'largest')
+        planned = known + unknown
+    log.info(f"规划完成: {len(planned)}/{len(jobs)} 个标签行需要翻页，跳过 {len(jobs) - len(planned)} 个")
+    return planned
+
+
+def group_jobs(jobs, group_size=OR_GROUP_SIZE, page_limit=200):
+    """把帖子总数合计不超过一页的小 tag 合成 OR 查询，一次请求覆盖几个 tag。
+
+    只合并 plan_jobs() 查到了 post_count 的 tag；增量抓取的 tag 各自有 id:>N 条件，不合并。
+    """
+    if group_size < 2:
+        return jobs
+    small = [job for job in jobs if job.post_count is not None and job.post_count <= page_limit and job.since_id is None]
+    grouped = []
+    current = []
+    total = 0
+    for job in sorted(small, key=lambda job: job.line_number):
+        if current and (len(current) >= group_size or total + job.post_count > page_limit):
+            grouped.append(current)
+            current, total = [], 0
+        current.append(job)
+        total += job.post_count
+    if current:
+        grouped.append(current)
+
+    groups = [TagGroup(members) for members in grouped if len(members) > 1]
+    merged = {id(job) for group in groups for job in group.members}
+    result = [job for job in jobs if id(job) not in merged] + groups
+    if groups:
+        log.info(f"合并查询: {len(merged)} 个小tag合成 {len(groups)} 个 OR 查询")
+    return result
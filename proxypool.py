@@ -0,0 +1,201 @@
+import asyncio
+import time
+from collections import deque
+
+import httpx
+
+from metrics import log
+from ratelimit import RateLimiter, retryable
+
+# 连续失败（连接错误、超时、代理认证失败）多少次后暂时剔除该代理
+MAX_FAILURES = 3
+# 剔除多少秒后重新启用；重新启用后再失败一次就再次剔除
+COOLDOWN = 60.0
+# 延迟的指数滑动平均系数
+LATENCY_ALPHA = 0.2
+# 这些状态码由代理本身返回，说明出口不可用
+PROXY_STATUS = {407}
+
+
+class Proxy:
+    """池里的一个出口：滚动的响应延迟和错误率、连续失败次数和剔除状态，API 和 CDN 两个 transport 共用。"""
+
+    def __init__(self, url, window=50):
+        self.url = url
+        # 收到响应头的时间（秒），还没有测到时为 None，会被优先尝试
+        self.latency = None
+        self.outcomes = deque(maxlen=window)
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.active = 0
+
+    def available(self, now):
+        return now >= self.ejected_until
+
+    def error_rate(self):
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def score(self):
+        # 预计的等待时间，越小越好：延迟 × 排在前面的请求数，按错误率放大；
+        # 没有测到延迟时取一个很小的值，还没有成功过的代理失败后也会被降低优先级
+        latency = max(self.latency or 0.0, 0.01)
+        return latency * (1 + self.active) / max(0.1, 1 - self.error_rate())
+
+
+class ProxyPool:
+    """多个代理出口组成的池，每个请求交给当前最健康的代理。
+
+    每个代理有自己的连接池和并发上限（transport() 的 connections 是每个代理的值）以及自己的限速器（rates 和
+    default_rate 是每个代理的请求/秒），总吞吐量随代理数量增加。按滚动的延迟、错误率和正在处理的请求数选择代理，
+    连续失败 max_failures 次的代理剔除 cooldown 秒后再重新启用。
+    """
+
+    def __init__(self, urls, rates=None, default_rate=10.0, max_failures=MAX_FAILURES, cooldown=COOLDOWN):
+        self.proxies = [Proxy(url) for url in dict.fromkeys(urls)]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        # 429/503 通常是按出口 IP 限速的，每个代理各自按 AIMD 调整速率
+        self.limiters = {proxy.url: RateLimiter(rates, default_rate) for proxy in self.proxies}
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def transport(self, connections, http2=False, keepalive_expiry=30.0):
+        return ProxyTransport(self, connections, http2, keepalive_expiry)
+
+    def rate(self, host):
+        # 所有代理对该 host 的速率之和
+        return sum(limiter.host(host).rate for limiter in self.limiters.values())
+
+    def healthy(self):
+        now = time.monotonic()
+        return sum(1 for proxy in self.proxies if proxy.available(now))
+
+    def choose(self, candidates, host):
+        """在 candidates（有空闲连接的代理）里选分数最低的；全部被剔除时选最早到期的一个试探。"""
+        now = time.monotonic()
+        available = [proxy for proxy in candidates if proxy.available(now)]
+        if available:
+            # 正在被该 host 限速暂停的代理加上剩余的暂停时间
+            return min(available, key=lambda p: p.score() + max(0.0, self.limiters[p.url].host(host).blocked_until - now))
+        proxy = min(candidates, key=lambda p: p.ejected_until)
+        self.readmit(proxy)
+        return proxy
+
+    def readmit(self, proxy):
+        log.info(f"重新启用代理: {proxy.url}")
+        proxy.ejected_until = 0.0
+        # 半开状态：再失败一次就再次剔除
+        proxy.failures = self.max_failures - 1
+
+    def success(self, proxy, latency, status_code):
+        error = retryable(status_code)
+        proxy.outcomes.append(error)
+        proxy.latency = latency if proxy.latency is None else proxy.latency + LATENCY_ALPHA * (latency - proxy.latency)
+        if status_code in PROXY_STATUS:
+            self.failure(proxy, f"状态码 {status_code}")
+        elif not error:
+            proxy.failures = 0
+
+    def failure(self, proxy, reason):
+        proxy.outcomes.append(True)
+        proxy.failures += 1
+        if proxy.failures >= self.max_failures and proxy.available(time.monotonic()):
+            proxy.ejected_until = time.monotonic() + self.cooldown
+            log.warning(f"代理连续失败 {proxy.failures} 次，剔除 {self.cooldown:.0f} 秒: {proxy.url} ({reason})")
+
+    def check(self):
+        # 剔除时间已到的代理恢复为半开状态
+        now = time.monotonic()
+        for proxy in self.proxies:
+            if proxy.ejected_until and proxy.available(now):
+                self.readmit(proxy)
+
+
+class _PooledStream(httpx.AsyncByteStream):
+    """包装代理返回的响应体：读取中的网络错误计入该代理，关闭时归还并发名额。"""
+
+    def __init__(self, stream, pool, proxy, release):
+        self.stream = stream
+        self.pool = pool
+        self.proxy = proxy
+        self.release = release
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                yield chunk
+        except httpx.TransportError as e:
+            self.pool.failure(self.proxy, type(e).__name__)
+            raise
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.release()
+
+
+class ProxyTransport(httpx.AsyncBaseTransport):
+    """httpx 的 transport：每个代理一个 AsyncHTTPTransport（各自的连接池）和 connections 个并发名额，
+    请求在有空闲名额的代理里按 ProxyPool.choose() 分配，响应体读完或关闭后才归还名额。
+    """
+
+    def __init__(self, pool, connections, http2=False, keepalive_expiry=30.0):
+        self.pool = pool
+        self.connections = connections
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections, keepalive_expiry=keepalive_expiry)
+        self.transports = {proxy.url: httpx.AsyncHTTPTransport(proxy=proxy.url, limits=limits, http2=http2) for proxy in pool.proxies}
+        self.active = {proxy.url: 0 for proxy in pool.proxies}
+        self.freed = asyncio.Event()
+
+    async def _take(self, host):
+        while True:
+            self.pool.check()
+            free = [proxy for proxy in self.pool.proxies if self.active[proxy.url] < self.connections]
+            if free:
+                proxy = self.pool.choose(free, host)
+                self.active[proxy.url] += 1
+                proxy.active += 1
+                return proxy
+            # 所有代理的名额都在用，等有请求结束
+            self.freed.clear()
+            await self.freed.wait()
+
+    def _release(self, proxy):
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.active[proxy.url] -= 1
+            proxy.active -= 1
+            self.freed.set()
+
+        return release
+
+    async def handle_async_request(self, request):
+        proxy = await self._take(request.url.host)
+        release = self._release(proxy)
+        try:
+            limiter = self.pool.limiters[proxy.url].host(request.url.host)
+            await limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = await self.transports[proxy.url].handle_async_request(request)
+            except httpx.TransportError as e:
+                self.pool.failure(proxy, type(e).__name__)
+                raise
+            limiter.observe(response.status_code, response.headers.get('Retry-After'))
+            self.pool.success(proxy, time.monotonic() - start, response.status_code)
+        except BaseException:
+            release()
+            raise
+        response.stream = _PooledStream(response.stream, self.pool, proxy, release)
+        return response
+
+    async def aclose(self):
+        for transport in self.transports.values():
+            await transport.aclose()
@@ -0,0 +1,113 @@
+import asyncio
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+# 这些状态码说明服务器暂时不可用或在限流，值得稍后重试
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+# 这些状态码说明请求太快，需要立即降速
+THROTTLE_STATUS = {429, 503}
+
+
+def retryable(status_code):
+    return status_code in RETRY_STATUS
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    # 指数退避 + full jitter，避免大量请求在同一时刻一起重试
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """单个 host 的令牌桶，速率根据最近的响应自适应调整（AIMD）。
+
+    成功时线性提高速率，收到 429/503 时减半并按 Retry-After 暂停整个 host，其他可重试错误
+    小幅降速；最近窗口内错误率过高时不再提速，最终稳定在略低于服务器上限的位置。
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.2, max_rate=None, window=50, max_error_rate=0.1):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 4
+        self.max_error_rate = max_error_rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.outcomes = deque(maxlen=window)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def error_rate(self):
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def observe(self, status_code, retry_after=None):
+        error = retryable(status_code)
+        self.outcomes.append(error)
+        if status_code in THROTTLE_STATUS:
+            self.rate = max(self.min_rate, self.rate / 2)
+            pause = parse_retry_after(retry_after)
+            if pause is None:
+                pause = 1 / self.rate
+            self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+        elif error:
+            self.rate = max(self.min_rate, self.rate * 0.9)
+        elif self.error_rate() <= self.max_error_rate:
+            # 每次成功增加的速率与当前速率成反比，大约每秒增加 0.1 req/s
+            self.rate = min(self.max_rate, self.rate + 0.1 / self.rate)
+
+
+class RateLimiter:
+    """按 host 分别限速，通过 httpx 的 event_hooks 作用在同一 client 的所有请求（包括流式下载）上。
+
+    rates 指定各 host 的初始速率（请求/秒），未列出的 host（通常是 CDN）使用 default_rate。
+    """
+
+    def __init__(self, rates=None, default_rate=10.0, **limiter_options):
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.limiter_options = limiter_options
+        self.hosts = {}
+
+    def host(self, host):
+        limiter = self.hosts.get(host)
+        if limiter is None:
+            limiter = self.hosts[host] = HostLimiter(self.rates.get(host, self.default_rate), **self.limiter_options)
+        return limiter
+
+    async def on_request(self, request):
+        await self.host(request.url.host).acquire()
+
+    async def on_response(self, response):
+        self.host(response.request.url.host).observe(response.status_code, response.headers.get('Retry-After'))
+
+    def install(self, session):
+        session.event_hooks['request'].append(self.on_request)
+        session.event_hooks['response'].append(self.on_response)
+        return session
@@ -0,0 +1,187 @@
+import asyncio
+import io
+import json
+import os
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import log
+
+INDEX_NAME = 'shards.json'
+# 大块顺序写，减少系统调用
+WRITE_BUFFER = 8 * 1024 * 1024
+
+
+class ShardWriter:
+    """把图片 + 标注按 WebDataset 布局顺序写入固定大小的 tar 分片。
+
+    每个样本是同名前缀的一组文件（<key>.jpg / <key>.txt / <key>.json），分片写满 max_samples 个样本
+    或 max_bytes 字节后换下一个。正在写的分片名为 *.tar.part，写完才改名，训练端只会看到完整的分片；
+    shards.json 记录每个分片的样本数、字节数和各标签行的样本数。所有写操作都在一个单独的线程里顺序执行。
+    add() 在样本 flush 并 fsync 到 .part 之后才返回，调用方随后在清单里记为已完成，异常退出后由 _recover() 找回；
+    同时写入的多个样本合并成一次 fsync。add() 返回各文件在分片里的位置（见 read_ref()），写进清单供之后去重引用。
+    """
+
+    def __init__(self, out_dir, prefix='shard', max_samples=1000, max_bytes=1024 ** 3):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.max_samples = max_samples
+        self.max_bytes = max_bytes
+        self.index_path = self.out_dir / INDEX_NAME
+        self.index = json.loads(self.index_path.read_text(encoding='utf-8')) if self.index_path.exists() else []
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shard-writer')
+        self.tar = None
+        self.current = None
+        # 有还没有 fsync 的样本
+        self.dirty = False
+        self._recover()
+
+    def _shard_name(self, number):
+        return f"{self.prefix}-{number:06d}.tar"
+
+    def _next_number(self):
+        numbers = [int(entry['shard'].rsplit('-', 1)[1].split('.')[0]) for entry in self.index]
+        return max(numbers, default=-1) + 1
+
+    def _open(self):
+        name = self._shard_name(self._next_number())
+        self.fileobj = open(self.out_dir / (name + '.part'), 'wb', buffering=WRITE_BUFFER)
+        self.tar = tarfile.open(fileobj=self.fileobj, mode='w', format=tarfile.PAX_FORMAT)
+        self.current = {'shard': name, 'samples': 0, 'bytes': 0, 'tags': {}}
+        # 写满改名后的路径，记在样本位置里
+        self.shard_path = (self.out_dir / name).resolve()
+
+    def _close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        # 改名之前连同 tar 结尾一起落盘
+        self.dirty = True
+        self._sync()
+        self.fileobj.close()
+        name = self.current['shard']
+        part = self.out_dir / (name + '.part')
+        if self.current['samples']:
+            os.replace(part, self.out_dir / name)
+            self.index.append(self.current)
+            self._save_index()
+        else:
+            os.remove(part)
+        self.tar = None
+        self.current = None
+
+    def _sync(self):
+        if self.dirty:
+            self.fileobj.flush()
+            os.fsync(self.fileobj.fileno())
+            self.dirty = False
+
+    def _save_index(self):
+        tmp = self.index_path.with_name(INDEX_NAME + '.part')
+        tmp.write_text(json.dumps(self.index, ensure_ascii=False, indent=1), encoding='utf-8')
+        os.replace(tmp, self.index_path)
+
+    def _recover(self):
+        # 上次异常退出留下的 .part 分片：把其中完整的样本搬进新的分片，避免清单里记为已完成的样本丢失。
+        # 新分片可能与旧的 .part 同名，先改名为 .recover，全部搬完并落盘后才删除
+        for part in self.out_dir.glob(f"{self.prefix}-*.tar.part"):
+            os.replace(part, part.with_suffix('.recover'))
+        recovered = sorted(self.out_dir.glob(f"{self.prefix}-*.tar.recover"))
+        for part in recovered:
+            samples = {}
+            try:
+                with tarfile.open(part, mode='r:') as tar:
+                    for member in tar:
+                        key, _, ext = member.name.partition('.')
+                        samples.setdefault(key, {})[ext] = tar.extractfile(member).read()
+            except (tarfile.TarError, OSError):
+                pass
+            for key, files in samples.items():
+                if 'txt' in files and len(files) >= 2:
+                    meta = json.loads(files['json']) if 'json' in files else {}
+                    self._write(key, files, meta.get('tag_line'))
+            log.info(f"已恢复未完成的分片: {part}")
+        if recovered:
+            self._sync()
+            for part in recovered:
+                os.remove(part)
+
+    def _write(self, key, files, tag_line=None):
+        if self.tar is None:
+            self._open()
+        now = time.time()
+        size = 0
+        refs = {}
+        for ext, content in files.items():
+            info = tarfile.TarInfo(f"{key}.{ext}")
+            info.mtime = now
+            if isinstance(content, Path):
+                info.size = content.stat().st_size
+                with open(content, 'rb') as f:
+                    self.tar.addfile(info, f)
+                os.remove(content)
+            else:
+                if isinstance(content, str):
+                    content = content.encode('utf-8')
+                info.size = len(content)
+                self.tar.addfile(info, io.BytesIO(content))
+            size += info.size
+            # 写完后 offset 在补齐到块大小的数据之后，数据前面紧挨着的一块是它的 ustar 头
+            padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            refs[ext] = f"{self.shard_path}#{info.name}@{self.tar.offset - padded - tarfile.BLOCKSIZE}"
+        self.dirty = True
+        self.current['samples'] += 1
+        self.current['bytes'] += size
+        if tag_line is not None:
+            self.current['tags'][tag_line] = self.current['tags'].get(tag_line, 0) + 1
+        if self.current['samples'] >= self.max_samples or self.current['bytes'] >= self.max_bytes:
+            self._close_shard()
+        return refs
+
+    async def add(self, key, files, tag_line=None):
+        """files: 扩展名 -> bytes / str / 已下载的临时文件路径（写入后删除）；返回扩展名 -> 分片内位置"""
+        loop = asyncio.get_running_loop()
+        refs = await loop.run_in_executor(self.executor, self._write, key, files, tag_line)
+        # 排在这之前的其他样本已经写完，一次 fsync 就都落盘了，之后的调用直接返回
+        await loop.run_in_executor(self.executor, self._sync)
+        return refs
+
+    def close(self):
+        self.executor.submit(self._close_shard).result()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_ref(ref):
+    """按 ShardWriter.add() 返回的位置（<分片路径>#<成员名>@<头偏移>）读出文件内容。
+
+    不是分片位置、分片已不存在或该位置已经不是这个成员（例如异常退出后样本被恢复到别的分片）时返回 None。
+    """
+    path, _, member = ref.rpartition('#')
+    member, _, offset = member.rpartition('@')
+    if not (path.endswith('.tar') and member and offset.isdigit()):
+        return None
+    # 先试 .part：打开之后分片写满被改名也仍然可读
+    for candidate in (path + '.part', path):
+        try:
+            with open(candidate, 'rb') as f:
+                f.seek(int(offset))
+                try:
+                    info = tarfile.TarInfo.frombuf(f.read(tarfile.BLOCKSIZE), tarfile.ENCODING, 'surrogateescape')
+                except tarfile.HeaderError:
+                    return None
+                if info.name != member:
+                    return None
+                data = f.read(info.size)
+                return data if len(data) == info.size else None
+        except FileNotFoundError:
+            continue
+    return None
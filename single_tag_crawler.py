@@ -1,209 +1,101 @@
-import httpx
 import asyncio
-import aiofiles
-import zipfile
-import os
-from pathlib import Path
-import csv
-from PIL import Image
+from engine import Crawl, CrawlEngine
+from sinks import ArchiveSink
+from sources import DanbooruSource, PREVIEW_VARIANTS, make_policy
+from workqueue import default_worker_id, worker_file
 
-async def download_image(session, url, filename, line, zipf, csv_writer, csvfile, error_flag, line_number):
-    max_retries = 10
-    retries = 0
-    
-    while retries < max_retries:
-        try:
-            response = await session.get(url)
-            if response.status_code == 200:
-                content_type = response.headers.get('Content-Type', '')
-                if 'video' in content_type:
-                    print(f"跳过视频文件: {url}")
-                    return False
-                
-                async with aiofiles.open(filename, 'wb') as f:
-                    await f.write(response.content)
-                
-                if filename.suffix.lower() == '.webp':
-                    new_filename = filename.with_suffix('.jpg')
-                    with Image.open(filename) as img:
-                        img.save(new_filename, 'JPEG')
-                    os.remove(filename)
-                    filename = new_filename
-                    print(f"转换完成: {filename}")
-                
-                print(f"下载完成: {filename}")
-                
-                csv_row = {'filename': filename.name, 'tags': line}
-                csv_writer.writerow(csv_row)
-                print(f"写入CSV: {csv_row}")
-                
-                csvfile.flush()
-                
-                if filename.name in zipf.namelist():
-                    del zipf.filelist[zipf.namelist().index(filename.name)]
-                    del zipf.NameToInfo[filename.name]
-                zipf.write(filename, arcname=filename.name)
-                
-                os.remove(filename)
-                return True
-            else:
-                print(f"下载失败 (状态码 {response.status_code}): {url}")
-                break
-        except Exception as e:
-            print(f"下载异常 (尝试 {retries + 1}/{max_retries}): {e} - {url}")
-            retries += 1
-    
-    print(f"放弃下载: {url}")
-    error_flag['value'] = True  # 设置错误标志
-    error_flag['lines'].append(line_number)  # 记录出错的行号
-    return False
-
-async def process_line(session, line, line_number, max_images=5, zipf=None, csv_writer=None, csvfile=None, existing_filenames=None, error_flag=None):
-    processed_tags = line.replace(' ', '_')
-    page = 1
-    processed_count = 0
-    
-    while processed_count < max_images:
-        url = f"https://kagamihara.donmai.us/posts.json?page={page}&tags={processed_tags}"
-        try:
-            response = await session.get(url)
-            if response.status_code == 200:
-                data = response.json()
-                if not data:
-                    break
-                for item in data:
-                    media_asset = item.get('media_asset', {})
-                    variants = media_asset.get('variants', [])
-                    
-                    size_720_variant = next((v for v in variants if v['type'] == '720x720'), None)
-                    sample_variant = next((v for v in variants if v['type'] == 'sample'), None)
-                    preview_variant = next((v for v in variants if v['type'] == 'preview'), None)
-                    original_variant = next((v for v in variants if v['type'] == 'original'), None)
-                    
-                    variant = size_720_variant or sample_variant or preview_variant or original_variant
-                    if variant:
-                        image_url = variant['url']
-                        image_name = os.path.basename(image_url)
-                        
-                        comparison_filename = image_name
-                        if comparison_filename.endswith('.webp'):
-                            comparison_filename = comparison_filename[:-5] + '.jpg'
-                        
-                        unique_filename = images_dir / f"{image_name}"
-                        
-                        if comparison_filename in existing_filenames:
-                            print(f"文件已存在: {comparison_filename}, 跳过下载")
-                            processed_count += 1  # 即使文件已存在也计入总数
-                            if processed_count >= max_images:
-                                return  # 达到最大数量，跳出循环
-                        else:
-                            success = await download_image(session, image_url, unique_filename, line, zipf, csv_writer, csvfile, error_flag, line_number)
-                            if success:
-                                processed_count += 1
-                                existing_filenames.add(comparison_filename)
-                                if processed_count >= max_images:
-                                    return  # 达到最大数量，跳出循环
-                            elif error_flag['value']:
-                                return  # 停止处理当前行
-                    else:
-                        print(f"未找到合适的变体: {item}")
-            else:
-                print(f"请求失败 (状态码 {response.status_code}): {url}")
-                error_flag['value'] = True  # 设置错误标志
-                error_flag['lines'].append(line_number)  # 记录出错的行号
-                return
-        except Exception as e:
-            print(f"请求异常: {e} - {url}")
-            error_flag['value'] = True  # 设置错误标志
-            error_flag['lines'].append(line_number)  # 记录出错的行号
-            return
-        page += 1
-
-async def read_existing_filenames(csv_file):
-    existing_filenames = set()
-    if os.path.exists(csv_file):
-        with open(csv_file, mode='r', newline='', encoding='utf-8') as csvfile:
-            csv_reader = csv.DictReader(csvfile)
-            # Skip header row
-            next(csv_reader, None)
-            for row in csv_reader:
-                existing_filenames.add(row['filename'])
-    return existing_filenames
-
-async def main(txt_path, output_zip, csv_file, timeout=1000, proxies=None, start_line=1, max_lines_per_batch=5, max_images=5):
-    print("开始执行脚本...")
-    print(f"当前工作目录: {os.getcwd()}")
-    print(f"尝试打开文件: {txt_path}")
-
-    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout), proxies=proxies) as session:
-        lines = []
-        try:
-            async with aiofiles.open(txt_path, mode='r') as file:
-                line_number = 0
-                while True:
-                    line = await file.readline()
-                    if not line:
-                        break
-                    line_number += 1
-                    if line_number >= start_line:
-                        lines.append(line.strip())
-            print(f"成功读取文件: {txt_path}, 行数: {len(lines)}")
-        except FileNotFoundError:
-            print(f"错误: 文件 {txt_path} 不存在.")
-            return None
-        
-        global images_dir
-        images_dir = Path("images")
-        images_dir.mkdir(parents=True, exist_ok=True)
-        print(f"创建/检查图片目录: {images_dir}")
-
-        with open(csv_file, mode='a', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ['filename', 'tags']
-            csv_writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            
-            if csvfile.tell() == 0:
-                csv_writer.writeheader()
-            
-            existing_filenames = await read_existing_filenames(csv_file)
-            
-            with zipfile.ZipFile(output_zip, 'a', zipfile.ZIP_DEFLATED) as zipf:
-                error_flag = {'value': False, 'lines': []}  # 初始化错误标志和行号列表
-                batch_start_line = start_line
-                while lines:
-                    batch_lines = lines[:max_lines_per_batch]
-                    lines = lines[max_lines_per_batch:]
-                    
-                    for i, line in enumerate(batch_lines, start=1):
-                        current_line_number = batch_start_line + i - 1
-                        print(f"处理第 {current_line_number}/{batch_start_line + len(batch_lines) - 1} 行: {line}")
-                        await process_line(session, line, current_line_number, max_images=max_images, zipf=zipf, csv_writer=csv_writer, csvfile=csvfile, existing_filenames=existing_filenames, error_flag=error_flag)
-                        if error_flag['value']:
-                            print(f"检测到下载异常，停止脚本。出错的行号: {', '.join(map(str, sorted(set(error_flag['lines']))))}")
-                            return min(error_flag['lines'])  # 返回最小的出错行号
-            
-                    batch_start_line += max_lines_per_batch
-    return None
+async def main(txt_path, output_zip, csv_file, timeout=60.0, proxies=None, start_line=1, page_fetchers=4, max_images=5, download_workers=8, queue_size=100, api_concurrency=2, cdn_concurrency=8, convert_workers=None, jpeg_quality=95, manifest_path='manifest.db', pagination_mode='cursor', page_limit=200, api_rate=5.0, cdn_rate=20.0, dedupe='skip', api_timeout=30.0, http2=False, listing_cache_path=None, cache_ttl=3600, offline=False, plan_ttl=86400, plan_order='largest', or_group_size=1, log_level='info', metrics_port=None, metrics_path=None, min_side=None, max_file_bytes=None, prefer_ext=(), byte_budget=None, work_queue=None, worker_id=None, refresh_after=None, proxy_pool=None, verify_images=True, quarantine_dir='quarantine'):
+    # 训练用的缩略图：720x720 > sample > preview > original
+    source = DanbooruSource(page_limit=page_limit, pagination_mode=pagination_mode, variants=PREVIEW_VARIANTS, policy=make_policy(min_side, max_file_bytes, prefer_ext))
+    if work_queue:
+        # 分布式抓取时每个 worker 写入自己的 images.worker-<id>.zip 和 train.worker-<id>.csv
+        worker_id = worker_id or default_worker_id()
+        output_zip, csv_file = worker_file(output_zip, worker_id), worker_file(csv_file, worker_id)
+    crawl = Crawl(source, ArchiveSink(output_zip, csv_file), txt_path, start_line, max_images, page_fetchers, download_workers, queue_size,
+                  api_concurrency, cdn_concurrency, api_rate, cdn_rate, timeout, api_timeout, proxies, http2,
+                  listing_cache_path or 'listing_cache.db', cache_ttl, offline, plan_ttl, plan_order, or_group_size, byte_budget=byte_budget, work_queue=work_queue, worker_id=worker_id, refresh_after=refresh_after, proxy_pool=proxy_pool,
+                  verify=verify_images, quarantine_dir=quarantine_dir)
+    engine = CrawlEngine(manifest_path, convert_workers, jpeg_quality, dedupe, log_level=log_level, metrics_port=metrics_port, metrics_path=metrics_path)
+    failed_lines, = await engine.run([crawl])
+    return failed_lines[0] if failed_lines else None  # 返回最小的出错行号
 
 if __name__ == "__main__":
     txt_path = "artist_full.txt"  # 存放标签行的txt文件(同目录下)
     output_zip = "images.zip"
     csv_file = "train.csv"
-    timeout = 5000  # 超时时间
+    timeout = 60  # 图片下载的读超时（秒），即两次收到数据之间最长的等待，卡住的传输超时后重试
+    api_timeout = 30  # API 请求的读超时（秒）
     proxies = {"http://": 'http://127.0.0.1:7890', "https://": 'http://127.0.0.1:7890'}
-    # 全局变量，控制每次处理多少个标签行
-    max_lines_per_batch = 5
+    # 同时翻页的标签行数量
+    page_fetchers = 4
+    # 下载 worker 数量，以及待下载队列的长度（队列满时翻页会暂停等待）
+    download_workers = 8
+    queue_size = 100
+    # API 请求与图片 CDN 请求各自的最大并发数
+    api_concurrency = 2
+    cdn_concurrency = 8
+    # WebP 转 JPEG 的进程数（None 为 CPU 核数）和 JPEG 质量
+    convert_workers = None
+    jpeg_quality = 95
+    # 已抓取帖子的 SQLite 清单，重启时无需重新读取 train.csv
+    manifest_path = "manifest.db"
+    # 翻页方式: 'cursor' 按帖子id键集翻页（推荐），'page' 为数字页码；每页条数（Danbooru 最多 200）
+    pagination_mode = "cursor"
+    page_limit = 200
+    # API 与图片 CDN 的初始请求速率（请求/秒），会根据 429/Retry-After 和错误率自动调整
+    api_rate = 5.0
+    cdn_rate = 20.0
+    # 按 md5 去重: 'skip' 重复内容不下载也不计数，'link' 不下载，只在 train.csv 里追加一行引用已有图片，None 关闭
+    # 与其他脚本使用同一个 manifest_path 时可跨 tag、跨站点去重
+    dedupe = "link"
+    log_level = "info" # 日志级别: 'debug' 输出每个文件的事件，'info' 每个tag的进度，'warning' 只输出失败
+    metrics_port = None # 在本机该端口提供 Prometheus 格式的 /metrics，None 不开启
+    metrics_path = None # 每30秒向该文件追加一行 JSON 指标快照（耗时、字节数、队列长度、重试和跳过原因），None 不写
+    min_side = None # 变体选择: 短边至少多少像素，设置后在各尺寸的变体中选满足条件且字节数最少的；None 使用默认变体
+    max_file_bytes = None # 单个文件最大字节数，超过的变体不下载
+    prefer_ext = () # 满足条件的变体中优先的格式，例如 ("jpg",) 可以避免 WebP 转换
+    byte_budget = None # 本次运行最多下载的字节数，例如 20 * 1024 ** 3；达到后停止，断点保留，None 不限
+    # API 与图片下载使用独立的连接池（连接数分别等于 api_concurrency / cdn_concurrency）；HTTP/2 需要 pip install httpx[http2]
+    http2 = False
+    # 列表页缓存（None 为 listing_cache.db）及有效期（秒），过期后用 ETag/Last-Modified 重新验证；cache_ttl = None 不使用缓存
+    # offline = True 时只读缓存、不请求 API 也不下载图片，用于离线演练（建议配合单独的 manifest_path）
+    listing_cache_path = None
+    cache_ttl = 3600
+    offline = False
+    # 翻页前先批量查询各 tag 的帖子数（结果在清单中缓存 plan_ttl 秒），跳过没有帖子或已被别名的 tag，None 不做规划
+    # plan_order: 'largest' 帖子多的先开始，'smallest'，None 保持文件顺序
+    plan_ttl = 86400
+    plan_order = "largest"
+    # 合并查询: 规划后帖子合计不超过一页的小 tag 每 or_group_size 个合成一个 ~a ~b 查询，帖子按 tag_string 分回各 tag
+    # 普通账号一次最多搜索 2 个 tag（Gold 6，Platinum 12），1 为关闭
+    or_group_size = 2
+    # 分布式抓取: 共享的工作队列文件（例如 "work_queue.db"）或协调服务地址（"http://host:8765"），见 coordinator.py，None 按 start_line 处理整个 txt
+    # 每个 worker 写入 images.worker-<worker_id>.zip / train.worker-<worker_id>.csv（worker_id 为 None 时为 主机名-进程号），结束后用 merge_workers.py 合并
+    work_queue = None
+    worker_id = None
     # 控制每个标签的最大下载图片数量
     max_images = 50
     # 全局变量，控制txt文件的启始标签行
     start_line = 1
+    # 增量模式: 已完成的标签距上次抓取超过 refresh_after 秒时（例如 86400）只请求比上次更新的帖子（id:>N），None 已完成的标签不再请求
+    refresh_after = None
+    # 代理池: 多个代理地址的列表，例如 ['http://127.0.0.1:7890', 'http://127.0.0.1:7891']，设置后忽略 proxies；并发和速率都是每个代理的值，download_workers 相应调大
+    proxy_pool = None
+    # 写入压缩包前检查图片结构（Pillow verify，JPEG 检查结束标记），不通过的文件和原因（quarantine.jsonl）移到 quarantine_dir 后重新下载
+    verify_images = True
+    quarantine_dir = "quarantine"
+    # 有标签行多次请求失败时最多重新启动几次；返回 4xx 的标签记入断点，不会重新启动
+    max_restarts = 3
 
     total_lines_processed = 0
-    while True:
-        result = asyncio.run(main(txt_path, output_zip, csv_file, timeout, proxies, start_line, max_lines_per_batch, max_images))
+    for restart in range(max_restarts + 1):
+        result = asyncio.run(main(txt_path, output_zip, csv_file, timeout, proxies, start_line, page_fetchers, max_images, download_workers, queue_size, api_concurrency, cdn_concurrency, convert_workers, jpeg_quality, manifest_path, pagination_mode, page_limit, api_rate, cdn_rate, dedupe, api_timeout, http2, listing_cache_path, cache_ttl, offline, plan_ttl, plan_order, or_group_size, log_level, metrics_port, metrics_path, min_side, max_file_bytes, prefer_ext, byte_budget, work_queue, worker_id, refresh_after, proxy_pool, verify_images, quarantine_dir))
         if result is None:  # 如果 main 返回 None，则表示没有错误发生，停止整个程序
             break
+        elif restart == max_restarts:
+            print(f"第 {result} 行等标签行重新启动 {max_restarts} 次后仍然失败，已保存断点，下次运行继续。")
         else:
-            start_line = result  # 将 start_line 设置为出错的行号并继续处理
+            start_line = result  # 将 start_line 设置为出错的行号，各tag从断点继续处理
 
         with open(txt_path, 'r') as file:
             total_lines_in_file = sum(1 for _ in file)
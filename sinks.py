@@ -0,0 +1,251 @@
+import asyncio
+import csv
+import json
+import os
+from pathlib import Path
+
+import aiofiles
+
+from archive_writer import ArchiveWriter
+from downloader import write_atomic, link_file
+from metadata_writer import MetadataWriter
+from metrics import log
+from shards import ShardWriter, read_ref
+
+# FolderSink 的分桶清单，每行一个样本
+BUCKET_MANIFEST = 'buckets.jsonl'
+
+
+def tag_save_dir(base_save_dir, line):
+    # 为每行创建一个子文件夹，使用清理后的行内容作为文件夹名
+    folder_name = line.strip().replace(' ', '_').replace('/', '_').replace('\\', '_')  # 避免非法字符
+    return Path(base_save_dir) / folder_name
+
+
+class Sink:
+    """下载结果的写入方式。
+
+    target() 返回流式下载的目标文件（None 表示下载到内存），save() 把图片和标注写入结果，
+    link() 在内容已下载过时不经网络复用已有文件，path() 是写入清单、供之后去重链接的本地路径（分片为样本在 tar 里的位置）。
+    sample 是引擎整理好的帖子信息：id、md5、tag_line、rating、score、tag_string、tag_groups、caption。
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def legacy_names(self):
+        # 旧版本按文件名去重时留下的文件，只在第一次使用清单时导入
+        return set()
+
+    def prepare(self, job):
+        pass
+
+    def target(self, job, name):
+        return None
+
+    def path(self, job, name):
+        return None
+
+    def __contains__(self, name):
+        return False
+
+    def backlog(self):
+        # 等待写入的样本数，作为队列长度指标导出
+        return 0
+
+    async def save(self, job, name, image, sample):
+        raise NotImplementedError
+
+    async def link(self, job, name, source, sample):
+        # 引用已下载的同一内容（source 为 Manifest.find_md5() 的结果），返回是否写入成功；失败时由调用方正常下载
+        return False
+
+
+class FolderSink(Sink):
+    """每个tag一个文件夹，图片 + 同名 txt 标注。
+
+    metadata 为 'txt'（同名 txt 标注）、'jsonl'（每个tag文件夹一个 metadata.jsonl，不写 txt）或 'both'，
+    都由 MetadataWriter 的写入线程批量写入。
+    图片缩放到分桶时，每个样本的相对路径和分桶尺寸追加到 base_dir 下的 buckets.jsonl。
+    """
+
+    def __init__(self, base_dir, metadata='txt'):
+        self.base_dir = Path(base_dir)
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+        self.bucket_file = None
+        self.metadata = MetadataWriter(captions=metadata in ('txt', 'both'), jsonl=metadata in ('jsonl', 'both'))
+
+    def __enter__(self):
+        self.metadata.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metadata.close()
+        if self.bucket_file is not None:
+            self.bucket_file.close()
+            self.bucket_file = None
+
+    def record_bucket(self, filename, bucket):
+        if self.bucket_file is None:
+            self.bucket_file = open(self.base_dir / BUCKET_MANIFEST, 'a', encoding='utf-8')
+        entry = {'file': filename.relative_to(self.base_dir).as_posix(), 'width': bucket[0], 'height': bucket[1]}
+        self.bucket_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def legacy_names(self):
+        names = set()
+        log.info("正在扫描已存在的文件...")
+        for sub_dir in self.base_dir.glob('*'):
+            # 跳过 .quarantine 等隐藏文件夹
+            if sub_dir.is_dir() and not sub_dir.name.startswith('.'):
+                for pattern in ('*.jpg', '*.png'):
+                    names.update(file.name for file in sub_dir.glob(pattern))
+        log.info(f"扫描完成，找到 {len(names)} 个已存在文件。")
+        return names
+
+    def prepare(self, job):
+        # 合并查询的帖子保存到各成员tag的文件夹
+        for target in job.members or [job]:
+            tag_save_dir(self.base_dir, target.line).mkdir(parents=True, exist_ok=True)
+
+    def target(self, job, name):
+        return tag_save_dir(self.base_dir, job.line) / name
+
+    def path(self, job, name):
+        return str(self.target(job, name).resolve())
+
+    def backlog(self):
+        return self.metadata.backlog()
+
+    async def save(self, job, name, image, sample):
+        filename = self.target(job, name)
+        if isinstance(image, bytes):
+            await write_atomic(filename, image)
+        log.debug(f"下载完成: {filename}")
+
+        await self.metadata.add(filename, sample)
+        log.debug(f"写入标注: {filename}")
+        if sample.get('bucket'):
+            self.record_bucket(filename, sample['bucket'])
+
+    async def link(self, job, name, source, sample):
+        src_path = source[4]
+        if not (src_path and os.path.exists(src_path)):
+            return False
+        try:
+            link_file(src_path, self.target(job, name))
+        except OSError as e:
+            # 检查之后文件被移走或删除
+            log.warning(f"引用已下载的文件失败: {e} - {src_path}")
+            return False
+        await self.save(job, name, self.target(job, name), sample)
+        return True
+
+
+class ShardSink(FolderSink):
+    """WebDataset 布局的 tar 分片，图片先下载到 .tmp，写入分片后删除。
+
+    清单里记录的 path 是图片在分片里的位置，去重引用时直接从 tar 读出写成新的样本。
+    """
+
+    def __init__(self, base_dir, max_samples=1000, max_bytes=1024 ** 3):
+        super().__init__(base_dir)
+        self.tmp_dir = self.base_dir / '.tmp'
+        self.tmp_dir.mkdir(exist_ok=True)
+        self.shards = ShardWriter(self.base_dir, max_samples=max_samples, max_bytes=max_bytes)
+        # save() 之后、记入清单之前的样本位置
+        self.refs = {}
+
+    def __enter__(self):
+        # 标注和元数据跟图片一起写进分片，不需要单独的写入线程
+        return self
+
+    def backlog(self):
+        return 0
+
+    def __exit__(self, *exc_info):
+        self.shards.close()
+        super().__exit__(*exc_info)
+
+    def prepare(self, job):
+        pass
+
+    def target(self, job, name):
+        return self.tmp_dir / name
+
+    def path(self, job, name):
+        return self.refs.pop(name, None)
+
+    async def save(self, job, name, image, sample):
+        # 图片、标注和元数据作为一个样本写入 tar 分片
+        ext = Path(name).suffix.lstrip('.')
+        meta = {key: sample[key] for key in ('id', 'md5', 'tag_line', 'rating', 'score', 'tag_string', 'tag_groups', 'bucket') if sample.get(key) is not None}
+        files = {ext: image, 'txt': sample['caption'], 'json': json.dumps(meta, ensure_ascii=False)}
+        refs = await self.shards.add(str(sample['id']), files, job.line)
+        self.refs[name] = refs[ext]
+        log.debug(f"写入分片: {sample['id']} ({job.line})")
+
+    async def link(self, job, name, source, sample):
+        src_path = source[4]
+        if not src_path:
+            return False
+        if os.path.exists(src_path):
+            async with aiofiles.open(src_path, 'rb') as f:
+                image = await f.read()
+        else:
+            # 之前写进分片的同一内容，按记录的位置从 tar 里读出
+            image = await asyncio.get_running_loop().run_in_executor(None, read_ref, src_path)
+            if image is None:
+                return False
+        await self.save(job, name, image, sample)
+        return True
+
+
+class ArchiveSink(Sink):
+    """所有图片写入一个 zip，train.csv 记录文件名和对应的标签行。"""
+
+    def __init__(self, zip_path, csv_path):
+        self.csv_path = csv_path
+        self.archive = ArchiveWriter(zip_path, csv_path)
+
+    def __enter__(self):
+        self.archive.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.archive.close()
+
+    def legacy_names(self):
+        names = set()
+        if os.path.exists(self.csv_path):
+            with open(self.csv_path, mode='r', newline='', encoding='utf-8') as csvfile:
+                names.update(row['filename'] for row in csv.DictReader(csvfile))
+        return names
+
+    def __contains__(self, name):
+        return name in self.archive
+
+    def backlog(self):
+        return self.archive.queue.qsize()
+
+    async def save(self, job, name, image, sample):
+        log.debug(f"下载完成: {name}")
+        csv_row = {'filename': name, 'tags': job.line}
+        # 由写入线程直接把字节写进压缩包，并批量 flush CSV
+        if await self.archive.add(name, image, csv_row):
+            log.debug(f"写入CSV: {csv_row}")
+
+    async def link(self, job, name, source, sample):
+        src_name, src_path = source[3], source[4]
+        if src_name in self.archive:
+            # 压缩包里已有这张图，只追加一行 CSV 引用它
+            await self.archive.add(src_name, None, {'filename': src_name, 'tags': job.line})
+            return True
+        if not (src_path and os.path.exists(src_path)):
+            return False
+        # 其他站点下载到本地的文件，直接读入压缩包
+        async with aiofiles.open(src_path, 'rb') as f:
+            await self.save(job, name, await f.read(), sample)
+        return True
@@ -0,0 +1,261 @@
+import fnmatch
+import os
+import re
+from collections import namedtuple
+
+from pagination import danbooru, moebooru
+
+# yande.re 会拒绝没有浏览器 User-Agent 的请求
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+# 原文件的变体名，API 返回的 md5 只对应这些变体
+ORIGINAL_VARIANTS = ('original', 'file')
+# single_tag_crawler 使用的缩略图优先顺序
+PREVIEW_VARIANTS = ('720x720', 'sample', 'preview', 'original')
+# Danbooru 帖子里按类别分开的标签字段 tag_string_<类别>
+DANBOORU_CATEGORIES = ('artist', 'copyright', 'character', 'general', 'meta')
+
+
+def comparison_name(url, jpeg=False):
+    # 保存时使用的文件名，WebP（jpeg=True 时所有格式）会被转成 JPEG
+    name = os.path.basename(url)
+    if jpeg:
+        return os.path.splitext(name)[0] + '.jpg'
+    if name.lower().endswith('.webp'):
+        name = name[:-5] + '.jpg'
+    return name
+
+
+# 帖子的一个图片变体，API 没有给出的尺寸、字节数为 None
+Variant = namedtuple('Variant', 'name url width height file_size file_ext')
+
+
+def estimated_bytes(variant, reference=None):
+    # 只有原图给出 file_size 时（Danbooru），其他变体按像素数比例估算
+    if variant.file_size:
+        return variant.file_size
+    if reference is not None and reference.file_size and variant.width and variant.height:
+        return reference.file_size * variant.width * variant.height / (reference.width * reference.height)
+    return None
+
+
+def make_policy(min_side=None, max_bytes=None, prefer_ext=()):
+    # 三个条件都没有设置时返回 None，使用各站点默认的变体顺序
+    if min_side or max_bytes or prefer_ext:
+        return VariantPolicy(min_side, max_bytes, prefer_ext)
+    return None
+
+
+class VariantPolicy:
+    """按尺寸、字节数和格式决定下载帖子的哪个变体。
+
+    在短边不小于 min_side、（已知或估算的）字节数不超过 max_bytes 的变体里，优先 prefer_ext 中的格式，
+    再选字节数最少的；没有变体满足尺寸要求时退而选不超过 max_bytes 的最大变体，全部超过时不下载。
+    """
+
+    def __init__(self, min_side=None, max_bytes=None, prefer_ext=()):
+        self.min_side = min_side
+        self.max_bytes = max_bytes
+        self.prefer_ext = tuple(prefer_ext or ())
+
+    def meets(self, variant, need=None):
+        if self.min_side and min(variant.width, variant.height) < self.min_side:
+            return False
+        # 分桶时还要能覆盖目标尺寸，留 1 像素的取整误差
+        if need and (variant.width < need[0] - 1 or variant.height < need[1] - 1):
+            return False
+        return True
+
+    def choose(self, variants, need=None):
+        """返回选中的 Variant，没有可下载的变体时返回 None。need 为分桶要求的 (宽, 高)。"""
+        sized = [v for v in variants if v.width and v.height]
+        reference = max(sized, key=lambda v: v.width * v.height, default=None)
+
+        def cost(v):
+            size = estimated_bytes(v, reference)
+            return (size if size is not None else float('inf'), v.width * v.height)
+
+        if self.max_bytes:
+            variants = [v for v in variants if (estimated_bytes(v, reference) or 0) <= self.max_bytes]
+            sized = [v for v in sized if v in variants]
+        if not sized:
+            # 不知道尺寸时按站点默认顺序
+            return variants[0] if variants else None
+        fits = [v for v in sized if self.meets(v, need)]
+        if fits:
+            return min(fits, key=lambda v: (v.file_ext not in self.prefer_ext if self.prefer_ext else False, cost(v)))
+        return max(sized, key=lambda v: v.width * v.height)
+
+
+def make_caption_rules(exclude=(), categories=None, max_tags=None, prefix=(), replace_underscores=False, separator=','):
+    # 都是默认值时返回 None，使用各站点默认的标注格式
+    if exclude or categories or max_tags or prefix:
+        return CaptionRules(separator, replace_underscores, exclude, categories, prefix, max_tags)
+    return None
+
+
+class CaptionRules:
+    """把帖子的标签整理成训练用的标注：按 tag_string 的顺序，去掉 exclude 里的标签（可以用 * ? 通配，
+    按站点原始的标签名匹配），categories 不为 None 时只保留这些类别，下划线按需换成空格，最多 max_tags 个，
+    prefix（例如触发词）放在最前面。
+
+    每个标签的整理结果只计算一次并缓存，每个帖子只做一次 split 和 join。
+    """
+
+    def __init__(self, separator=',', replace_underscores=False, exclude=(), categories=None, prefix=(), max_tags=None):
+        self.separator = separator
+        self.replace_underscores = replace_underscores
+        self.exclude = {tag for tag in exclude if not any(c in tag for c in '*?[')}
+        patterns = [fnmatch.translate(tag) for tag in exclude if tag not in self.exclude]
+        self.pattern = re.compile('|'.join(patterns)) if patterns else None
+        self.categories = tuple(categories) if categories else None
+        self.prefix = list(prefix)
+        self.max_tags = max_tags
+        self.cache = {}
+
+    def normalize(self, tag):
+        # 返回整理后的标签，被过滤掉时返回 None
+        try:
+            return self.cache[tag]
+        except KeyError:
+            pass
+        if tag in self.exclude or (self.pattern is not None and self.pattern.match(tag)):
+            result = None
+        else:
+            result = tag.replace('_', ' ') if self.replace_underscores else tag
+        self.cache[tag] = result
+        return result
+
+    def caption(self, tag_string, groups=None):
+        """groups 为 类别 -> 标签列表，只在设置了 categories 时使用（没有类别信息的站点不过滤）。"""
+        tags = tag_string.split()
+        if self.categories is not None and groups:
+            allowed = {tag for category in self.categories for tag in groups.get(category, ())}
+            tags = [tag for tag in tags if tag in allowed]
+        tags = [normalized for normalized in map(self.normalize, tags) if normalized is not None]
+        if self.max_tags:
+            tags = tags[:self.max_tags]
+        return self.separator.join(self.prefix + tags)
+
+
+class Source:
+    """一个图站的适配器：列表接口的翻页方式、图片地址的选取和标注格式。
+
+    引擎只通过这些方法和站点打交道，新增站点时实现一个子类即可。
+    """
+
+    site = None
+    # 是否支持 planner 的批量 tag 查询（tags.json）
+    plannable = False
+
+    # 默认标注是否把下划线换成空格
+    replace_underscores = False
+
+    def __init__(self, pagination, headers=None, policy=None, caption_rules=None):
+        self.pagination = pagination
+        self.headers = headers
+        # VariantPolicy，None 时使用 candidates() 的第一个变体
+        self.policy = policy
+        # CaptionRules，None 时逗号分隔全部标签
+        self.caption_rules = caption_rules or CaptionRules(replace_underscores=self.replace_underscores)
+
+    @property
+    def base_url(self):
+        return self.pagination.endpoint.rsplit('/', 1)[0]
+
+    @property
+    def api_host(self):
+        return self.pagination.endpoint.split('/')[2]
+
+    def candidates(self, item):
+        """返回帖子的全部 Variant，按站点默认的优先顺序排列。"""
+        raise NotImplementedError
+
+    def default_variant(self, variants):
+        return variants[0]
+
+    def image_url(self, item, buckets=None):
+        """返回 (图片地址, 变体名)，没有可用地址时返回 (None, None)。
+
+        设置了 policy 或 buckets 时按尺寸和字节数选择，buckets 要求变体能覆盖目标分桶。
+        """
+        variants = [v for v in self.candidates(item) if v.url]
+        if not variants:
+            return None, None
+        if self.policy is None and buckets is None:
+            chosen = self.default_variant(variants)
+        else:
+            need = None
+            sized = [v for v in variants if v.width and v.height]
+            if buckets is not None and sized:
+                largest = max(sized, key=lambda v: v.width * v.height)
+                need = buckets.required(largest.width, largest.height)
+            chosen = (self.policy or VariantPolicy()).choose(variants, need)
+        return (chosen.url, chosen.name) if chosen else (None, None)
+
+    def tag_string(self, item):
+        raise NotImplementedError
+
+    def tag_groups(self, item):
+        """返回 类别 -> 标签列表，站点不区分类别时返回空字典。"""
+        return {}
+
+    def caption(self, item, groups=None):
+        return self.caption_rules.caption(self.tag_string(item), groups if groups is not None else self.tag_groups(item))
+
+
+class DanbooruSource(Source):
+    site = 'danbooru'
+    plannable = True
+    # 逗号分隔，下划线换成空格
+    replace_underscores = True
+
+    def __init__(self, base_url='https://kagamihara.donmai.us', page_limit=200, pagination_mode='cursor', variants=('original',), headers=None, policy=None, caption_rules=None):
+        super().__init__(danbooru(base_url, page_limit, pagination_mode), headers, policy, caption_rules)
+        # 没有 policy 时按顺序选第一个存在的变体
+        self.variants = variants
+
+    def candidates(self, item):
+        media_asset = item.get('media_asset') or {}
+        by_type = {}
+        for v in media_asset.get('variants', []):
+            # 只有原图有 file_size
+            file_size = (item.get('file_size') or media_asset.get('file_size')) if v['type'] == 'original' else None
+            by_type[v['type']] = Variant(v['type'], v.get('url'), v.get('width'), v.get('height'), file_size, v.get('file_ext'))
+        ordered = [by_type.pop(name) for name in self.variants if name in by_type]
+        return ordered + list(by_type.values())
+
+    def default_variant(self, variants):
+        return variants[0] if variants[0].name in self.variants else None
+
+    def tag_string(self, item):
+        return item.get('tag_string', '')
+
+    def tag_groups(self, item):
+        groups = {}
+        for category in DANBOORU_CATEGORIES:
+            tags = item.get(f'tag_string_{category}')
+            if tags:
+                groups[category] = tags.split()
+        return groups
+
+
+class MoebooruSource(Source):
+    site = 'yandere'
+
+    def __init__(self, base_url='https://yande.re', page_limit=100, pagination_mode='cursor', headers=BROWSER_HEADERS, site='yandere', policy=None, caption_rules=None):
+        super().__init__(moebooru(base_url, page_limit, pagination_mode), headers, policy, caption_rules)
+        self.site = site
+
+    def candidates(self, item):
+        # 没有 policy 时使用原文件
+        return [
+            Variant('file', item.get('file_url'), item.get('width'), item.get('height'), item.get('file_size'), item.get('file_ext')),
+            Variant('jpeg', item.get('jpeg_url'), item.get('jpeg_width'), item.get('jpeg_height'), item.get('jpeg_file_size'), 'jpg'),
+            Variant('sample', item.get('sample_url'), item.get('sample_width'), item.get('sample_height'), item.get('sample_file_size'), 'jpg'),
+            Variant('preview', item.get('preview_url'), item.get('actual_preview_width'), item.get('actual_preview_height'), None, 'jpg'),
+        ]
+
+    def tag_string(self, item):
+        return item.get('tags', '')
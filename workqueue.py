@@ -0,0 +1,318 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+
+from metrics import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS work (
+    queue TEXT NOT NULL,
+    line_number INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (queue, line_number)
+);
+CREATE INDEX IF NOT EXISTS work_status ON work (queue, status, lease_until);
+"""
+
+# 一个标签行最多被租约几次（失败或租约过期都算一次），之后标记为 failed 不再分配
+MAX_ATTEMPTS = 3
+# 每个 worker 写入自己的输出（文件夹 save_dir/worker-<id>，压缩包 images.worker-<id>.zip），抓取结束后用 merge_workers.py 合并
+WORKER_PREFIX = 'worker-'
+# 队列里暂时没有可租约的行、但其他 worker 还持有租约时，每隔多少秒再试一次
+POLL_INTERVAL = 5.0
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def worker_dir(base_dir, worker_id):
+    return Path(base_dir) / f"{WORKER_PREFIX}{worker_id}"
+
+
+def worker_file(path, worker_id):
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{WORKER_PREFIX}{worker_id}{path.suffix}")
+
+
+def open_queue(spec, name):
+    """spec 为 http(s):// 地址时连接协调服务（QueueServer），否则是本机共享的 SQLite 队列文件。"""
+    if str(spec).startswith(('http://', 'https://')):
+        return RemoteQueue(spec, name)
+    return WorkQueue(spec, name)
+
+
+class WorkQueue:
+    """把标签行分给多个 worker 进程的租约队列，保存在 SQLite 文件里（WAL 模式），name 区分不同站点的队列。
+
+    worker 用 lease() 取得若干行并持有 lease_seconds 秒的租约，处理期间定时 heartbeat() 续约，
+    结束后 complete() 报告结果；worker 崩溃或断网后租约过期，这些行会被其他 worker 的 lease() 重新取走。
+    同一台机器上的进程可以直接共用这个文件；多台机器时由 QueueServer 在一台机器上提供 HTTP 接口，
+    不要把 SQLite 文件放在网络文件系统上共用（文件锁不可靠）。
+    方法都是协程，和 RemoteQueue 的接口一致；SQLite 调用（等其他进程的写锁时最多 busy_timeout）
+    都在队列自己的线程里执行，不阻塞事件循环。
+    """
+
+    def __init__(self, path='work_queue.db', name='default', max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.name = name
+        self.max_attempts = max_attempts
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='work-queue', initializer=self._connect)
+
+    def _connect(self):
+        # 连接只在队列的线程里使用
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=30000')
+        self.conn.executescript(SCHEMA)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def load(self, lines):
+        """lines: [(行号, 标签行)]，已在队列里的行号保持原状态，返回新加入的行数。"""
+        return await self._run(self._load, list(lines))
+
+    def _load(self, lines):
+        now = time.time()
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO work (queue, line_number, line, updated_at) VALUES (?, ?, ?, ?)",
+                                  [(self.name, number, line, now) for number, line in lines])
+        return self.conn.total_changes - before
+
+    async def lease(self, worker, count=1, lease_seconds=300):
+        """租约最多 count 个待处理或租约已过期的行，返回 [(行号, 标签行)]。"""
+        rows = await self._run(self._lease, worker, count, lease_seconds)
+        reclaimed = sum(1 for row in rows if row[2] == 'leased')
+        if reclaimed:
+            log.info(f"[{self.name}] {worker} 接手了 {reclaimed} 个租约已过期的标签行")
+        return [(row[0], row[1]) for row in rows]
+
+    def _lease(self, worker, count, lease_seconds):
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 重试次数用完的过期租约不再分配
+            self.conn.execute("UPDATE work SET status = 'failed', worker = NULL, updated_at = ? WHERE queue = ? AND status = 'leased' AND lease_until < ? AND attempts >= ?",
+                              (now, self.name, now, self.max_attempts))
+            rows = self.conn.execute(
+                "SELECT line_number, line, status FROM work WHERE queue = ? AND (status = 'pending' OR (status = 'leased' AND lease_until < ?)) "
+                "ORDER BY line_number LIMIT ?", (self.name, now, count)).fetchall()
+            self.conn.executemany(
+                "UPDATE work SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? WHERE queue = ? AND line_number = ?",
+                [(worker, now + lease_seconds, now, self.name, row[0]) for row in rows])
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    async def heartbeat(self, worker, lease_seconds=300):
+        # 续约该 worker 持有的全部行，返回续约的行数
+        return await self._run(self._heartbeat, worker, lease_seconds)
+
+    def _heartbeat(self, worker, lease_seconds):
+        with self.conn:
+            cursor = self.conn.execute("UPDATE work SET lease_until = ? WHERE queue = ? AND worker = ? AND status = 'leased'",
+                                       (time.time() + lease_seconds, self.name, worker))
+        return cursor.rowcount
+
+    async def complete(self, worker, line_number, failed=False):
+        """报告一行的结果；失败的行在重试次数用完之前回到待处理。租约已经转给其他 worker 时忽略，返回 False。"""
+        if failed:
+            sql = "UPDATE work SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, lease_until = NULL, updated_at = ? WHERE queue = ? AND line_number = ? AND worker = ? AND status = 'leased'"
+            params = (self.max_attempts, time.time(), self.name, line_number, worker)
+        else:
+            sql = "UPDATE work SET status = 'done', worker = NULL, lease_until = NULL, updated_at = ? WHERE queue = ? AND line_number = ? AND worker = ? AND status = 'leased'"
+            params = (time.time(), self.name, line_number, worker)
+        return await self._run(self._execute, sql, params) > 0
+
+    async def release(self, worker, line_number=None):
+        # 没有处理完的行交还队列（例如达到流量上限时），不计入重试次数
+        sql = "UPDATE work SET status = 'pending', worker = NULL, lease_until = NULL, attempts = MAX(attempts - 1, 0), updated_at = ? WHERE queue = ? AND worker = ? AND status = 'leased'"
+        params = (time.time(), self.name, worker)
+        if line_number is not None:
+            sql += " AND line_number = ?"
+            params += (line_number,)
+        return await self._run(self._execute, sql, params)
+
+    async def requeue(self):
+        # 定期增量抓取前把已完成和失败的行放回待处理，返回放回的行数
+        return await self._run(self._execute, "UPDATE work SET status = 'pending', worker = NULL, lease_until = NULL, attempts = 0, updated_at = ? WHERE queue = ? AND status IN ('done', 'failed')",
+                               (time.time(), self.name))
+
+    async def progress(self):
+        # 各状态的行数
+        return await self._run(self._progress)
+
+    def _progress(self):
+        rows = self.conn.execute("SELECT status, COUNT(*) FROM work WHERE queue = ? GROUP BY status", (self.name,))
+        return dict(rows.fetchall())
+
+    def _execute(self, sql, params):
+        with self.conn:
+            return self.conn.execute(sql, params).rowcount
+
+    async def unfinished(self):
+        counts = await self.progress()
+        return counts.get('pending', 0) + counts.get('leased', 0)
+
+    async def close(self):
+        if self.conn is not None:
+            await self._run(self.conn.close)
+        self.executor.shutdown(wait=True)
+
+
+class RemoteQueue:
+    """通过 HTTP 使用其他机器上 QueueServer 的队列，接口和 WorkQueue 相同。
+
+    协调服务暂时不可用时按间隔重试，worker 不会因为协调服务重启而退出。
+    """
+
+    def __init__(self, url, name='default', timeout=30.0, max_retries=10):
+        self.url = url.rstrip('/')
+        self.name = name
+        self.max_retries = max_retries
+        self.session = httpx.AsyncClient(timeout=timeout, trust_env=False)
+
+    async def call(self, method, **params):
+        for retries in range(1, self.max_retries + 1):
+            try:
+                response = await self.session.post(f"{self.url}/{method}", json=dict(params, queue=self.name))
+                response.raise_for_status()
+                return response.json()['result']
+            except httpx.TransportError as e:
+                if retries >= self.max_retries:
+                    raise
+                log.warning(f"协调服务请求失败 (尝试 {retries}/{self.max_retries}): {e}")
+                await asyncio.sleep(min(2 ** retries, 60))
+
+    async def load(self, lines):
+        return await self.call('load', lines=lines)
+
+    async def lease(self, worker, count=1, lease_seconds=300):
+        return [tuple(row) for row in await self.call('lease', worker=worker, count=count, lease_seconds=lease_seconds)]
+
+    async def heartbeat(self, worker, lease_seconds=300):
+        return await self.call('heartbeat', worker=worker, lease_seconds=lease_seconds)
+
+    async def complete(self, worker, line_number, failed=False):
+        return await self.call('complete', worker=worker, line_number=line_number, failed=failed)
+
+    async def release(self, worker, line_number=None):
+        return await self.call('release', worker=worker, line_number=line_number)
+
+    async def progress(self):
+        return await self.call('progress')
+
+    async def unfinished(self):
+        counts = await self.progress()
+        return counts.get('pending', 0) + counts.get('leased', 0)
+
+    async def close(self):
+        await self.session.aclose()
+
+
+class QueueServer:
+    """在一台机器上把 SQLite 队列文件通过 HTTP 提供给其他机器的 worker（POST /<方法名>，JSON 参数和结果）。
+
+    没有认证，只在可信的内网里使用。
+    """
+
+    METHODS = ('load', 'lease', 'heartbeat', 'complete', 'release', 'progress')
+
+    def __init__(self, path='work_queue.db', host='127.0.0.1', port=8765, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.max_attempts = max_attempts
+        self.queues = {}
+        self.server = None
+
+    def queue(self, name):
+        if name not in self.queues:
+            self.queues[name] = WorkQueue(self.path, name, self.max_attempts)
+        return self.queues[name]
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        log.info(f"协调服务地址: http://{self.host}:{self.port}")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+        await self.server.wait_closed()
+        for queue in self.queues.values():
+            await queue.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            request = await reader.readline()
+            length = 0
+            while (header := (await reader.readline()).strip()):
+                name, _, value = header.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            params = json.loads(await reader.readexactly(length)) if length else {}
+            method = request.split()[1].decode('ascii').strip('/')
+            if method in self.METHODS:
+                queue = self.queue(params.pop('queue', 'default'))
+                status, body = '200 OK', {'result': await getattr(queue, method)(**params)}
+            else:
+                status, body = '404 Not Found', {'error': method}
+        except (ValueError, TypeError, KeyError) as e:
+            status, body = '400 Bad Request', {'error': str(e)}
+        except (ConnectionError, IndexError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        try:
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode('ascii') + data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class Heartbeat:
+    """处理期间每 lease_seconds / 3 秒为 worker 持有的租约续约一次。"""
+
+    def __init__(self, queue, worker, lease_seconds=300):
+        self.queue = queue
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.task = None
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self._loop())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.queue.heartbeat(self.worker, self.lease_seconds)
+            except Exception as e:
+                # 下一次心跳再试，租约在 lease_seconds 内不会过期
+                log.warning(f"续约失败: {e}")
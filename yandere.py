@@ -1,216 +1,81 @@
-import httpx
 import asyncio
-import aiofiles
-import os
 from pathlib import Path
-from PIL import Image
-import json
-
-async def download_image(session, item, filename, save_dir, error_flag, line_number):
-    max_retries = 10
-    retries = 0
-    
-    url = item.get('file_url')
-    
-    if not url:
-        print(f"未找到图片URL: {item}")
-        return False
-
-    while retries < max_retries:
-        try:
-            response = await session.get(url)
-            if response.status_code == 200:
-                content_type = response.headers.get('Content-Type', '')
-                if 'video' in content_type:
-                    print(f"跳过视频文件: {url}")
-                    return False
-
-                async with aiofiles.open(filename, 'wb') as f:
-                    await f.write(response.content)
-
-                if filename.suffix.lower() == '.webp':
-                    new_filename = filename.with_suffix('.jpg')
-                    try:
-                        with Image.open(filename) as img:
-                            if img.mode in ('RGBA', 'P'):
-                                img = img.convert('RGB')
-                            img.save(new_filename, 'JPEG')
-                        os.remove(filename)
-                        filename = new_filename
-                        print(f"转换完成: {filename}")
-                    except Exception as e:
-                        print(f"WebP转换失败: {e}, 文件: {filename}")
-                        os.remove(filename)
-                        return False
-
-                print(f"下载完成: {filename}")
-                
-                tag_string = item.get('tags', '')
-                processed_tags = tag_string.replace(' ', ',')
-                
-                txt_filename = filename.with_suffix('.txt')
-                async with aiofiles.open(txt_filename, 'w', encoding='utf-8') as txt_file:
-                    await txt_file.write(processed_tags)
-                print(f"写入TXT: {txt_filename}")
-                
-                return True
-            else:
-                print(f"下载失败 (状态码 {response.status_code}): {url}")
-                break
-        except Exception as e:
-            print(f"下载异常 (尝试 {retries + 1}/{max_retries}): {e} - {url}")
-            retries += 1
-            await asyncio.sleep(2)
-    
-    print(f"放弃下载: {url}")
-    error_flag['value'] = True
-    error_flag['lines'].append(line_number)
-    return False
-
-async def process_line(session, line, line_number, base_save_dir, max_images=5, existing_filenames=None, error_flag=None):
-    folder_name = line.strip().replace(' ', '_').replace('/', '_').replace('\\', '_')
-    save_dir = base_save_dir / folder_name
-    save_dir.mkdir(parents=True, exist_ok=True)
-    
-    processed_tags = line.strip().replace(' ', '_')
-    page = 1
-    processed_count = 0
-    
-    while processed_count < max_images:
-        url = f"https://yande.re/post.json?page={page}&tags={processed_tags}"
-        try:
-            response = await session.get(url)
-            if response.status_code == 200:
-                data = response.json()
-                if not data:
-                    print(f"Tag '{processed_tags}' 已无更多图片。")
-                    break
-                
-                for item in data:
-                    image_name = os.path.basename(item.get('file_url', ''))
-                    if not image_name:
-                        continue
-
-                    comparison_filename = image_name
-                    if comparison_filename.lower().endswith('.webp'):
-                        comparison_filename = comparison_filename[:-5] + '.jpg'
-                    
-                    if comparison_filename in existing_filenames:
-                        print(f"文件已存在: {comparison_filename}, 跳过下载")
-                        processed_count += 1 
-                        if processed_count >= max_images:
-                            return
-                        continue
-
-                    original_filename_path = save_dir / image_name
-                    
-                    success = await download_image(session, item, original_filename_path, save_dir, error_flag, line_number)
-                    if success:
-                        processed_count += 1
-                        existing_filenames.add(comparison_filename)
-                        if processed_count >= max_images:
-                            return
-                    elif error_flag['value']:
-                        print(f"因下载错误，终止处理Tag: '{line.strip()}'")
-                        return
-
-            else:
-                print(f"请求失败 (状态码 {response.status_code}): {url}")
-                error_flag['value'] = True
-                error_flag['lines'].append(line_number)
-                return
-        except json.JSONDecodeError:
-            print(f"JSON解析失败，可能是因为API返回了非JSON内容（如HTML错误页）: {url}")
-            error_flag['value'] = True
-            error_flag['lines'].append(line_number)
-            return
-        except Exception as e:
-            print(f"请求异常: {e} - {url}")
-            error_flag['value'] = True
-            error_flag['lines'].append(line_number)
-            return
-        
-        page += 1
-
-async def read_existing_filenames(base_save_dir):
-    existing_filenames = set()
-    print("正在扫描已存在的文件...")
-    for sub_dir in base_save_dir.glob('*'):
-        if sub_dir.is_dir():
-            for file in sub_dir.glob('*.jpg'):
-                existing_filenames.add(file.name)
-            for file in sub_dir.glob('*.png'):
-                existing_filenames.add(file.name)
-    print(f"扫描完成，找到 {len(existing_filenames)} 个已存在文件。")
-    return existing_filenames
-
-async def main(txt_path, save_dir="downloaded_images", timeout=1000, proxies=None, start_line=1, max_lines_per_batch=5, max_images=5):
-    print("开始执行脚本...")
-    print(f"当前工作目录: {os.getcwd()}")
-    print(f"尝试打开文件: {txt_path}")
-
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-
-    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout), proxies=proxies, headers=headers) as session:
-        lines = []
-        try:
-            async with aiofiles.open(txt_path, mode='r', encoding='utf-8') as file:
-                all_lines = await file.readlines()
-                lines = [line.strip() for line in all_lines[start_line - 1:] if line.strip()]
-
-            print(f"成功读取文件: {txt_path}, 从第 {start_line} 行开始，共 {len(lines)} 行待处理。")
-        except FileNotFoundError:
-            print(f"错误: 文件 {txt_path} 不存在.")
-            return None
-        
-        base_save_dir = Path(save_dir)
-        base_save_dir.mkdir(parents=True, exist_ok=True)
-        print(f"创建/检查基础保存目录: {base_save_dir}")
-
-        existing_filenames = await read_existing_filenames(base_save_dir)
-        
-        error_flag = {'value': False, 'lines': []}
-        tasks_with_linenumbers = [(line, start_line + i) for i, line in enumerate(lines)]
-
-        for i in range(0, len(tasks_with_linenumbers), max_lines_per_batch):
-            batch = tasks_with_linenumbers[i:i + max_lines_per_batch]
-            print(f"开始处理批次 {i // max_lines_per_batch + 1}")
-            
-            tasks = [
-                process_line(session, line, line_num, base_save_dir, max_images, existing_filenames, error_flag)
-                for line, line_num in batch
-            ]
-            
-            await asyncio.gather(*tasks)
-
-            if error_flag['value']:
-                error_lines = sorted(set(error_flag['lines']))
-                print(f"\n检测到下载异常，停止脚本。出错的行号: {', '.join(map(str, error_lines))}")
-                return min(error_lines)
-        
-    return None
+from engine import Crawl, CrawlEngine
+from sinks import FolderSink
+from sources import MoebooruSource, make_policy, make_caption_rules
+from workqueue import default_worker_id, worker_dir
+
+async def main(txt_path, save_dir="downloaded_images", timeout=60.0, proxies=None, start_line=1, page_fetchers=5, max_images=5, download_workers=8, queue_size=100, api_concurrency=2, cdn_concurrency=8, convert_workers=None, jpeg_quality=95, manifest_path=None, pagination_mode='cursor', page_limit=100, api_rate=5.0, cdn_rate=20.0, dedupe='skip', api_timeout=30.0, http2=False, listing_cache_path=None, cache_ttl=3600, offline=False, log_level='info', metrics_port=None, metrics_path=None, min_side=None, max_file_bytes=None, prefer_ext=(), byte_budget=None, work_queue=None, worker_id=None, refresh_after=None, proxy_pool=None, verify_images=True, quarantine_dir=None, metadata_format='txt', caption_exclude=(), caption_max_tags=None, caption_prefix=()):
+    base_save_dir = Path(save_dir)
+    # 分布式抓取时每个 worker 写入 save_dir 下自己的文件夹，清单和列表缓存仍在 save_dir
+    worker_id = (worker_id or default_worker_id()) if work_queue else None
+    source = MoebooruSource(page_limit=page_limit, pagination_mode=pagination_mode, policy=make_policy(min_side, max_file_bytes, prefer_ext),
+                            caption_rules=make_caption_rules(caption_exclude, max_tags=caption_max_tags, prefix=caption_prefix))
+    crawl = Crawl(source, FolderSink(worker_dir(base_save_dir, worker_id) if worker_id else base_save_dir, metadata_format), txt_path, start_line, max_images, page_fetchers, download_workers, queue_size,
+                  api_concurrency, cdn_concurrency, api_rate, cdn_rate, timeout, api_timeout, proxies, http2,
+                  listing_cache_path or base_save_dir / 'listing_cache.db', cache_ttl, offline, byte_budget=byte_budget, work_queue=work_queue, worker_id=worker_id, refresh_after=refresh_after, proxy_pool=proxy_pool,
+                  verify=verify_images, quarantine_dir=quarantine_dir or base_save_dir / '.quarantine')
+    engine = CrawlEngine(manifest_path or base_save_dir / 'manifest.db', convert_workers, jpeg_quality, dedupe, log_level=log_level, metrics_port=metrics_port, metrics_path=metrics_path)
+    failed_lines, = await engine.run([crawl])
+    return failed_lines[0] if failed_lines else None
 
 if __name__ == "__main__":
     txt_path = "artist_full.txt"  # 所有你需要爬的标签txt，每行一个tag，不同tag会保存到不同的文件夹里
     save_dir = "./yande" # 修改保存目录以区分
-    timeout = 30                 # 超时时间（秒），不建议设置过高
+    timeout = 60                 # 图片下载的读超时（秒），即两次收到数据之间最长的等待
+    api_timeout = 30             # API请求的读超时（秒）
     # 如果不需要代理，请设置为 None
     proxies = {"http://": 'http://127.0.0.1:7890', "https://": 'http://127.0.0.1:7890'}
-    max_lines_per_batch = 5      # 同时处理的tag数量（并发数）
+    page_fetchers = 5            # 同时翻页的tag数量
+    download_workers = 8         # 下载worker数量
+    queue_size = 100             # 待下载队列长度，队列满时翻页暂停
+    api_concurrency = 2          # API请求最大并发数
+    cdn_concurrency = 8          # 图片下载最大并发数
+    convert_workers = None       # WebP转JPEG的进程数，None为CPU核数
+    jpeg_quality = 95            # 转换后的JPEG质量
+    manifest_path = None         # 已抓取帖子的SQLite清单，None为 save_dir/manifest.db
+    pagination_mode = "cursor"   # 翻页方式: 'cursor' 按帖子id键集翻页，'page' 为数字页码
+    page_limit = 100             # 每页条数，yande.re 最多 100
+    api_rate = 2.0               # API初始请求速率(请求/秒)，会根据429/Retry-After和错误率自动调整
+    cdn_rate = 10.0              # 图片CDN初始请求速率(请求/秒)
+    listing_cache_path = None    # 列表页缓存，None为 save_dir/listing_cache.db
+    cache_ttl = 3600             # 列表页缓存有效期（秒），过期后用 ETag/Last-Modified 重新验证；None 不使用缓存
+    offline = False              # True 时只读缓存、不请求API也不下载图片，用于离线演练（建议配合单独的 manifest_path）
+    http2 = False                # HTTP/2 多路复用，需要 pip install httpx[http2]
+    log_level = "info"           # 日志级别: 'debug' 输出每个文件的事件，'info' 每个tag的进度，'warning' 只输出失败
+    metrics_port = None          # 在本机该端口提供 Prometheus 格式的 /metrics，None 不开启
+    metrics_path = None          # 每30秒向该文件追加一行 JSON 指标快照（耗时、字节数、队列长度、重试和跳过原因），None 不写
+    min_side = None              # 变体选择: 短边至少多少像素，设置后在各尺寸的变体中选满足条件且字节数最少的；None 使用默认变体
+    max_file_bytes = None        # 单个文件最大字节数，超过的变体不下载
+    prefer_ext = ()              # 满足条件的变体中优先的格式，例如 ("jpg",) 可以避免 WebP 转换
+    byte_budget = None           # 本次运行最多下载的字节数，例如 20 * 1024 ** 3；达到后停止，断点保留，None 不限
+    dedupe = "link"              # 按md5去重: 'skip' 重复内容不下载也不计数，'link' 不下载但硬链接到当前tag并计数，None 关闭
+                                 # 把 manifest_path 指向 Danbooru 脚本的清单即可跨站点去重
+    work_queue = None            # 分布式抓取: 共享的工作队列文件或协调服务地址，见 coordinator.py；结束后用 merge_workers.py 合并输出
+    worker_id = None             # worker 名，输出写入 save_dir/worker-<worker_id>；None为 主机名-进程号
     max_images = 1500            # 每个tag最多爬的图片数
     start_line = 1               # 从txt文件的第几行开始爬取
-
-    while True:
+    refresh_after = None         # 增量模式: 已完成的tag距上次抓取超过多少秒时(例如 86400)只请求比上次更新的帖子(id:>N)；None 已完成的tag不再请求
+    proxy_pool = None            # 代理池: 多个代理地址的列表，设置后忽略 proxies；并发和速率都是每个代理的值，download_workers 相应调大到 cdn_concurrency×代理数
+    verify_images = True         # 下载后检查图片结构，原图另按 API 的 md5 校验；不通过的文件隔离后重新下载
+    quarantine_dir = None        # 校验失败的文件和原因（quarantine.jsonl）移到这里，None为 save_dir/.quarantine
+    metadata_format = "txt"      # 标注和元数据: 'txt' 同名txt标注，'jsonl' 每个tag文件夹一个 metadata.jsonl（帖子id、评级、分数、标注、完整标签），'both' 两者都写
+    caption_exclude = ()         # 标注里去掉的标签，可以用通配符，例如 ("highres", "*_background")
+    caption_max_tags = None      # 标注最多保留多少个标签，None 不限
+    caption_prefix = ()          # 放在每个标注最前面的标签，例如 LoRA 的触发词
+    max_restarts = 3             # 有标签行多次请求失败时最多重新启动几次；返回 4xx 的tag记入断点，不会重新启动
+
+    for restart in range(max_restarts + 1):
         try:
-            result = asyncio.run(main(txt_path, save_dir, timeout, proxies, start_line, max_lines_per_batch, max_images))
+            result = asyncio.run(main(txt_path, save_dir, timeout, proxies, start_line, page_fetchers, max_images, download_workers, queue_size, api_concurrency, cdn_concurrency, convert_workers, jpeg_quality, manifest_path, pagination_mode, page_limit, api_rate, cdn_rate, dedupe, api_timeout, http2, listing_cache_path, cache_ttl, offline, log_level, metrics_port, metrics_path, min_side, max_file_bytes, prefer_ext, byte_budget, work_queue, worker_id, refresh_after, proxy_pool, verify_images, quarantine_dir, metadata_format, caption_exclude, caption_max_tags, caption_prefix))
             
             if result is None:
                 print("\n所有任务已成功完成！")
                 break
+            elif restart == max_restarts:
+                print(f"\n第 {result} 行等标签行重新启动 {max_restarts} 次后仍然失败，已保存断点，下次运行继续。")
             else:
-                print(f"\n脚本将在发生错误的行 {result} 处重新启动。")
+                print(f"\n脚本将在发生错误的行 {result} 处重新启动，各tag从断点继续。")
                 start_line = result
 
         except KeyboardInterrupt: